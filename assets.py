@@ -0,0 +1,41 @@
+import io
+
+import streamlit as st
+from PIL import Image
+
+# Maximum width (in pixels) of the content of the page, the images wider than
+# it are resized by st.image (it is 2 * 730 in streamlit 1.10)
+MAXIMUM_CONTENT_WIDTH = 2 * 730
+
+
+@st.experimental_singleton
+def page_image(path: str) -> bytes:
+    """
+    Returns an image of the page resized to the maximum width of the content.
+
+    st.image resizes and encodes again the images wider than the page in each
+    run of the script (about half a second for the bilayer image). The
+    resized image is made once per server, so st.image only has to send it.
+
+    Parameters
+    ----------
+    path : str
+        The path to the image.
+
+    Returns
+    -------
+    bytes
+        The content of the image in its original format.
+    """
+    with Image.open(path) as image:
+        width, height = image.size
+        if width <= MAXIMUM_CONTENT_WIDTH:
+            with open(path, "rb") as fopen:
+                return fopen.read()
+        resized = image.resize(
+            (MAXIMUM_CONTENT_WIDTH, int(height * MAXIMUM_CONTENT_WIDTH / width)),
+            resample=Image.BILINEAR,
+        )
+        output = io.BytesIO()
+        resized.save(output, format=image.format)
+    return output.getvalue()
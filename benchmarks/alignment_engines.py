@@ -0,0 +1,167 @@
+"""
+Compares the batched python alignment engine with the serial one.
+
+Usage: python benchmarks/alignment_engines.py [--seeds 10] [-o results.json]
+
+The inputs of the minimization of each molecule in data/ are recorded from
+its alignment and the minimization is run with both engines and several
+seeds. For each engine, the median wall time, the mean and standard
+deviation of the final Chi2 and the mean number of trial moves, accepted
+moves and improvements of the Chi2 are reported. The engines are
+stochastic, so the runs differ but the statistics of both engines should
+agree within their errors.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from contextlib import redirect_stdout
+from typing import Any, Callable
+
+import gaddlemaps._alignment
+import gaddlemaps._backend
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from minimization import batched_minimize_molecules  # noqa: E402
+from progress import Chi2Stream  # noqa: E402
+from utilities import GlobalInformation, file_from_content  # noqa: E402
+
+DATA = os.path.join(ROOT, "data")
+SYSTEM = "system_CG.gro"
+# (topology in the initial resolution, files in the final resolution)
+MOLECULES = [
+    ("CG/EMIM.itp", ("AA/EMIM.gro", "AA/EMIM.itp")),
+    ("CG/DECS_augmented.itp", ("AA/DS.gro", "AA/DS.itp")),
+]
+
+
+def _read(fname: str):
+    with open(os.path.join(DATA, fname), "rb") as fopen:
+        return file_from_content(os.path.basename(fname), fopen.read())
+
+
+def minimization_inputs() -> dict[str, tuple]:
+    """
+    Returns the arguments of the minimization of each molecule.
+    """
+    information = GlobalInformation()
+    information.load_system_files(
+        [_read(SYSTEM)] + [_read(top) for top, _ in MOLECULES],
+        tuple([SYSTEM] + [top for top, _ in MOLECULES]),
+    )
+    for mol, (_, (fgro, ftop)) in zip(
+        information.system.different_molecules, MOLECULES
+    ):
+        information.load_end_molecule(mol.name, _read(fgro), _read(ftop), (fgro, ftop))
+    inputs = {}
+    old_minimize = gaddlemaps._alignment.minimize_molecules
+    try:
+        for mol_name, alignment in information.molecule_correspondence.items():
+
+            def record(*args, mol_name=mol_name):
+                inputs[mol_name] = args
+                return args[1]
+
+            gaddlemaps._alignment.minimize_molecules = record
+            alignment.align_molecules(information._parsed_restrictions(mol_name))
+    finally:
+        gaddlemaps._alignment.minimize_molecules = old_minimize
+    return inputs
+
+
+def serial_engine(args: tuple, counts: dict[str, int]) -> np.ndarray:
+    """
+    Runs the python engine of gaddlemaps counting the trial moves.
+    """
+    old_accept = gaddlemaps._backend.accept_metropolis
+
+    def accept(*accept_args) -> bool:
+        accepted = old_accept(*accept_args)
+        counts["trials"] = counts.get("trials", 0) + 1
+        counts["accepted"] = counts.get("accepted", 0) + bool(accepted)
+        return accepted
+
+    gaddlemaps._backend.accept_metropolis = accept
+    try:
+        return gaddlemaps._backend._minimize_molecules(*args)
+    finally:
+        gaddlemaps._backend.accept_metropolis = old_accept
+
+
+def batched_engine(args: tuple, counts: dict[str, int]) -> np.ndarray:
+    return batched_minimize_molecules(*args, statistics=counts)
+
+
+ENGINES: dict[str, Callable[[tuple, dict[str, int]], np.ndarray]] = {
+    "serial": serial_engine,
+    "batched": batched_engine,
+}
+
+
+def run_engine(engine: str, args: tuple, seed: int) -> dict[str, float]:
+    """
+    Runs a minimization and returns its time and statistics.
+    """
+    counts: dict[str, int] = {}
+    np.random.seed(seed)
+    start = time.perf_counter()
+    with redirect_stdout(Chi2Stream()) as output:
+        ENGINES[engine](args, counts)
+    wall_time = time.perf_counter() - start
+    return {
+        "time": wall_time,
+        "chi2": output.chi2,
+        "trials": counts["trials"],
+        "accepted": counts["accepted"],
+        "improvements": output.step,
+    }
+
+
+def summary(runs: list[dict[str, float]]) -> dict[str, float]:
+    chi2 = [run["chi2"] for run in runs]
+    return {
+        "time": statistics.median(run["time"] for run in runs),
+        "chi2_mean": statistics.mean(chi2),
+        "chi2_std": statistics.stdev(chi2) if len(chi2) > 1 else 0.0,
+        "trials": statistics.mean(run["trials"] for run in runs),
+        "acceptance": statistics.mean(run["accepted"] / run["trials"] for run in runs),
+        "improvements": statistics.mean(run["improvements"] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--seeds", type=int, default=10, help="runs of each engine")
+    parser.add_argument("-o", "--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    results: dict[str, Any] = {}
+    columns = ("time", "chi2_mean", "chi2_std", "trials", "acceptance", "improvements")
+    print(f"{'molecule':>10s} {'engine':>8s} " + " ".join(f"{c:>12s}" for c in columns))
+    for mol_name, inputs in minimization_inputs().items():
+        results[mol_name] = {}
+        for engine in ENGINES:
+            runs = [run_engine(engine, inputs, seed) for seed in range(args.seeds)]
+            results[mol_name][engine] = {"summary": summary(runs), "runs": runs}
+            values = results[mol_name][engine]["summary"]
+            print(
+                f"{mol_name:>10s} {engine:>8s} "
+                + " ".join(f"{values[c]:12.4g}" for c in columns)
+            )
+        speedup = (
+            results[mol_name]["serial"]["summary"]["time"]
+            / results[mol_name]["batched"]["summary"]["time"]
+        )
+        print(f"{mol_name:>10s} speedup {speedup:.1f}x")
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Compares the .gro serializer used to render the molecules with the original
+per-atom loop.
+
+Usage: python benchmarks/gro_serializer.py [--sizes 1000 10000 50000]
+
+Besides the molecules in data/AA, synthetic molecules with the requested
+number of atoms are generated. The script fails if the outputs differ.
+"""
+import argparse
+import os
+import sys
+import timeit
+from io import StringIO
+
+import numpy as np
+from gaddlemaps.components import Molecule
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utilities import molecule_gro_content  # noqa: E402
+
+
+def loop_gro_content(molecule: Molecule) -> str:
+    """
+    The original implementation of molecule_gro_content.
+    """
+    lines = ["test", f"{len(molecule)}"]
+    for atom in molecule:
+        atom = atom.copy()
+        lines.append(atom.gro_line(parsed=False))
+    lines += ["    0.0000    0.0000    0.0000"]
+    return "\n".join(lines)
+
+
+def _named_file(content: str, name: str) -> StringIO:
+    fopen = StringIO(content)
+    fopen.mode = "r"  # type: ignore
+    fopen.name = name  # type: ignore
+    return fopen
+
+
+def synthetic_molecule(n_atoms: int, atoms_per_residue: int = 10) -> Molecule:
+    """
+    Returns a random chain molecule with n_atoms split in residues.
+    """
+    rng = np.random.default_rng(0)
+    positions = np.cumsum(rng.normal(0, 0.1, (n_atoms, 3)), axis=0) + 50
+    gro_lines = ["synthetic", str(n_atoms)]
+    itp_lines = ["[ moleculetype ]", "SYN 3", "", "[ atoms ]"]
+    for index, position in enumerate(positions):
+        resid = index // atoms_per_residue + 1
+        name = f"C{index % atoms_per_residue}"
+        gro_lines.append(
+            "{:5d}{:5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}".format(
+                resid % 99999, "SYN", name, (index + 1) % 99999, *position
+            )
+        )
+        itp_lines.append(
+            f"{index + 1:6d} C {resid:6d} SYN {name:>5s} {index + 1:6d} 0.0"
+        )
+    gro_lines.append("   100.00000   100.00000   100.00000")
+    itp_lines += ["", "[ bonds ]"]
+    itp_lines += [f"{index:6d} {index + 1:6d} 1" for index in range(1, n_atoms)]
+    return Molecule.from_files(
+        _named_file("\n".join(gro_lines) + "\n", "synthetic.gro"),
+        _named_file("\n".join(itp_lines) + "\n", "synthetic.itp"),
+    )
+
+
+def data_molecules() -> dict[str, Molecule]:
+    folder = os.path.join(ROOT, "data", "AA")
+    molecules = {}
+    for fname in sorted(os.listdir(folder)):
+        name, ext = os.path.splitext(fname)
+        if ext == ".gro":
+            molecules[name] = Molecule.from_files(
+                os.path.join(folder, fname), os.path.join(folder, name + ".itp")
+            )
+    return molecules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="*", default=[1000, 10000, 50000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    molecules = data_molecules()
+    for size in args.sizes:
+        molecules[f"synthetic_{size}"] = synthetic_molecule(size)
+
+    print(f"{'molecule':>16s} {'atoms':>7s} {'loop (s)':>10s} {'numpy (s)':>10s} "
+          f"{'speedup':>8s}")
+    for name, molecule in molecules.items():
+        if molecule_gro_content(molecule) != loop_gro_content(molecule):
+            sys.exit(f"The output for {name} is different")
+        number = max(1, 2000 // len(molecule))
+        times = []
+        for func in (loop_gro_content, molecule_gro_content):
+            timer = timeit.Timer(lambda: func(molecule))
+            times.append(min(timer.repeat(args.repeat, number)) / number)
+        print(f"{name:>16s} {len(molecule):7d} {times[0]:10.5f} {times[1]:10.5f} "
+              f"{times[0] / times[1]:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Times each phase of the mapping with the files in data/ and with larger
+systems made by replicating data/system_CG.gro.
+
+Usage:
+    python benchmarks/pipeline_phases.py run [--sizes 1 2 4] [-o results.json]
+                                             [--baseline old.json]
+    python benchmarks/pipeline_phases.py compare old.json new.json
+
+The phases are the parsing of the uploaded system, the recognition of the
+molecules (building the residue index and add_ftop), the alignment, the
+exchange maps, the extrapolation and the serialization of the molecules for
+the 3D views. The molecules are only aligned once (with a fixed seed)
+because the alignment does not depend on the size of the system. The results
+are written as JSON and two results files can be compared: the phases that
+got slower than the threshold are reported as regressions and the script
+exits with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Any, Callable, Optional
+
+import gaddlemaps
+import numpy as np
+from gaddlemaps.components import System
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from profiling import memory_usage  # noqa: E402
+from residues import add_ftop, residue_index  # noqa: E402
+from utilities import (  # noqa: E402
+    DEFAULT_ATOM_BUDGET,
+    GlobalInformation,
+    available_engines,
+    file_from_content,
+    molecule_gro_content,
+    reduced_gro_content,
+    write_and_get_file,
+)
+
+DATA = os.path.join(ROOT, "data")
+# (topology in the initial resolution, files in the final resolution)
+MOLECULES = [
+    ("CG/EMIM.itp", ("AA/EMIM.gro", "AA/EMIM.itp")),
+    ("CG/DECS_augmented.itp", ("AA/DS.gro", "AA/DS.itp")),
+]
+PHASES = [
+    "parse",
+    "recognition",
+    "align",
+    "exchange_maps",
+    "extrapolate",
+    "serialization",
+]
+# Relative increase of the time of a phase reported as a regression
+DEFAULT_THRESHOLD = 0.2
+# Differences smaller than this (in seconds) are ignored
+MIN_DIFFERENCE = 0.01
+
+
+def _read(fname: str):
+    with open(os.path.join(DATA, fname), "rb") as fopen:
+        return file_from_content(os.path.basename(fname), fopen.read())
+
+
+def replicated_system(factor: int) -> bytes:
+    """
+    Returns data/system_CG.gro replicated factor times along the x axis.
+    """
+    with open(os.path.join(DATA, "system_CG.gro")) as fopen:
+        lines = fopen.read().splitlines()
+    n_atoms = int(lines[1])
+    atoms, box = lines[2 : 2 + n_atoms], lines[2 + n_atoms].split()
+    n_residues = max(int(line[:5]) for line in atoms)
+    box_x = float(box[0])
+    new_lines = [f"{lines[0]} x{factor}", str(n_atoms * factor)]
+    for copy in range(factor):
+        for index, line in enumerate(atoms):
+            resid = int(line[:5]) + copy * n_residues
+            atomid = copy * n_atoms + index + 1
+            x_pos = float(line[20:28]) + copy * box_x
+            new_lines.append(
+                f"{resid % 100000:5d}{line[5:15]}{atomid % 100000:5d}"
+                f"{x_pos:8.3f}{line[28:]}"
+            )
+    box[0] = f"{box_x * factor:.5f}"
+    new_lines.append("   " + "   ".join(box))
+    return ("\n".join(new_lines) + "\n").encode()
+
+
+def _timed(func: Callable[[], Any]) -> tuple[Any, float]:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run_case(
+    system_content: bytes,
+    engine: str,
+    alignments: Optional[dict[str, tuple[np.ndarray, np.ndarray]]] = None,
+) -> tuple[dict[str, float], dict[str, tuple[np.ndarray, np.ndarray]], int]:
+    """
+    Runs all the phases of a mapping once.
+
+    Parameters
+    ----------
+    system_content : bytes
+        The content of the .gro file of the system.
+    engine : str
+        The alignment engine.
+    alignments : dict, optional
+        The aligned positions of the molecules. If given, the molecules are
+        not aligned again and the time of the alignment is not measured.
+
+    Returns
+    -------
+    times : dict of str: float
+        The time in seconds of each phase.
+    alignments : dict
+        The aligned positions of the molecules.
+    n_atoms : int
+        The number of atoms in the system.
+    """
+    times = {}
+    upl_system = file_from_content("system.gro", system_content)
+    system, times["parse"] = _timed(lambda: System(write_and_get_file(upl_system)))
+    topologies = [_read(top) for top, _ in MOLECULES]
+
+    def recognize():
+        residue_index(system)
+        for upl in topologies:
+            add_ftop(system, write_and_get_file(upl))
+
+    _, times["recognition"] = _timed(recognize)
+
+    information = GlobalInformation()
+    information.engine = engine
+    information.system_files = [upl_system] + topologies
+    information.set_system(system, tuple(map(str, range(len(topologies) + 1))))
+    for mol, (_, (fgro, ftop)) in zip(system.different_molecules, MOLECULES):
+        information.load_end_molecule(mol.name, _read(fgro), _read(ftop), (fgro, ftop))
+    if alignments is None:
+        seeds = {mol.name: 1 for mol in system.different_molecules}
+        with redirect_stdout(StringIO()):
+            _, times["align"] = _timed(
+                lambda: information.align_molecules(seeds=seeds)
+            )
+        alignments = {
+            name: (ali.start.atoms_positions, ali.end.atoms_positions)
+            for name, ali in information.molecule_correspondence.items()
+        }
+    else:
+        for name, positions in alignments.items():
+            information.restore_alignment(name, *positions)
+
+    _, times["exchange_maps"] = _timed(
+        lambda: information.calculate_exchange_maps(0.5)
+    )
+    _, times["extrapolate"] = _timed(information.extrapolate_system)
+
+    def serialize():
+        for alignment in information.molecule_correspondence.values():
+            for molecule in (alignment.start, alignment.end):
+                molecule_gro_content(molecule)
+                reduced_gro_content(molecule, DEFAULT_ATOM_BUDGET)
+
+    _, times["serialization"] = _timed(serialize)
+    return times, alignments, system.system_gro.n_atoms
+
+
+def run(sizes: list[int], repeat: int, engine: str) -> dict[str, Any]:
+    """
+    Runs the benchmark for each replication factor of the system.
+
+    The time of each phase is the minimum of the repetitions.
+
+    Returns
+    -------
+    dict
+        The results with the metadata of the run.
+    """
+    cases: dict[str, Any] = {}
+    alignments = None
+    for size in sizes:
+        content = replicated_system(size)
+        best: dict[str, float] = {}
+        for _ in range(repeat):
+            times, alignments, n_atoms = run_case(content, engine, alignments)
+            for phase, value in times.items():
+                best[phase] = min(value, best.get(phase, value))
+        name = f"x{size}"
+        best = {phase: best[phase] for phase in PHASES if phase in best}
+        cases[name] = {"atoms": n_atoms, "phases": best}
+        print(
+            f"{name:>5s} {n_atoms:8d} atoms: "
+            + ", ".join(f"{phase} {value:.3f} s" for phase, value in best.items())
+        )
+    return {
+        "metadata": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "gaddlemaps": getattr(gaddlemaps, "__version__", "unknown"),
+            "engine": engine,
+            "repeat": repeat,
+            "peak_memory_mb": memory_usage()[1],
+        },
+        "cases": cases,
+    }
+
+
+def compare(
+    baseline: dict[str, Any],
+    current: dict[str, Any],
+    threshold: float = DEFAULT_THRESHOLD,
+) -> list[str]:
+    """
+    Compares two results and returns the description of the regressions.
+
+    A phase is a regression if it is more than threshold (relative) and
+    MIN_DIFFERENCE seconds slower than in the baseline. Only the cases and
+    phases in both results are compared.
+    """
+    regressions = []
+    print(
+        f"{'case':>5s} {'phase':>14s} {'baseline':>9s} {'current':>9s} "
+        f"{'change':>8s}"
+    )
+    for name, case in current["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        old_phases = baseline["cases"][name]["phases"]
+        for phase, new in case["phases"].items():
+            if phase not in old_phases:
+                continue
+            old = old_phases[phase]
+            change = (new - old) / old if old > 0 else 0.0
+            flag = ""
+            if new - old > MIN_DIFFERENCE and change > threshold:
+                flag = " REGRESSION"
+                regressions.append(f"{name} {phase}: {old:.3f} s -> {new:.3f} s")
+            print(f"{name:>5s} {phase:>14s} {old:9.3f} {new:9.3f} {change:+7.0%}{flag}")
+    return regressions
+
+
+def _load(fname: str) -> dict[str, Any]:
+    with open(fname) as fopen:
+        return json.load(fopen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run the benchmark")
+    run_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[1, 2],
+        help="replication factors of data/system_CG.gro",
+    )
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument(
+        "--engine", choices=available_engines(), default=available_engines()[0]
+    )
+    run_parser.add_argument("-o", "--output", help="JSON file for the results")
+    run_parser.add_argument("--baseline", help="results to compare with")
+    compare_parser = subparsers.add_parser("compare", help="compare two results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument(
+            "--threshold",
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help="relative slowdown reported as a regression (default: 0.2)",
+        )
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(args.sizes, args.repeat, args.engine)
+        if args.output:
+            with open(args.output, "w") as fout:
+                json.dump(results, fout, indent=2)
+        if not args.baseline:
+            return
+        baseline, current = _load(args.baseline), results
+    else:
+        baseline, current = _load(args.baseline), _load(args.current)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        sys.exit("Regressions:\n" + "\n".join(regressions))
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
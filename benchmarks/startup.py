@@ -0,0 +1,154 @@
+"""
+Measures the cold start of the app: the import time of its modules and the
+time until the page is shown.
+
+Usage: python benchmarks/startup.py [--runs 3] [--port 8599] [-o results.json]
+
+The import time of each module is measured in a new interpreter with
+streamlit already imported, as it is in the server. For the page, a new
+server is started in each run and a session is opened through its
+websocket. The time until the first element is received and until the
+script finishes are reported for the first run of the script in the new
+server (cold) and for a rerun of the same session (warm).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Any
+
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from tornado.websocket import websocket_connect
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["gaddlemaps", "py3Dmol", "utilities", "components"]
+# Seconds to wait for the server to start
+SERVER_TIMEOUT = 60
+
+
+def import_time(module: str) -> float:
+    """
+    Returns the seconds taken to import a module in a new interpreter.
+    """
+    code = (
+        "import time, streamlit, streamlit.components.v1\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.split()[-1])
+
+
+async def _script_run(url: str, connection=None) -> tuple[Any, float, float]:
+    start = time.perf_counter()
+    if connection is None:
+        connection = await websocket_connect(url)
+    message = BackMsg()
+    message.rerun_script.query_string = ""
+    await connection.write_message(message.SerializeToString(), binary=True)
+    first_element = None
+    while True:
+        data = await connection.read_message()
+        if data is None:
+            raise RuntimeError("The server closed the connection")
+        forward = ForwardMsg()
+        forward.ParseFromString(data)
+        kind = forward.WhichOneof("type")
+        if kind == "delta" and first_element is None:
+            first_element = time.perf_counter() - start
+        elif kind == "script_finished":
+            return connection, first_element, time.perf_counter() - start
+
+
+def page_times(port: int) -> dict[str, float]:
+    """
+    Starts a server and returns the times to show the page.
+    """
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "streamlit",
+            "run",
+            "gaddlemaps_app.py",
+            "--server.headless",
+            "true",
+            "--server.port",
+            str(port),
+            "--server.fileWatcherType",
+            "none",
+        ],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(f"http://localhost:{port}/healthz")
+                break
+            except OSError:
+                if time.perf_counter() - start > SERVER_TIMEOUT:
+                    raise RuntimeError("The server did not start")
+                time.sleep(0.05)
+        times = {"server_start": time.perf_counter() - start}
+
+        async def session():
+            url = f"ws://localhost:{port}/stream"
+            connection, times["cold_first_element"], times["cold_page"] = (
+                await _script_run(url)
+            )
+            _, times["warm_first_element"], times["warm_page"] = await _script_run(
+                url, connection
+            )
+            connection.close()
+
+        asyncio.run(session())
+        return times
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8599)
+    parser.add_argument("-o", "--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    results: dict[str, Any] = {"imports": {}, "page": {}}
+    print(f"{'module':>24s} {'import (s)':>10s}")
+    for module in MODULES:
+        value = min(import_time(module) for _ in range(args.runs))
+        results["imports"][module] = value
+        print(f"{module:>24s} {value:10.3f}")
+
+    runs = [page_times(args.port) for _ in range(args.runs)]
+    print(f"\n{'page':>24s} {'median (s)':>10s}")
+    for name in runs[0]:
+        value = statistics.median(run[name] for run in runs)
+        results["page"][name] = value
+        print(f"{name:>24s} {value:10.3f}")
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import copy
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Union
+
+import numpy as np
+import streamlit as st
+from gaddlemaps.components import Molecule, System
+from gaddlemaps.parsers import open_coordinate_file
+from streamlit.logger import get_logger
+from streamlit.uploaded_file_manager import UploadedFile
+
+from residues import add_ftop, residue_index
+from utilities import reopen_file, write_and_get_file
+
+# Default memory cap of the parse cache (in MB). It can be changed with the
+# GADDLEMAPS_PARSE_CACHE_MB environment variable. It limits the estimated
+# memory of the cached objects (see ParseCache), not of the whole server.
+DEFAULT_PARSE_CACHE_MB = 512
+
+# Approximate memory (in bytes) used per atom by the parsed objects, measured
+# with tracemalloc. A System reads the coordinates lazily from its .gro file,
+# so it only keeps a few integers per atom, while each atom of a Molecule is a
+# python object with its coordinates and topology.
+_SYSTEM_ATOM_BYTES = 16
+_MOLECULE_ATOM_BYTES = 1536
+
+# Default location and size cap (in MB) of the alignment cache. They can be
+# changed with the GADDLEMAPS_ALIGNMENT_CACHE_DIR and
+# GADDLEMAPS_ALIGNMENT_CACHE_MB environment variables.
+DEFAULT_ALIGNMENT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "gaddlemaps_interface", "alignments"
+)
+DEFAULT_ALIGNMENT_CACHE_MB = 256
+# Seconds after which a temporary file of the alignment cache is considered
+# abandoned by a writer that was killed before renaming it
+STALE_TEMP_SECONDS = 600
+
+_LOGGER = get_logger(__name__)
+
+
+# Number of upload ids whose content hash is remembered
+_MAX_REMEMBERED_HASHES = 1024
+_upload_hashes: OrderedDict[int, str] = OrderedDict()
+_upload_hashes_lock = threading.Lock()
+
+
+def hash_uploaded_file(uploaded_file: UploadedFile) -> str:
+    """
+    Returns the sha256 hex digest of the content of an uploaded file.
+
+    The digest is remembered by the upload id (unique in the server) so the
+    content of large files is not hashed again in every rerun.
+
+    Parameters
+    ----------
+    uploaded_file : UploadedFile
+        The file uploaded by streamlit.
+
+    Returns
+    -------
+    str
+        The hex digest of the file content.
+    """
+    file_id = getattr(uploaded_file, "id", None)
+    if file_id is not None:
+        with _upload_hashes_lock:
+            digest = _upload_hashes.get(file_id)
+        if digest is not None:
+            return digest
+    digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    if file_id is not None:
+        with _upload_hashes_lock:
+            _upload_hashes[file_id] = digest
+            while len(_upload_hashes) > _MAX_REMEMBERED_HASHES:
+                _upload_hashes.popitem(last=False)
+    return digest
+
+
+def estimated_size(value: Union[System, Molecule]) -> int:
+    """
+    Returns the approximate memory (in bytes) used by a parsed object.
+
+    The estimate is proportional to the number of atoms of the system and of
+    its recognized molecules or to the number of atoms of the molecule.
+
+    Parameters
+    ----------
+    value : gaddlemaps.components.System or gaddlemaps.components.Molecule
+        The parsed object.
+
+    Returns
+    -------
+    int
+        The estimated memory used by the object.
+    """
+    if isinstance(value, System):
+        return value.system_gro.n_atoms * _SYSTEM_ATOM_BYTES + sum(
+            estimated_size(mol) for mol in value.different_molecules
+        )
+    return len(value) * _MOLECULE_ATOM_BYTES
+
+
+def copy_system(system: System) -> System:
+    """
+    Returns an independent copy of a System without parsing it again.
+
+    The parsed residues of the .gro file and its residue index are shared
+    (they are never modified) but the copy gets its own file handle, molecules
+    and recognition arrays so it can be used (or extended with add_ftop) from
+    a different session.
+
+    Parameters
+    ----------
+    system : gaddlemaps.components.System
+        The system to copy.
+
+    Returns
+    -------
+    gaddlemaps.components.System
+        The copied system.
+    """
+    new_system = copy.copy(system)
+    new_system.system_gro = copy.copy(system.system_gro)
+    fopen = reopen_file(system.system_gro._open_fgro._file)
+    new_system.system_gro._open_fgro = open_coordinate_file(fopen)
+    new_system.different_molecules = [
+        mol.deep_copy() for mol in system.different_molecules
+    ]
+    new_system._molecules_ordered = [
+        list(info) for info in system._molecules_ordered
+    ]
+    new_system._available_mgro_ordered = system._available_mgro_ordered.copy()
+    return new_system
+
+
+class ParseCache:
+    """
+    Content-addressed LRU cache of the parsed gaddlemaps objects.
+
+    The objects are indexed with the hashes of the uploaded files that
+    generated them so the same upload is only parsed once no matter how many
+    reruns (or sessions) request it. The stored objects are never handed out,
+    each request receives its own copy that can be safely modified.
+
+    The memory used by each entry is estimated from its number of atoms (see
+    estimated_size). Once the sum exceeds max_bytes, the least recently used
+    entries are evicted. The temporary files with the uploads and the copies
+    handed out to the sessions are not counted.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The maximum estimated memory (in bytes) used by the cached objects.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """
+        int : The estimated memory (in bytes) used by the cached objects.
+        """
+        return self._size
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        dict of str: int : The hit/miss/eviction counters and the current
+            number of entries and size of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size": self.size,
+        }
+
+    def clear(self):
+        """
+        Removes all the entries of the cache (the counters are kept).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _lookup(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def _store(self, key: Hashable, value: Any, nbytes: int):
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self._size += nbytes
+            while self._size > self.max_bytes:
+                _, (_, old_nbytes) = self._entries.popitem(last=False)
+                self._size -= old_nbytes
+                self.evictions += 1
+
+    def _get_or_parse(self, key: Hashable, parse: Callable[[], Any]) -> Any:
+        value = self._lookup(key)
+        if value is None:
+            value = parse()
+            self._store(key, value, estimated_size(value))
+            _LOGGER.info("Parse cache miss for %s: %s", key[0], self.stats)
+        return value
+
+    def _get_system(self, key: tuple[str, ...], files: tuple[UploadedFile, ...]):
+        def parse() -> System:
+            if len(files) == 1:
+                system = System(write_and_get_file(files[0]))
+                # Built once here, it is shared by all the copies of the system
+                residue_index(system)
+                return system
+            # Reuse the system with the previous topologies already recognized
+            system = copy_system(self._get_system(key[:-1], files[:-1]))
+            add_ftop(system, write_and_get_file(files[-1]))
+            return system
+
+        return self._get_or_parse(key, parse)
+
+    def get_system(self, fgro: UploadedFile, *ftops: UploadedFile) -> System:
+        """
+        Returns the System corresponding to the uploaded files.
+
+        If the system was previously loaded with the same .gro and a subset of
+        the first topologies, the cached one is extended instead of parsing
+        the .gro file again.
+
+        Parameters
+        ----------
+        fgro : UploadedFile
+            The uploaded .gro file with the system.
+        *ftops : UploadedFile
+            The uploaded topologies of the molecules to recognize in the
+            system, in the order they were added.
+
+        Returns
+        -------
+        gaddlemaps.components.System
+            A copy of the cached system that can be freely modified.
+        """
+        files = (fgro,) + ftops
+        key = ("system",) + tuple(hash_uploaded_file(upl) for upl in files)
+        return copy_system(self._get_system(key, files))
+
+    def get_molecule(self, fgro: UploadedFile, ftop: UploadedFile) -> Molecule:
+        """
+        Returns the Molecule corresponding to the uploaded files.
+
+        Parameters
+        ----------
+        fgro : UploadedFile
+            The uploaded .gro file with the molecule.
+        ftop : UploadedFile
+            The uploaded topology of the molecule.
+
+        Returns
+        -------
+        gaddlemaps.components.Molecule
+            A copy of the cached molecule that can be freely modified.
+        """
+        key = ("molecule", hash_uploaded_file(fgro), hash_uploaded_file(ftop))
+        molecule = self._get_or_parse(
+            key,
+            lambda: Molecule.from_files(
+                write_and_get_file(fgro), write_and_get_file(ftop)
+            ),
+        )
+        return molecule.deep_copy()
+
+
+@st.experimental_singleton
+def get_parse_cache() -> ParseCache:
+    """
+    Returns the parse cache shared by all the sessions of the server.
+    """
+    max_mb = float(os.environ.get("GADDLEMAPS_PARSE_CACHE_MB", DEFAULT_PARSE_CACHE_MB))
+    return ParseCache(int(max_mb * 1024**2))
+
+
+class AlignmentCache:
+    """
+    On-disk cache of the results of the alignments.
+
+    The entries are indexed by a canonical hash of the molecule topology in
+    the initial resolution, the files of the molecule in the final resolution
+    and the restrictions, so the same pair of molecules is only aligned once
+    no matter the system (or session) it belongs to. Each entry is a .npz
+    file with the aligned positions of both molecules, the final chi2 and,
+    for the multi-start alignments, the chi2 of the starts.
+
+    The cache can be shared by several processes: the entries are written to
+    a temporary file and then atomically renamed, and every operation
+    tolerates the entries removed by other processes. Once the size of the
+    directory exceeds max_bytes, the least recently used entries (by
+    modification time, which is updated on every hit) are removed, as well
+    as the temporary files left by writers killed before renaming them.
+
+    Parameters
+    ----------
+    directory : str
+        The directory where the entries are stored. It is created if needed.
+    max_bytes : int
+        The maximum size (in bytes) of the stored entries.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def hash_key(key: Hashable) -> str:
+        """
+        Returns the canonical hash of a key (nested tuples of str and int).
+        """
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def _path(self, key: Hashable) -> str:
+        return os.path.join(self.directory, self.hash_key(key) + ".npz")
+
+    def get(
+        self, key: Hashable
+    ) -> Optional[
+        tuple[np.ndarray, np.ndarray, float, Optional[tuple[list[float], int]]]
+    ]:
+        """
+        Returns the stored result of an alignment or None if it is missing.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the alignment (see GlobalInformation).
+
+        Returns
+        -------
+        tuple or None
+            The aligned positions of the molecule in the initial and final
+            resolutions, the chi2 (nan if it is unknown) and the spread of the
+            starts (see GlobalInformation.alignment_spread) or None if it was
+            not stored.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                spread = None
+                if "spread" in data:
+                    spread = (data["spread"].tolist(), int(data["stopped"]))
+                result = (data["start"], data["end"], float(data["chi2"]), spread)
+            os.utime(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        return result
+
+    def store(
+        self,
+        key: Hashable,
+        start_positions: np.ndarray,
+        end_positions: np.ndarray,
+        chi2: Optional[float],
+        spread: Optional[tuple[list[float], int]] = None,
+    ):
+        """
+        Stores the result of an alignment.
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the alignment (see GlobalInformation).
+        start_positions : numpy.ndarray
+            The aligned positions of the molecule in the initial resolution.
+        end_positions : numpy.ndarray
+            The aligned positions of the molecule in the final resolution.
+        chi2 : float or None
+            The chi2 of the alignment.
+        spread : tuple of (list of float, int), optional
+            The chi2 of the starts of a multi-start alignment and the number
+            of them that were stopped.
+        """
+        extra = {}
+        if spread is not None:
+            extra = {"spread": np.array(spread[0], dtype=float), "stopped": spread[1]}
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as ftemp:
+                np.savez(
+                    ftemp,
+                    start=start_positions,
+                    end=end_positions,
+                    chi2=np.nan if chi2 is None else chi2,
+                    **extra,
+                )
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            _LOGGER.warning("The alignment could not be stored in the cache")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        stale_time = time.time() - STALE_TEMP_SECONDS
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith((".npz", ".tmp")):
+                continue
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(".tmp"):
+                    if stat.st_mtime < stale_time:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= nbytes
+
+
+@functools.lru_cache(maxsize=None)
+def get_alignment_cache() -> AlignmentCache:
+    """
+    Returns the alignment cache of the current process.
+
+    It is not a streamlit singleton because it is used by the worker
+    processes of the mapping jobs.
+    """
+    directory = os.environ.get(
+        "GADDLEMAPS_ALIGNMENT_CACHE_DIR", DEFAULT_ALIGNMENT_CACHE_DIR
+    )
+    max_mb = float(
+        os.environ.get("GADDLEMAPS_ALIGNMENT_CACHE_MB", DEFAULT_ALIGNMENT_CACHE_MB)
+    )
+    return AlignmentCache(directory, int(max_mb * 1024**2))
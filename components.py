@@ -1,16 +1,48 @@
-import tempfile
+import hashlib
+import time
+from typing import Optional
+
+import numpy as np
 import streamlit as st
-from gaddlemaps import Alignment
-from gaddlemaps.components import Molecule, System
+import streamlit.components.v1 as st_components
+from streamlit.uploaded_file_manager import UploadedFile
 
+from caching import get_parse_cache, hash_uploaded_file
+from exports import EXPORT_FORMATS
+from preview import AXES, DEFAULT_PREVIEW_ATOMS, PALETTE
+from jobs import (
+    CANCELLED,
+    DONE,
+    FAILED,
+    Job,
+    QueueFullError,
+    get_job_manager,
+    session_user,
+)
+from residues import residue_index
+from selection import SelectionError
 from utilities import (
+    CACHED_ALIGNMENT,
+    DEFAULT_ATOM_BUDGET,
     GlobalInformation,
+    available_engines,
     represent_molecule,
     represent_molecule_comparative,
-    st_stdout,
-    write_and_get_file,
 )
 
+# Seconds between two updates of the progress of a running job
+JOB_POLL_INTERVAL = 0.5
+
+# Maximum number of constraints of a molecule
+MAX_RESTRICTIONS = 1000
+# Number of selected atom indexes displayed under each selection
+MAX_SHOWN_INDEXES = 20
+
+# Scale factors that can be compared with the one selected in the slider
+COMPARED_SCALE_FACTORS = [round(0.05 * i, 2) for i in range(1, 21)]
+# Maximum number of alignments of each molecule from different orientations
+MAX_ALIGNMENT_STARTS = 16
+
 
 def upload_system_and_molecules(information: GlobalInformation):
     """
@@ -26,11 +58,9 @@ def upload_system_and_molecules(information: GlobalInformation):
         col_upl, _, col_info, _ = st.columns([5, 1, 3, 1])
 
         with col_upl:
-            cg_system_gro = write_and_get_file(
-                st.file_uploader(
-                    "Choose a .gro file with the system in the initial resolution",
-                    type=["gro"],
-                )
+            cg_system_gro = st.file_uploader(
+                "Choose a .gro file with the system in the initial resolution",
+                type=["gro"],
             )
 
         with col_info:
@@ -38,19 +68,25 @@ def upload_system_and_molecules(information: GlobalInformation):
                 information.cg_system_name = cg_system_gro.name.split("/")[-1].split(
                     "."
                 )[0]
-                information.system = System(cg_system_gro)
+                information.system_files = [cg_system_gro]
+                load_system(information, information.system_files, exact=False)
                 st.write("Detected residues:")
+                composition = residue_index(information.system).composition
                 text = """| Resname   | Number |
 | ----------- | ----------- |
 """
                 text += "\n".join(
-                    [
-                        "|" + "|".join([k, str(v)]) + "|"
-                        for k, v in information.system.system_gro.composition.items()
-                    ]
+                    ["|" + "|".join([k, str(v)]) + "|" for k, v in composition.items()]
                 )
                 st.markdown(text)
+                if "load" in information.peak_memory:
+                    st.caption(
+                        "Memory used by the server after loading the system: "
+                        f"{information.peak_memory['load']:.0f} MB"
+                    )
             else:
+                information.system_files = []
+                information.set_system(None, ())
                 # Some extra space for alignment
                 st.text("\n")
                 st.text("\n")
@@ -81,7 +117,35 @@ def upload_system_and_molecules(information: GlobalInformation):
             add_molecule_component(information)
 
 
-def add_molecule_component(information: GlobalInformation):
+def load_system(
+    information: GlobalInformation, files: list[UploadedFile], exact: bool = True
+):
+    """
+    Loads the system from the uploaded files if they changed
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        Object containing all the information about the current mapping
+    files : list of UploadedFile
+        The .gro file of the system followed by the topologies of the
+        molecules to find in it
+    exact : bool, optional
+        If False, the loaded system is kept when it was created from the given
+        files followed by more topologies. The default is True.
+    """
+    key = tuple(hash_uploaded_file(upl) for upl in files)
+    if information.system_key == key:
+        return
+    if not exact and information.system_key[: len(key)] == key:
+        return
+    with information.profiler.phase("parse:system"):
+        system = get_parse_cache().get_system(*files)
+    information.set_system(system, key)
+    information.record_memory("load")
+
+
+def add_molecule_component(information: GlobalInformation, index: int = 0):
     """
     Implements de logic and interface to add new molecules
 
@@ -89,62 +153,103 @@ def add_molecule_component(information: GlobalInformation):
     ----------
     information : GlobalInformation
         Object containing all the information about the current mapping
+    index : int, optional
+        The index of the molecule to add. The default is 0.
     """
     new_comp = False
     warning = False
     with st.container():
-        st.markdown(f"### Molecule {len(information.system.different_molecules) + 1}")
+        st.markdown(f"### Molecule {index + 1}")
         col_cg, col_aa = st.columns(2)
 
         mol_cg = None
         with col_cg:
-            itp_file = write_and_get_file(
-                st.file_uploader(
-                    "Upload topology to find molecules in the system (initial resolution):",
-                    type=["itp", "top"],
-                    accept_multiple_files=False,
-                    key=f"itp_cg_{len(information.system.different_molecules)}",
-                )
+            itp_file = st.file_uploader(
+                "Upload topology to find molecules in the system (initial resolution):",
+                type=["itp", "top"],
+                accept_multiple_files=False,
+                key=f"itp_cg_{index}",
             )
             if itp_file is not None:
-                information.system.add_ftop(itp_file)
-                mol_cg = information.system.different_molecules[-1]
-                information.molecule_correspondence[mol_cg.name] = Alignment(
-                    start=mol_cg
-                )
+                information.system_files.append(itp_file)
+                load_system(information, information.system_files, exact=False)
+                mol_cg = information.system.different_molecules[index]
                 # Empty space for alignment
                 st.markdown('<p style="height:163px"></p>', unsafe_allow_html=True)
-                represent_molecule(mol_cg)
+                atom_budget = atom_budget_selection(len(mol_cg), f"full_cg_{index}")
+                with information.profiler.phase(f"render:{mol_cg.name} (initial)"):
+                    represent_molecule(mol_cg, atom_budget=atom_budget)
                 warning = True
         with col_aa:
             if mol_cg is not None:
-                aa_gro = write_and_get_file(
-                    st.file_uploader(
-                        "Upload the corresponding GRO file with the molecule in the final resolution:",
-                        type=["gro"],
-                        key=f"gro_aa_{len(information.system.different_molecules)}",
-                    )
+                aa_gro = st.file_uploader(
+                    "Upload the corresponding GRO file with the molecule in the final resolution:",
+                    type=["gro"],
+                    key=f"gro_aa_{index + 1}",
                 )
-                aa_itp = write_and_get_file(
-                    st.file_uploader(
-                        "Upload the corresponding TOPOLOGY file the final resolution:",
-                        type=["top", "itp"],
-                        key=f"itp_aa_{len(information.system.different_molecules)}",
-                    )
+                aa_itp = st.file_uploader(
+                    "Upload the corresponding TOPOLOGY file the final resolution:",
+                    type=["top", "itp"],
+                    key=f"itp_aa_{index + 1}",
                 )
                 if aa_gro is not None and aa_itp is not None:
-                    mol_aa = Molecule.from_files(aa_gro, aa_itp)
-                    information.molecule_correspondence[mol_cg.name].end = mol_aa
-                    represent_molecule(mol_aa, style={"sphere": {"scale": 0.5}})
+                    key = (hash_uploaded_file(aa_gro), hash_uploaded_file(aa_itp))
+                    if information.end_molecules_keys.get(mol_cg.name) != key:
+                        with information.profiler.phase(f"parse:{mol_cg.name}"):
+                            molecule = get_parse_cache().get_molecule(aa_gro, aa_itp)
+                        information.set_end_molecule(
+                            mol_cg.name, molecule, key, files=(aa_gro, aa_itp)
+                        )
+                    mol_aa = information.end_molecules[mol_cg.name]
+                    atom_budget = atom_budget_selection(
+                        len(mol_aa), f"full_aa_{index + 1}"
+                    )
+                    with information.profiler.phase(f"render:{mol_cg.name} (final)"):
+                        represent_molecule(
+                            mol_aa,
+                            style={"sphere": {"scale": 0.5}},
+                            atom_budget=atom_budget,
+                        )
                     new_comp = True
                     warning = False
+                else:
+                    information.set_end_molecule(mol_cg.name, None, None)
         if new_comp:
             restriction_selection(information, mol_cg.name)
     st.markdown("----")
     if warning:
         st.warning("To upload more molecules, complete the previous one")
     if new_comp:
-        add_molecule_component(information)
+        add_molecule_component(information, index + 1)
+    else:
+        # Remove the molecules of the topologies that are not uploaded anymore
+        load_system(information, information.system_files)
+
+
+def atom_budget_selection(n_atoms: int, key: str) -> Optional[int]:
+    """
+    Returns the atom budget of a 3D view letting the user ask for all the atoms
+
+    Parameters
+    ----------
+    n_atoms : int
+        The number of atoms of the represented molecule.
+    key : str
+        The key of the checkbox to show all the atoms.
+
+    Returns
+    -------
+    int or None
+        The atom budget for represent_molecule (None to show all the atoms).
+    """
+    if n_atoms <= DEFAULT_ATOM_BUDGET:
+        return DEFAULT_ATOM_BUDGET
+    full_detail = st.checkbox(
+        f"Show all the {n_atoms} atoms",
+        key=key,
+        help="Large molecules are simplified to keep the page responsive. Show all the atoms to hover them and see their indexes (it may be slow).",
+    )
+    return None if full_detail else DEFAULT_ATOM_BUDGET
 
 
 def restriction_selection(information: GlobalInformation, mol_name: str):
@@ -175,18 +280,68 @@ def restriction_selection(information: GlobalInformation, mol_name: str):
         _, col, _ = st.columns([1, 2, 1])
         with col:
             st.info(
-                """__Info__: If you select multiple indexes in a single
-                selection box, all the possible pairs of constraints will be
-                added. For instance, if you select [1, 2] in the left box and
-                [3, 4] in the right one, the [(1, 3), (1, 4), (2, 3), (2, 4)]
-                constraints will be added."""
+                """__Info__: The atoms are selected with a list of items
+                separated by commas. Each item can be an atom index or a range
+                of indexes (e.g. `0-3, 7`), atom names (`name C1 N*`), residue
+                numbers (`resid 2-4`) or residue names (`resname EMI`). If you
+                select multiple atoms in a single selection box, all the
+                possible pairs of constraints will be added. For instance, if
+                you select `1, 2` in the left box and `3-4` in the right one,
+                the [(1, 3), (1, 4), (2, 3), (2, 4)] constraints will be
+                added."""
             )
     restrictions: set[tuple[int, int]] = set()
-    multiselect_restrictions(information, mol_name, restrictions, 0)
-    information.molecule_restrictions[mol_name] = list(restrictions)
+    selection_restrictions(information, mol_name, restrictions, 0)
+    information.molecule_restrictions[mol_name] = sorted(restrictions)
+
+
+def atom_selection(
+    information: GlobalInformation, mol_name: str, final: bool, key: str
+) -> list[int]:
+    """
+    Adds a text input to select atoms of a molecule with an expression
+
+    The expression is resolved in the server (see selection.AtomTable), so
+    the size of the widget does not depend on the number of atoms.
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        Object containing all the information about the current mapping
+    mol_name : str
+        Name of the molecule
+    final : bool
+        If True, the atoms are selected in the final resolution
+    key : str
+        The key of the widget
+
+    Returns
+    -------
+    list of int
+        The indexes of the selected atoms (empty if the expression is empty
+        or not valid)
+    """
+    resolution, side = ("final", "right") if final else ("initial", "left")
+    expression = st.text_input(
+        f"Select atoms in the {resolution} resolution:",
+        key=key,
+        help=f"Indexes or ranges (0-3, 7), atom names (name C1 N*), residue numbers (resid 2-4) or residue names (resname EMI) separated by commas. To find them hover the atoms in the {side} 3D view",
+    )
+    if not expression.strip():
+        return []
+    try:
+        indexes = information.atom_table(mol_name, final).select(expression)
+    except SelectionError as error:
+        st.error(str(error))
+        return []
+    shown = ", ".join(map(str, indexes[:MAX_SHOWN_INDEXES]))
+    if len(indexes) > MAX_SHOWN_INDEXES:
+        shown += ", ..."
+    st.caption(f"Selected atoms ({len(indexes)}): {shown}")
+    return indexes
 
 
-def multiselect_restrictions(
+def selection_restrictions(
     information: GlobalInformation,
     mol_name: str,
     restrictions: set[tuple[int, int]],
@@ -195,6 +350,8 @@ def multiselect_restrictions(
     """
     Adds the widgets to select the constraints to a molecule
 
+    A new pair of widgets is added each time the last one is filled.
+
     Parameters
     ----------
     information : GlobalInformation
@@ -209,24 +366,25 @@ def multiselect_restrictions(
     """
     _, col1, col2, _ = st.columns([1, 1, 1, 1])
     with col1:
-        cg_rest = st.multiselect(
-            "Select atoms indexes in the initial resolution:",
-            list(range(len(information.molecule_correspondence[mol_name].start))),
-            key=f"cg_rest_{mol_name}_{key_index}",
-            help="To find the indexes hover the atoms in the left 3D view",
+        cg_rest = atom_selection(
+            information, mol_name, False, f"cg_selection_{mol_name}_{key_index}"
         )
     with col2:
-        aa_rest = st.multiselect(
-            "Select atoms indexes in the final resolution:",
-            list(range(len(information.molecule_correspondence[mol_name].end))),
-            key=f"aa_rest_{mol_name}_{key_index}",
-            help="To find the indexes hover the atoms in the right 3D view",
+        aa_rest = atom_selection(
+            information, mol_name, True, f"aa_selection_{mol_name}_{key_index}"
         )
-    if cg_rest and aa_rest:
-        for cg_index in cg_rest:
-            for aa_index in aa_rest:
-                restrictions.add((cg_index, aa_index))
-        multiselect_restrictions(information, mol_name, restrictions, key_index + 1)
+    if not (cg_rest and aa_rest):
+        return
+    if len(restrictions) + len(cg_rest) * len(aa_rest) > MAX_RESTRICTIONS:
+        st.error(
+            f"Too many constraints, the maximum is {MAX_RESTRICTIONS}. Select "
+            "fewer atoms in the last pair of selections."
+        )
+        return
+    for cg_index in cg_rest:
+        for aa_index in aa_rest:
+            restrictions.add((cg_index, aa_index))
+    selection_restrictions(information, mol_name, restrictions, key_index + 1)
 
 
 def run_mapping_and_download(information: GlobalInformation):
@@ -242,10 +400,11 @@ def run_mapping_and_download(information: GlobalInformation):
     st.markdown(
         """Once you have uploaded the molecules to be mapped and their
         corresponding constraints you can proceed with their alignment in both
-        resolutions. Due to limitations related with the UI, the extrapolation
-        and generation of the final mapped system can not be decoupled from
-        this alignment step. That is why you need to specified the scale factor
-        at this point."""
+        resolutions. Once the molecules are aligned, the final mapped system is
+        generated (extrapolated) with the selected scale factor. The
+        extrapolation can be repeated with other scale factors without
+        aligning the molecules again and several scale factors can be
+        extrapolated at once to compare the results."""
     )
 
     with st.columns(3)[0]:
@@ -256,29 +415,86 @@ def run_mapping_and_download(information: GlobalInformation):
             value=0.5,
             help="The mapped molecules will be scaled by this factor respect to the closest original bead (recommended 0.5 to avoid molecular overlaps)",
         )
-        pressed_align = st.button("Align and extrapolate")
+        compared = st.multiselect(
+            "Other scale factors to compare",
+            COMPARED_SCALE_FACTORS,
+            help="The system is also extrapolated with these scale factors to compare the results with the selected one",
+        )
+        information.engine = st.selectbox(
+            "Alignment engine",
+            available_engines(),
+            help="The C++ engine is much faster but it is only available if the compiled backend of gaddlemaps is installed in the server. The batched Python engine is the Python one evaluating many trial moves at once",
+        )
+        information.alignment_starts = st.number_input(
+            "Alignments of each molecule",
+            min_value=1,
+            max_value=MAX_ALIGNMENT_STARTS,
+            value=1,
+            help="Each molecule is aligned several times starting from random orientations and the alignment with the lowest Chi2 is kept. It helps with molecules that get stuck in a wrong orientation",
+        )
+        target_chi2 = st.number_input(
+            "Target Chi2 (0 to run all the alignments)",
+            min_value=0.0,
+            value=0.0,
+            format="%.4g",
+            disabled=information.alignment_starts == 1,
+            help="The remaining alignments of a molecule are stopped as soon as one of them reaches this Chi2",
+        )
+        information.target_chi2 = target_chi2 or None
+    col_align, col_extrapolate, _ = st.columns([1, 1, 4])
+    with col_align:
+        pressed_align = st.button("Align")
+    with col_extrapolate:
+        pressed_extrapolate = st.button("Extrapolate")
+    information.scale_factor = round(scale_factor, 2)
+    scale_factors = [information.scale_factor] + [
+        factor for factor in compared if factor != information.scale_factor
+    ]
+    spec = None
     if pressed_align:
+        # Nothing changed since the last alignment, the user wants to try again
+        spec = information.job_spec(force=information.is_aligned)
+    elif pressed_extrapolate:
+        if information.is_aligned:
+            spec = information.job_spec(scale_factors=scale_factors)
+            if not spec["scale_factors"]:
+                spec = None
+                st.info("The system is already extrapolated with these scale factors.")
+        else:
+            st.warning("The molecules must be aligned before the extrapolation.")
+    if spec is not None:
+        manager = get_job_manager()
+        if information.job_id is not None:
+            manager.cancel(information.job_id)
+            information.job_id = None
+        try:
+            information.job_id = manager.submit(spec, user=session_user())
+        except QueueFullError as error:
+            st.error(str(error))
+        else:
+            # Allows to recover the result if the page is reloaded
+            st.experimental_set_query_params(job=information.job_id)
+    if information.job_id is not None:
         st.markdown("### Backend output")
         st.markdown(
-            """The text in the green box bellow is the output from the backend
-            process. For each molecule, the computed "distance" (Chi2) between
-            its representation in both resolution is displayed. After all the
-            molecules are aligned, the exchange maps are computed and the final
-            mapped system is generated."""
+            """The text in the green box bellow is the progress of the
+            mapping. For each molecule, the computed "distance" (Chi2) between
+            its representation in both resolution is displayed. In the
+            extrapolation, the exchange maps are computed and the final mapped
+            system is generated for each scale factor. Only the molecules whose
+            files or constraints changed since the last alignment are aligned
+            again. If nothing changed, all of them are aligned again. The molecules
+            already aligned in a previous mapping (even of another system)
+            with the same files and constraints are loaded from a cache,
+            unless all of them are aligned again. The mapping runs
+            in the background, so you can cancel it or reload the page and
+            come back for the result."""
         )
-    with st.columns(2)[0]:
-        if pressed_align:
-            temp_gro = tempfile.NamedTemporaryFile(suffix=".gro")
-            with st_stdout("success"):
-                information.align_molecules()
-                print("Calculating exchange maps...")
-                information.manager.calculate_exchange_maps(scale_factor)
-                print("Generating the mapped system...")
-                information.manager.extrapolate_system(temp_gro.name)
-                temp_gro.seek(0)
+        with st.columns(2)[0]:
+            follow_mapping_job(information)
 
     # If the alignments are done, show the comparative
-    if information.manager is not None:
+    if information.is_aligned:
         st.markdown("### Alignment visual check")
         st.markdown(
             """In the following representations the result of the alignment is
@@ -289,31 +505,396 @@ def run_mapping_and_download(information: GlobalInformation):
             mapped system in the next section."""
         )
         cols = st.columns(2)
-        for index, (mol_name, ali) in enumerate(
-            information.molecule_correspondence.items()
-        ):
+        aligned = [
+            (mol_name, ali)
+            for mol_name, ali in information.molecule_correspondence.items()
+            if mol_name in information.end_molecules
+        ]
+        for index, (mol_name, ali) in enumerate(aligned):
             with cols[index % 2]:
                 st.markdown(f"#### {index + 1}. {mol_name}")
-                represent_molecule_comparative(ali)
+                if mol_name in information.alignment_times:
+                    engine, wall_time = information.alignment_times[mol_name]
+                    if engine == CACHED_ALIGNMENT:
+                        text = "Alignment loaded from the cache of previous mappings"
+                    else:
+                        text = f"Aligned with the {engine} engine in {wall_time:.2f} s"
+                    chi2 = information.alignment_chi2.get(mol_name)
+                    if chi2 is not None:
+                        text += f" (Chi2 = {chi2:.4g})"
+                    if mol_name in information.alignment_spread:
+                        text += spread_caption(*information.alignment_spread[mol_name])
+                    st.caption(text)
+                atom_budget = atom_budget_selection(
+                    max(len(ali.start), len(ali.end)), f"full_comp_{mol_name}"
+                )
+                with information.profiler.phase(f"render:{mol_name} (aligned)"):
+                    represent_molecule_comparative(
+                        ali,
+                        atom_budget=atom_budget,
+                        cache=information.render_cache,
+                        slot=f"{mol_name}:aligned",
+                    )
+    if information.is_aligned and information.profiler.phases:
+        with st.expander("Performance of the mapping"):
+            st.markdown(
+                """Time and memory used by each phase of the mapping (only
+                the last run of each phase is shown). The alignment,
+                exchange maps and extrapolation run in a separate process,
+                the rest of the phases run in the server and their CPU time
+                and memory include the work of other users at the same
+                time. The table can be downloaded in JSON format with the
+                mapped system."""
+            )
+            st.markdown(information.profiler.markdown())
     st.markdown("----")
-    if pressed_align:
+    mapped = {}
+    if information.is_aligned:
+        mapped = {
+            factor: information.mapped_systems[factor]
+            for factor in scale_factors
+            if factor in information.mapped_systems
+        }
+    if mapped:
         st.markdown("## 4. Download the mapped system")
         st.markdown(
             """If the alignment is correct, you can download the .gro file with
-            the mapped system pressing the button below. Note that once you
-            press it, the alignment will be lost (due again to limitations of
-            the UI) so you will need to perform the alignment again if you
-            want to change the scale factor or visualize the molecule overlap
-            in the previous section. Do not be surprised by the result if you
+            the mapped system pressing the button below. The alignment is kept
+            while the uploaded files and constraints do not change. If you
+            change the scale factor, only the extrapolation is repeated and if
+            you change the constraints of a molecule, only that molecule is
+            aligned again. Do not be surprised by the result if you
             visualize the system and the molecules seem to be wrong. Remember
             that the scale factor is applied to avoid molecule overlaps. Normal
             molecular configurations are restored after a short energy
             minimization simulation (we recommend to use the steepest decent
             algorithm)."""
         )
+        missing = [factor for factor in scale_factors if factor not in mapped]
+        if missing:
+            st.info(
+                "Press the Extrapolate button to generate the system with the "
+                "scale factors: " + ", ".join(map(str, missing))
+            )
+        fmt = st.selectbox(
+            "File format",
+            list(EXPORT_FORMATS),
+            format_func=lambda fmt: EXPORT_FORMATS[fmt][0],
+            key="download_format",
+            help="""The compressed .gro (gzip) is the smallest and fastest
+            download. The .npz file has the positions,
+            velocities (if any), atom names, residues and box of the system as
+            NumPy arrays.""",
+        )
+        _, extension, mime, _ = EXPORT_FORMATS[fmt]
+        factors = list(mapped)
+        for row in range(0, len(factors), 4):
+            for col, factor in zip(st.columns(4), factors[row : row + 4]):
+                with col:
+                    suffix = "" if factor == information.scale_factor else f"_{factor}"
+                    name = f"{information.cg_system_name}_mapped{suffix}"
+                    st.markdown(f"**Scale factor {factor}**")
+                    st.download_button(
+                        "Download mapped system",
+                        information.export_mapped_system(factor, fmt, name + ".gro"),
+                        file_name=name + extension,
+                        mime=mime,
+                        key=f"download_mapped_{factor}",
+                    )
+        preview_mapped_system(information, factors)
+        if len(mapped) > 1:
+            compare_scale_factors(information, factors)
         st.download_button(
-            "Download mapped system",
-            temp_gro.read(),
-            file_name=information.cg_system_name + "_mapped.gro",
+            "Download performance report (JSON)",
+            information.profiler.to_json(),
+            file_name=information.cg_system_name + "_performance.json",
+            mime="application/json",
         )
+        if "mapping" in information.peak_memory:
+            st.caption(
+                "Peak memory of the mapping process: "
+                f"{information.peak_memory['mapping']:.0f} MB"
+            )
         st.markdown("----")
+
+
+def preview_mapped_system(information: GlobalInformation, scale_factors: list[float]):
+    """
+    Represents a simplified view of the whole mapped system
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        Object containing all the information about the current mapping
+    scale_factors : list of float
+        The scale factors of the mapped systems that can be previewed
+    """
+    show = st.checkbox(
+        "Preview the mapped system",
+        key="show_system_preview",
+        help="""Shows the whole mapped system to check the overlaps between the
+        molecules before downloading it. Large systems are simplified keeping
+        whole residues.""",
+    )
+    if not show:
+        return
+    cols = st.columns(4)
+    with cols[0]:
+        factor = st.selectbox("Scale factor", scale_factors, key="preview_factor")
+    with cols[1]:
+        max_atoms = st.number_input(
+            "Maximum number of atoms",
+            min_value=1000,
+            max_value=10 * DEFAULT_PREVIEW_ATOMS,
+            value=DEFAULT_PREVIEW_ATOMS,
+            step=10000,
+            key="preview_max_atoms",
+        )
+    with cols[2]:
+        per_type = st.number_input(
+            "Maximum residues of each type (0 for all)",
+            min_value=0,
+            value=0,
+            step=100,
+            key="preview_per_type",
+        )
+    with cols[3]:
+        region = st.selectbox(
+            "Region",
+            ["Whole system"] + [f"Slab along {axis}" for axis in AXES],
+            key="preview_region",
+        )
+    with information.profiler.phase("render:system preview"):
+        preview = information.system_preview(factor)
+        slab = None
+        if region != "Whole system":
+            axis = AXES.index(region[-1])
+            coordinates = preview.centers[:, axis]
+            low = float(np.floor(coordinates.min() * 10) / 10)
+            high = float(np.ceil(coordinates.max() * 10) / 10)
+            third = round((high - low) / 3, 1)
+            slab_range = st.slider(
+                f"Range of the slab along {AXES[axis]} (nm)",
+                min_value=low,
+                max_value=high,
+                value=(low + third, high - third),
+                step=0.1,
+                key=f"preview_slab_{axis}",
+            )
+            slab = (axis, *slab_range)
+        residues = preview.select(int(max_atoms), int(per_type) or None, slab)
+        n_atoms = len(preview.atoms(residues))
+        legend = ", ".join(
+            f'<span style="color:{PALETTE[kind % len(PALETTE)]}">{resname}</span>'
+            for kind, resname in enumerate(preview.resnames)
+        )
+        st.markdown(
+            f"{n_atoms} of {preview.n_atoms} atoms ({len(residues)} of "
+            f"{len(preview.residue_kinds)} residues) are shown. Residues: {legend}",
+            unsafe_allow_html=True,
+        )
+        key = hashlib.blake2b(information.mapped_systems[factor])
+        key.update(repr((int(max_atoms), int(per_type), slab)).encode())
+        html, _ = information.render_cache.get_or_render(
+            "system:preview", key.hexdigest(), lambda: (preview.html(residues), [])
+        )
+        st_components.html(html, height=600, width=800)
+
+
+def compare_scale_factors(information: GlobalInformation, scale_factors: list[float]):
+    """
+    Represents a molecule mapped with several scale factors side by side
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        Object containing all the information about the current mapping
+    scale_factors : list of float
+        The scale factors to compare
+    """
+    with st.expander("Compare the scale factors"):
+        st.markdown(
+            """The first molecule of the selected type in the system (big
+            transparent spheres) with the molecule in the final resolution
+            placed as in the mapped system with each scale factor."""
+        )
+        mol_name = st.selectbox(
+            "Molecule", list(information.end_molecules), key="compare_molecule"
+        )
+        alignment = information.molecule_correspondence[mol_name]
+        for row in range(0, len(scale_factors), 3):
+            for col, factor in zip(st.columns(3), scale_factors[row : row + 3]):
+                with col:
+                    st.markdown(f"**Scale factor {factor}**")
+                    represent_molecule_comparative(
+                        alignment,
+                        width=400,
+                        height=300,
+                        scale_factor=factor,
+                        cache=information.render_cache,
+                        slot=f"{mol_name}:scale_factor_{factor}",
+                    )
+
+
+def spread_caption(values: list[float], cancelled: int) -> str:
+    """
+    Returns the description of the Chi2 of the starts of an alignment
+
+    Parameters
+    ----------
+    values : list of float
+        The sorted Chi2 of the finished starts
+    cancelled : int
+        The number of starts stopped when the target Chi2 was reached
+
+    Returns
+    -------
+    str
+        The text to append to the caption of the alignment
+    """
+    text = ""
+    if len(values) > 1:
+        text += (
+            f". Best of {len(values)} alignments with Chi2 from {values[0]:.4g} "
+            f"to {values[-1]:.4g} (median {np.median(values):.4g}, std "
+            f"{np.std(values):.2g})"
+        )
+    if cancelled:
+        text += (
+            f". {cancelled} of {len(values) + cancelled} alignments stopped after "
+            "reaching the target Chi2"
+        )
+    return text
+
+
+def queue_message(job: Job) -> Optional[str]:
+    """
+    Returns the position in the queue of a job waiting to start
+
+    Parameters
+    ----------
+    job : Job
+        The mapping job
+
+    Returns
+    -------
+    str or None
+        The text to display or None if the job is not waiting
+    """
+    queue_status = get_job_manager().queue_status(job)
+    if queue_status is None:
+        return None
+    position, wait = queue_status
+    wait_text = (
+        "less than a minute" if wait < 60 else f"about {round(wait / 60)} minutes"
+    )
+    return (
+        f"Waiting for a free slot in the server: position {position} in the "
+        f"queue, expected to start in {wait_text}."
+    )
+
+
+def follow_mapping_job(information: GlobalInformation):
+    """
+    Displays the progress of the mapping job of the session until it finishes
+
+    Each run of the script shows the current state of the job and, while it
+    is not finished, reruns the script after JOB_POLL_INTERVAL. The script
+    thread is not held by the job, so the widgets (e.g. the cancel button)
+    respond while it runs. When the job is done, its result is stored in
+    information.
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        Object containing all the information about the current mapping
+    """
+    manager = get_job_manager()
+    manager.poll()
+    job = manager.get(information.job_id)
+    if job is None:
+        information.job_id = None
+        st.warning("The mapping was lost, please run it again.")
+        return
+    if not job.is_finished and st.button("Cancel mapping"):
+        manager.cancel(job.id)
+    if not job.is_finished:
+        waiting = queue_message(job)
+        if waiting is not None:
+            st.info(waiting)
+        else:
+            st.info(job.progress.status())
+            st.success(job.progress.markdown() or "Starting the mapping...")
+        time.sleep(JOB_POLL_INTERVAL)
+        st.experimental_rerun()
+    st.success(job.progress.markdown() or "No progress was reported.")
+    information.job_id = None
+    information.last_job_id = job.id
+    if job.status == DONE:
+        information.apply_job_result(job.spec, job.result)
+    elif job.status == FAILED:
+        st.error("The mapping failed with the following error:")
+        st.code(job.error)
+    elif job.status == CANCELLED:
+        st.warning("The mapping was cancelled.")
+
+
+def previous_mapping_job(information: GlobalInformation):
+    """
+    Shows the mapping job in the page address if it is not from this session
+
+    This allows to check the progress and download the result of a mapping
+    after reloading the page.
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        Object containing all the information about the current mapping
+    """
+    job_id = st.experimental_get_query_params().get("job", [None])[0]
+    if job_id is None or job_id in (information.job_id, information.last_job_id):
+        return
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    st.markdown("## Previous mapping")
+    if job is None:
+        st.info(
+            """The mapping in the page address is not available anymore. You
+            can upload the files and run it again."""
+        )
+    elif job.status == DONE:
+        st.success("The mapping you started before reloading the page is done.")
+        if not job.result["mapped_systems"]:
+            st.info(
+                """The molecules were aligned but the system was not
+                extrapolated. Upload the files again to load the alignment
+                from the cache and extrapolate the system."""
+            )
+        for factor, mapped_system in job.result["mapped_systems"].items():
+            suffix = "" if factor == job.spec["scale_factor"] else f"_{factor}"
+            st.download_button(
+                f"Download mapped system (scale factor {factor})",
+                mapped_system,
+                file_name=f"{job.spec['name']}_mapped{suffix}.gro.gz",
+                mime="application/gzip",
+                key=f"download_previous_job_{factor}",
+            )
+    elif job.status == FAILED:
+        st.error("The mapping you started before reloading the page failed:")
+        st.code(job.error)
+    elif job.status == CANCELLED:
+        st.warning("The mapping you started before reloading the page was cancelled.")
+    else:
+        st.info(
+            (queue_message(job) or job.progress.status())
+            + " (started before reloading the page, press the button below to"
+            " check again)"
+        )
+        st.success(job.progress.markdown() or "Starting the mapping...")
+        col_check, col_cancel, _ = st.columns([1, 1, 3])
+        with col_check:
+            st.button("Check again")
+        with col_cancel:
+            if st.button("Cancel", key="cancel_previous_job"):
+                manager.cancel(job_id)
+    st.markdown("----")
@@ -0,0 +1,279 @@
+import gzip
+import io
+import shutil
+import zipfile
+from typing import Any, BinaryIO, Callable, Iterator, Sequence
+
+import numpy as np
+from gaddlemaps.parsers import GroFile, extract_lattice_gro
+
+# Compression level of the mapped systems kept in memory. The .gro files
+# compress 3 times with the fastest level and the higher ones are much slower
+# for little gain.
+COMPRESS_LEVEL = 1
+# Size of the blocks read and written when copying files
+CHUNK_SIZE = 2**20
+
+
+def compress_file(fopen: BinaryIO) -> bytes:
+    """
+    Returns the gzip compressed content of a file read in blocks.
+
+    Only the compressed content is kept in memory.
+
+    Parameters
+    ----------
+    fopen : BinaryIO
+        The opened file (in binary mode).
+
+    Returns
+    -------
+    bytes
+        The compressed content.
+    """
+    output = io.BytesIO()
+    with gzip.GzipFile(
+        fileobj=output, mode="wb", compresslevel=COMPRESS_LEVEL
+    ) as fgz:
+        shutil.copyfileobj(fopen, fgz, CHUNK_SIZE)
+    return output.getvalue()
+
+
+def open_compressed(content: bytes) -> BinaryIO:
+    """
+    Returns a file that reads the decompressed content of gzip data.
+    """
+    return gzip.GzipFile(fileobj=io.BytesIO(content), mode="rb")
+
+
+def write_decompressed(content: bytes, fout: BinaryIO):
+    """
+    Writes the decompressed content of gzip data to a file in blocks.
+    """
+    with open_compressed(content) as fin:
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+
+
+def gro_from_compressed(content: bytes) -> bytes:
+    """
+    Returns the .gro file from its gzip compressed content.
+    """
+    return gzip.decompress(content)
+
+
+def zip_from_compressed(content: bytes, fname: str) -> bytes:
+    """
+    Returns a .zip file with the .gro file from its gzip compressed content.
+
+    Parameters
+    ----------
+    content : bytes
+        The gzip compressed .gro file.
+    fname : str
+        The name of the .gro file in the .zip file.
+
+    Returns
+    -------
+    bytes
+        The content of the .zip file.
+    """
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as fzip:
+        with fzip.open(fname, "w") as fout:
+            write_decompressed(content, fout)
+    return output.getvalue()
+
+
+# Fields of the atom lines that can be read with read_compressed_gro
+GRO_FIELDS = ("resids", "resnames", "names", "positions", "velocities")
+
+
+def _line_blocks(fin: BinaryIO) -> Iterator[bytes]:
+    # Blocks of about CHUNK_SIZE bytes with complete lines
+    rest = b""
+    while True:
+        data = fin.read(CHUNK_SIZE)
+        if not data:
+            if rest:
+                yield rest + b"\n"
+            return
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+
+
+def _field(chars: np.ndarray, start: int, end: int) -> np.ndarray:
+    return np.ascontiguousarray(chars[:, start:end]).view(f"S{end - start}")[:, 0]
+
+
+def _vectors(chars: np.ndarray, start: int, size: int) -> np.ndarray:
+    return np.stack(
+        [_field(chars, start + i * size, start + (i + 1) * size) for i in range(3)],
+        axis=1,
+    ).astype(np.float32)
+
+
+def read_compressed_gro(
+    content: bytes, fields: Sequence[str] = GRO_FIELDS
+) -> dict[str, Any]:
+    """
+    Reads the atoms of a .gro file from its gzip compressed content.
+
+    The file is decompressed in blocks and the columns of all the atom lines
+    of each block are parsed at once.
+
+    Parameters
+    ----------
+    content : bytes
+        The gzip compressed .gro file.
+    fields : sequence of str, optional
+        The fields of the atoms to read (see GRO_FIELDS). By default, all of
+        them.
+
+    Returns
+    -------
+    dict of str: Any
+        The arrays with the fields of the atoms and:
+
+        - box: (3, 3) array with the lattice vectors of the box in nm.
+        - comment: the comment line of the .gro file.
+
+        See npz_from_compressed for the description of the fields.
+        velocities is only included if the .gro file has velocities.
+
+    Raises
+    ------
+    IOError
+        If the .gro file is incomplete.
+    ValueError
+        If an atom line can not be parsed.
+    """
+    blocks: dict[str, list[np.ndarray]] = {field: [] for field in fields}
+    header: list[bytes] = []
+    n_atoms = -1
+    read = 0
+    box_line = b""
+    pos_width = vel_width = 0
+    with open_compressed(content) as fin:
+        for data in _line_blocks(fin):
+            buffer = np.frombuffer(data, dtype=np.uint8)
+            ends = np.flatnonzero(buffer == ord("\n"))
+            starts = np.concatenate(([0], ends[:-1] + 1))
+            first = 0
+            while len(header) < 2 and first < len(starts):
+                header.append(data[starts[first] : ends[first]])
+                first += 1
+                if len(header) == 2:
+                    n_atoms = int(header[1])
+            if n_atoms < 0:
+                continue
+            last = min(len(starts), first + n_atoms - read)
+            if last < len(starts) and not box_line:
+                box_line = data[starts[last] : ends[last]]
+            if last <= first:
+                continue
+            read += last - first
+            if not pos_width:
+                line = data[starts[first] : ends[first]].decode().rstrip("\r")
+                formats = GroFile.determine_format(line)
+                pos_width = formats["position"][0]
+                if formats["velocities"]:
+                    vel_width = pos_width
+            width = 20 + 3 * (pos_width + vel_width)
+            # Character matrix with a row for each atom line (shorter lines
+            # are padded with zeros)
+            columns = np.arange(width)
+            index = starts[first:last, None] + columns
+            chars = np.where(
+                columns < (ends[first:last] - starts[first:last])[:, None],
+                buffer[np.minimum(index, len(buffer) - 1)],
+                0,
+            ).astype(np.uint8)
+            if "resids" in blocks:
+                blocks["resids"].append(_field(chars, 0, 5).astype(np.int32))
+            if "resnames" in blocks:
+                blocks["resnames"].append(np.char.strip(_field(chars, 5, 10)))
+            if "names" in blocks:
+                blocks["names"].append(np.char.strip(_field(chars, 10, 15)))
+            if "positions" in blocks:
+                blocks["positions"].append(_vectors(chars, 20, pos_width))
+            if "velocities" in blocks and vel_width:
+                blocks["velocities"].append(
+                    _vectors(chars, 20 + 3 * pos_width, vel_width)
+                )
+    if n_atoms < 0 or read != n_atoms or not box_line:
+        raise IOError("The .gro file is incomplete")
+    arrays: dict[str, Any] = {
+        field: np.concatenate(values) for field, values in blocks.items() if values
+    }
+    for field in ("resnames", "names"):
+        if field in arrays:
+            arrays[field] = arrays[field].astype(str)
+    arrays["box"] = extract_lattice_gro(box_line.decode())
+    arrays["comment"] = header[0].decode().rstrip("\r")
+    return arrays
+
+
+def npz_from_compressed(content: bytes) -> bytes:
+    """
+    Returns the coordinates and atom information of a .gro file as a .npz.
+
+    The .gro file is read from its gzip compressed content (see
+    read_compressed_gro). The arrays in the .npz file are:
+
+    - positions: (N, 3) float32 array with the positions in nm.
+    - velocities: (N, 3) float32 array with the velocities in nm/ps (only if
+      the .gro file has velocities).
+    - resids: (N,) int32 array with the residue numbers.
+    - resnames, names: (N,) arrays with the residue and atom names.
+    - box: (3, 3) array with the lattice vectors of the box in nm.
+    - comment: the comment line of the .gro file.
+
+    Parameters
+    ----------
+    content : bytes
+        The gzip compressed .gro file.
+
+    Returns
+    -------
+    bytes
+        The content of the .npz file.
+    """
+    arrays = read_compressed_gro(content)
+    arrays["comment"] = np.array(arrays["comment"])
+    output = io.BytesIO()
+    np.savez_compressed(output, **arrays)
+    return output.getvalue()
+
+
+# The formats in which the mapped system can be downloaded: (label, file
+# extension, mime type, function that builds the file from the gzip
+# compressed .gro and its name)
+EXPORT_FORMATS: dict[str, tuple[str, str, str, Callable[[bytes, str], bytes]]] = {
+    "gro.gz": (
+        "Compressed .gro (.gro.gz)",
+        ".gro.gz",
+        "application/gzip",
+        lambda content, fname: content,
+    ),
+    "gro": (
+        "Uncompressed .gro",
+        ".gro",
+        "text/plain",
+        lambda content, fname: gro_from_compressed(content),
+    ),
+    "zip": (
+        ".gro in a .zip file",
+        ".zip",
+        "application/zip",
+        zip_from_compressed,
+    ),
+    "npz": (
+        "NumPy arrays (.npz)",
+        ".npz",
+        "application/octet-stream",
+        lambda content, fname: npz_from_compressed(content),
+    ),
+}
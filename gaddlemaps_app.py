@@ -1,7 +1,6 @@
 import streamlit as st
 
-from components import run_mapping_and_download, upload_system_and_molecules
-from utilities import GlobalInformation
+from assets import page_image
 
 
 # Page style
@@ -17,7 +16,7 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-st.image("./imgs/logo.png", use_column_width=True)
+st.image(page_image("./imgs/logo.png"), use_column_width=True)
 
 st.title("What is this?")
 col1, col2 = st.columns(2)
@@ -53,7 +52,7 @@ with col1:
     )
 
 with col2:
-    st.image("./imgs/bilayer.png", use_column_width=True)
+    st.image(page_image("./imgs/bilayer.png"), use_column_width=True)
 
 st.markdown("# Limitations")
 
@@ -64,10 +63,14 @@ process, the following limitations should be taken into account:
 - This interface does not offer the same freedom as the python [gaddlemaps
   module](https://github.com/txemaotero/gaddlemaps)
   does.
-- This web app uses the slow alignment engine (the one that is not implemented
-  in C++) so, if you are trying to map systems with large molecules (e.g.
-  proteins), you may want to consider using the gaddlemaps module with the fast
-  implementation instead. 
+- The fast alignment engine (the one implemented in C++) is only available if
+  the compiled backend of gaddlemaps is installed in the server running this
+  web app. Otherwise, a python engine is used (by default, the batched one,
+  which is a few times faster than the original one but still much slower
+  than C++), so if you are trying to map systems with large molecules (e.g.
+  proteins), you may want to consider running this app locally with the
+  compiled backend installed. The engine used and the time taken to align each
+  molecule are displayed after the alignment.
 - Here, you are limited to use .gro and .itp (or .top) file formats for the
   coordinates and topology, respectively, while with the python module you can
   implement you own parsers and use different formats. 
@@ -105,9 +108,20 @@ st.code(
 )
 st.markdown("----")
 
-# Global object to store the information
-information = GlobalInformation()
+# The modules of the mapping import gaddlemaps and the 3D views, which takes
+# about a second in a new server, so they are imported once the static part
+# of the page is sent
+from components import (  # noqa: E402
+    previous_mapping_job,
+    run_mapping_and_download,
+    upload_system_and_molecules,
+)
+from utilities import get_session_information  # noqa: E402
+
+# Object to store the information, kept between reruns of the session
+information = get_session_information()
 
+previous_mapping_job(information)
 upload_system_and_molecules(information)
 
 if information.errors:
@@ -0,0 +1,399 @@
+"""
+Maps several systems from the command line without the web interface.
+
+Usage: python gaddlemaps_batch.py manifest.json [-o OUTPUT_DIR] [-j JOBS]
+
+The manifest is a JSON file with the systems to map. The paths are relative
+to the manifest and the restrictions are pairs of atom indexes (starting in
+0) in the initial and final resolutions, as in the web interface:
+
+    {
+        "scale_factor": 0.5,
+        "systems": [
+            {
+                "name": "system",
+                "gro": "system_CG.gro",
+                "trajectory": "trajectory_CG.gro",
+                "scale_factor": 0.5,
+                "molecules": [
+                    {
+                        "topology": "CG/EMIM.itp",
+                        "end_gro": "AA/EMIM.gro",
+                        "end_topology": "AA/EMIM.itp",
+                        "restrictions": [[0, 1]]
+                    }
+                ]
+            }
+        ]
+    }
+
+"name" and "scale_factor" are optional in each system (the default scale
+factor is the global one, 0.5 if it is not given) and so are the
+restrictions of the molecules. The mapped systems are written to
+OUTPUT_DIR/{name}_mapped.gro together with a JSON report with the time
+taken by each step.
+
+If a system has a "trajectory" (a .gro file with several frames of the
+system), all its frames are mapped with the same exchange maps and written
+to OUTPUT_DIR/{name}_mapped_trajectory.gro.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Any, Optional
+
+from caching import get_alignment_cache
+from exports import write_decompressed
+from trajectory import MIN_FRAMES_PER_WORKER, map_trajectory
+from utilities import GlobalInformation, available_engines, file_from_content
+
+DEFAULT_SCALE_FACTOR = 0.5
+
+
+def _read_file(path: str):
+    with open(path, "rb") as fopen:
+        content = fopen.read()
+    upl = file_from_content(os.path.basename(path), content)
+    return upl, hashlib.sha256(content).hexdigest()
+
+
+def load_manifest(fname: str) -> list[dict[str, Any]]:
+    """
+    Reads the manifest and returns the systems to map.
+
+    The paths of the files are made absolute and the optional fields are
+    filled with their default values.
+
+    Parameters
+    ----------
+    fname : str
+        The path of the manifest.
+
+    Returns
+    -------
+    list of dict
+        The systems to map.
+
+    Raises
+    ------
+    ValueError
+        If the manifest is not valid.
+    """
+    with open(fname) as fopen:
+        manifest = json.load(fopen)
+    folder = os.path.dirname(os.path.abspath(fname))
+    scale_factor = manifest.get("scale_factor", DEFAULT_SCALE_FACTOR)
+    systems = []
+    for index, system in enumerate(manifest.get("systems", [])):
+        try:
+            molecules = [
+                {
+                    "topology": os.path.join(folder, molecule["topology"]),
+                    "end_gro": os.path.join(folder, molecule["end_gro"]),
+                    "end_topology": os.path.join(folder, molecule["end_topology"]),
+                    "restrictions": sorted(
+                        (int(start), int(end))
+                        for start, end in molecule.get("restrictions", [])
+                    ),
+                }
+                for molecule in system["molecules"]
+            ]
+            gro = os.path.join(folder, system["gro"])
+            trajectory = system.get("trajectory")
+            if trajectory is not None:
+                trajectory = os.path.join(folder, trajectory)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f"Wrong definition of the system {index}: {error}")
+        if not molecules:
+            raise ValueError(f"The system {index} has no molecules to map")
+        systems.append(
+            {
+                "name": system.get(
+                    "name", os.path.splitext(os.path.basename(gro))[0]
+                ),
+                "gro": gro,
+                "scale_factor": float(system.get("scale_factor", scale_factor)),
+                "molecules": molecules,
+                "trajectory": trajectory,
+            }
+        )
+    if not systems:
+        raise ValueError("The manifest does not contain any system")
+    names = [system["name"] for system in systems]
+    if len(set(names)) != len(names):
+        raise ValueError("The names of the systems must be unique")
+    return systems
+
+
+def map_system(
+    system: dict[str, Any],
+    output_dir: str,
+    engine: str,
+    align_workers: int = 1,
+    use_cache: bool = True,
+    seed: Optional[int] = None,
+    frame_workers: int = 1,
+    starts: int = 1,
+    target_chi2: Optional[float] = None,
+) -> dict[str, Any]:
+    """
+    Maps a system of the manifest and writes the result.
+
+    Parameters
+    ----------
+    system : dict
+        The system as returned by load_manifest.
+    output_dir : str
+        The directory where the mapped system is written.
+    engine : str
+        The alignment engine.
+    align_workers : int, optional
+        The number of processes used to align the molecules. The default is 1.
+    use_cache : bool, optional
+        If True (the default), the alignment cache is used.
+    seed : int, optional
+        The seed of the alignments. The default is None (random).
+    frame_workers : int, optional
+        The number of processes used to map the frames of the trajectory. The
+        default is 1. The trajectories with fewer than MIN_FRAMES_PER_WORKER
+        frames per process are mapped in the current process.
+    starts : int, optional
+        The number of alignments of each molecule (the best one is kept). The
+        default is 1.
+    target_chi2 : float, optional
+        The Chi2 that stops the remaining starts of a molecule when one of
+        them reaches it. The default is running all the starts.
+
+    Returns
+    -------
+    dict
+        The report of the mapping with the time taken by each step.
+    """
+    report: dict[str, Any] = {"name": system["name"], "gro": system["gro"]}
+    timings: dict[str, float] = {}
+    start_time = time.perf_counter()
+    output = StringIO()
+    try:
+        with redirect_stdout(output):
+            information = GlobalInformation()
+            information.engine = engine
+            information.alignment_starts = starts
+            information.target_chi2 = target_chi2
+            if use_cache:
+                information.alignment_cache = get_alignment_cache()
+            information.cg_system_name = system["name"]
+
+            step_time = time.perf_counter()
+            files = [_read_file(system["gro"])]
+            files += [_read_file(mol["topology"]) for mol in system["molecules"]]
+            information.load_system_files(
+                [upl for upl, _ in files], tuple(key for _, key in files)
+            )
+            molecules = information.system.different_molecules
+            if len(molecules) != len(system["molecules"]):
+                raise ValueError("Some molecules were not found in the system")
+            for mol, mol_files in zip(molecules, system["molecules"]):
+                (fgro, gro_key), (ftop, top_key) = (
+                    _read_file(mol_files["end_gro"]),
+                    _read_file(mol_files["end_topology"]),
+                )
+                information.load_end_molecule(mol.name, fgro, ftop, (gro_key, top_key))
+                information.molecule_restrictions[mol.name] = mol_files[
+                    "restrictions"
+                ]
+            timings["load"] = time.perf_counter() - step_time
+
+            step_time = time.perf_counter()
+            seeds = None
+            if seed is not None:
+                seeds = {mol.name: seed + index for index, mol in enumerate(molecules)}
+            information.align_molecules(workers=align_workers, seeds=seeds)
+            timings["align"] = time.perf_counter() - step_time
+
+            step_time = time.perf_counter()
+            information.calculate_exchange_maps(system["scale_factor"])
+            timings["exchange_maps"] = time.perf_counter() - step_time
+
+            step_time = time.perf_counter()
+            mapped_system = information.extrapolate_system()
+            timings["extrapolate"] = time.perf_counter() - step_time
+
+            fname = os.path.join(output_dir, system["name"] + "_mapped.gro")
+            with open(fname, "wb") as fout:
+                write_decompressed(mapped_system, fout)
+            report["output"] = fname
+
+            if system["trajectory"] is not None:
+                step_time = time.perf_counter()
+                fname = os.path.join(
+                    output_dir, system["name"] + "_mapped_trajectory.gro"
+                )
+                with open(system["trajectory"]) as ftraj, open(fname, "w") as fout:
+                    report["frames"] = map_trajectory(
+                        information, ftraj, fout, workers=frame_workers
+                    )
+                report["trajectory_output"] = fname
+                timings["trajectory"] = time.perf_counter() - step_time
+        report["status"] = "done"
+        report["molecules"] = [
+            {
+                "name": mol_name,
+                "engine": information.alignment_times[mol_name][0],
+                "align_time": information.alignment_times[mol_name][1],
+                "chi2": information.alignment_chi2.get(mol_name),
+                **_spread_report(information.alignment_spread.get(mol_name)),
+            }
+            for mol_name in information.end_molecules
+        ]
+        report["phases"] = information.profiler.phases
+    except Exception:
+        report["status"] = "failed"
+        report["error"] = traceback.format_exc()
+        report["backend_output"] = output.getvalue()
+    timings["total"] = time.perf_counter() - start_time
+    report["timings"] = timings
+    return report
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Maps the systems of a manifest with gaddlemaps.",
+        epilog="See the docstring of this script for the manifest format.",
+    )
+    parser.add_argument("manifest", help="JSON file with the systems to map")
+    parser.add_argument(
+        "-o", "--output-dir", default=".", help="where the mapped systems are written"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="systems mapped at the same time"
+    )
+    parser.add_argument(
+        "--align-workers",
+        type=int,
+        default=1,
+        help="processes used to align the molecules of each system",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=available_engines(),
+        default=available_engines()[0],
+        help="the alignment engine (default: the fastest available)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not use the alignment cache"
+    )
+    parser.add_argument("--seed", type=int, help="seed of the alignments")
+    parser.add_argument(
+        "--frame-workers",
+        type=int,
+        default=1,
+        help="processes used to map the frames of the trajectories (the ones "
+        f"with fewer than {MIN_FRAMES_PER_WORKER} frames per process are mapped "
+        "serially)",
+    )
+    parser.add_argument(
+        "--starts",
+        type=int,
+        default=1,
+        help="alignments of each molecule from random orientations (the best "
+        "one is kept)",
+    )
+    parser.add_argument(
+        "--target-chi2",
+        type=float,
+        help="stop the remaining starts of a molecule when one reaches this Chi2",
+    )
+    parser.add_argument(
+        "--report",
+        help="the JSON report file (default: OUTPUT_DIR/mapping_report.json)",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        systems = load_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = (
+        args.output_dir,
+        args.engine,
+        args.align_workers,
+        not args.no_cache,
+        args.seed,
+        args.frame_workers,
+        args.starts,
+        args.target_chi2,
+    )
+
+    start_time = time.perf_counter()
+    reports = []
+    if args.jobs > 1 and len(systems) > 1:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(min(args.jobs, len(systems)), context) as pool:
+            futures = [pool.submit(map_system, system, *options) for system in systems]
+            for future in futures:
+                reports.append(future.result())
+                _print_report(reports[-1])
+    else:
+        for system in systems:
+            reports.append(map_system(system, *options))
+            _print_report(reports[-1])
+
+    report_fname = args.report or os.path.join(args.output_dir, "mapping_report.json")
+    with open(report_fname, "w") as fout:
+        json.dump(
+            {
+                "manifest": os.path.abspath(args.manifest),
+                "engine": args.engine,
+                "jobs": args.jobs,
+                "align_workers": args.align_workers,
+                "starts": args.starts,
+                "target_chi2": args.target_chi2,
+                "wall_time": time.perf_counter() - start_time,
+                "systems": reports,
+            },
+            fout,
+            indent=2,
+        )
+    print(f"Report written to {report_fname}")
+    return int(any(report["status"] != "done" for report in reports))
+
+
+def _spread_report(spread: Optional[tuple[list[float], int]]) -> dict[str, Any]:
+    # The Chi2 of the starts of a multi-start alignment
+    if spread is None:
+        return {}
+    values, cancelled = spread
+    return {
+        "starts_chi2": values,
+        "starts_chi2_std": statistics.pstdev(values) if values else None,
+        "cancelled_starts": cancelled,
+    }
+
+
+def _print_report(report: dict[str, Any]):
+    if report["status"] == "done":
+        print(
+            f"{report['name']}: mapped in {report['timings']['total']:.2f} s "
+            f"-> {report['output']}"
+        )
+        if "trajectory_output" in report:
+            print(
+                f"{report['name']}: {report['frames']} frames mapped "
+                f"-> {report['trajectory_output']}"
+            )
+    else:
+        print(f"{report['name']}: failed\n{report['error']}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import sys
+from multiprocessing.connection import Connection
+
+
+def main():
+    """
+    Runs a mapping job started by jobs.JobManager.
+
+    The only argument is the file descriptor of the connection with the
+    server, which sends the spec of the job and receives its events.
+    """
+    connection = Connection(int(sys.argv[1]))
+    spec = connection.recv()
+    # Imported once the spec is received so the server does not wait for it
+    from jobs import run_mapping_job
+
+    run_mapping_job(spec, connection.send)
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+import atexit
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import suppress
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Optional
+
+import streamlit as st
+from streamlit.scriptrunner import get_script_run_ctx
+
+from caching import get_alignment_cache
+from progress import ProgressState, ThrottledCallback
+from profiling import memory_usage
+from utilities import GlobalInformation
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Number of finished jobs whose results are kept in memory
+MAX_FINISHED_JOBS = 32
+
+# Default number of jobs waiting to start (in the whole server and for each
+# user). They can be changed with the GADDLEMAPS_QUEUE_LENGTH and
+# GADDLEMAPS_JOBS_PER_USER environment variables.
+DEFAULT_QUEUE_LENGTH = 16
+DEFAULT_JOBS_PER_USER = 2
+
+# Estimated duration (in seconds) of a job before any job finished
+DEFAULT_JOB_TIME = 60.0
+# Number of finished jobs used to estimate the duration of the next ones
+RECENT_JOBS = 20
+
+
+class QueueFullError(RuntimeError):
+    """
+    Raised when a job can not be submitted because the queue is full.
+    """
+
+
+# Script run by the worker processes. They are not started with
+# multiprocessing because the spawned processes import the __main__ module,
+# which is the app while the server runs it.
+WORKER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "job_worker.py"
+)
+
+
+def run_mapping_job(spec: dict[str, Any], send: Callable[[tuple[str, Any]], None]):
+    """
+    Runs the alignment, exchange maps and extrapolation of a mapping.
+
+    This is the function executed by the worker processes. The mapping is
+    loaded again from the spec (see GlobalInformation.from_job_spec). The
+    molecules in spec["to_align"] are aligned and then the system is
+    extrapolated with each scale factor in spec["scale_factors"] (the
+    exchange maps are calculated again for each one but the molecules are
+    not aligned again). The progress events (throttled) and the result are
+    sent as (kind, value) tuples.
+
+    Parameters
+    ----------
+    spec : dict
+        The inputs of the mapping.
+    send : callable
+        Function that sends the events to the server.
+    """
+    progress = ThrottledCallback(lambda event: send(("progress", event)))
+    try:
+        information = GlobalInformation.from_job_spec(spec)
+        information.alignment_cache = get_alignment_cache()
+        information.progress = progress
+        if spec["to_align"]:
+            information.align_molecules(
+                force=spec["force"], workers=spec["workers"], seeds=spec["seeds"]
+            )
+        mapped_systems = {}
+        map_stage_keys = {}
+        for scale_factor in spec["scale_factors"]:
+            information.calculate_exchange_maps(scale_factor)
+            mapped_systems[scale_factor] = information.extrapolate_system()
+            if scale_factor == spec["scale_factor"]:
+                map_stage_keys = {
+                    stage: information.stages.key(stage)
+                    for stage in information.stages.stages("exchange_map:")
+                    + ["extrapolate"]
+                }
+        progress.flush()
+        positions = {
+            mol_name: (ali.start.atoms_positions, ali.end.atoms_positions)
+            for mol_name, ali in information.molecule_correspondence.items()
+            if mol_name in spec["to_align"]
+        }
+        send(
+            (
+                "result",
+                {
+                    "positions": positions,
+                    "alignment_times": information.alignment_times,
+                    "alignment_chi2": information.alignment_chi2,
+                    "alignment_spread": information.alignment_spread,
+                    "mapped_systems": mapped_systems,
+                    "map_stage_keys": map_stage_keys,
+                    "peak_memory": memory_usage()[1],
+                    "phases": information.profiler.phases,
+                },
+            )
+        )
+    except Exception:
+        progress.flush()
+        send(("error", traceback.format_exc()))
+
+
+class Job:
+    """
+    A mapping running in a worker process.
+
+    Attributes
+    ----------
+    id : str
+        The identifier of the job.
+    spec : dict
+        The inputs of the mapping.
+    user : str
+        The user that submitted the job.
+    status : str
+        One of PENDING (waiting in the queue), RUNNING, DONE, FAILED or
+        CANCELLED.
+    progress : progress.ProgressState
+        The progress of the mapping built from the events of the worker.
+    result : dict or None
+        The result of the mapping once the job is done.
+    error : str or None
+        The traceback of the error if the job failed.
+    """
+
+    def __init__(self, job_id: str, spec: dict[str, Any], user: str = ""):
+        self.id = job_id
+        self.spec = spec
+        self.user = user
+        self.status = PENDING
+        self.progress = ProgressState()
+        self.result: Optional[dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._connection: Optional[Connection] = None
+
+    @property
+    def is_finished(self) -> bool:
+        """
+        bool : True if the job is done, failed or was cancelled.
+        """
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def _finish(self, status: str):
+        self.status = status
+        self.finished = time.time()
+        if self._connection is not None:
+            self._connection.close()
+        self._process = None
+        self._connection = None
+
+
+class JobManager:
+    """
+    Runs the mappings in worker processes and keeps track of them.
+
+    The jobs wait in a queue until one of the max_running slots is free, so
+    the server is never running more mappings than the CPUs can take. When a
+    slot is free, the oldest job of the user with the fewest running jobs is
+    started, so a user submitting many jobs does not delay the rest. The jobs
+    that do not fit in the queue (max_queued in total or max_per_user of the
+    same user, running or waiting) are rejected.
+
+    There is no scheduler thread: the queue advances every time a session
+    polls any job. The jobs are stored by id so a session can follow (or
+    fetch the result of) a job submitted by a previous session, e.g. after a
+    page reload. Only the last max_finished finished jobs are kept.
+
+    Parameters
+    ----------
+    max_running : int, optional
+        The number of jobs running at the same time. The default is 1.
+    max_queued : int, optional
+        The number of jobs waiting to start. The default is
+        DEFAULT_QUEUE_LENGTH.
+    max_per_user : int, optional
+        The number of jobs of a user running or waiting to start. The default
+        is DEFAULT_JOBS_PER_USER.
+    max_finished : int, optional
+        The number of finished jobs to keep. The default is MAX_FINISHED_JOBS.
+    align_workers : int, optional
+        The number of processes used by each job to align the molecules in
+        parallel. The default is 1.
+    """
+
+    def __init__(
+        self,
+        max_running: int = 1,
+        max_queued: int = DEFAULT_QUEUE_LENGTH,
+        max_per_user: int = DEFAULT_JOBS_PER_USER,
+        max_finished: int = MAX_FINISHED_JOBS,
+        align_workers: int = 1,
+    ):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.max_finished = max_finished
+        self.align_workers = align_workers
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._durations: deque[float] = deque(maxlen=RECENT_JOBS)
+        self._lock = threading.Lock()
+        # The workers are not daemonic (they start their own processes to
+        # align the molecules) so they are stopped before the server exits
+        atexit.register(self.shutdown)
+
+    def _with_status(self, status: str) -> list[Job]:
+        return [job for job in self._jobs.values() if job.status == status]
+
+    def submit(self, spec: dict[str, Any], user: str = "") -> str:
+        """
+        Adds a new mapping job to the queue.
+
+        Parameters
+        ----------
+        spec : dict
+            The inputs of the mapping (see GlobalInformation.job_spec).
+        user : str, optional
+            The user that submits the job (see session_user).
+
+        Returns
+        -------
+        str
+            The id of the job.
+
+        Raises
+        ------
+        QueueFullError
+            If the queue is full or the user has too many jobs.
+        """
+        spec = dict(spec, workers=self.align_workers)
+        job = Job(uuid.uuid4().hex, spec, user)
+        with self._lock:
+            self._update()
+            pending = self._with_status(PENDING)
+            active = pending + self._with_status(RUNNING)
+            if sum(other.user == user for other in active) >= self.max_per_user:
+                raise QueueFullError(
+                    f"You already have {self.max_per_user} mappings running or "
+                    "waiting. Wait until one of them finishes or cancel it."
+                )
+            if len(pending) >= self.max_queued:
+                raise QueueFullError(
+                    "The server is busy and there is no room for more mappings "
+                    "in the queue. Please try again in a few minutes."
+                )
+            self._jobs[job.id] = job
+            self._start_pending()
+        return job.id
+
+    def _start(self, job: Job):
+        job._connection, worker_connection = multiprocessing.Pipe()
+        job._process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT, str(worker_connection.fileno())],
+            pass_fds=(worker_connection.fileno(),),
+            # The processes that align the molecules in parallel join the
+            # group of the job, so they are stopped with it (see cancel)
+            start_new_session=True,
+        )
+        worker_connection.close()
+        # If the worker already died, the job fails in the next poll
+        with suppress(OSError):
+            job._connection.send(job.spec)
+        job.status = RUNNING
+        job.started = time.time()
+
+    def _pending_order(self) -> list[Job]:
+        """
+        Returns the waiting jobs in the order they will be started.
+        """
+        running = Counter(job.user for job in self._with_status(RUNNING))
+        pending = self._with_status(PENDING)
+        order = []
+        while pending:
+            # Users with fewer running jobs first, the oldest job of each
+            # user first
+            job = min(pending, key=lambda job: (running[job.user], job.created))
+            pending.remove(job)
+            running[job.user] += 1
+            order.append(job)
+        return order
+
+    def _start_pending(self):
+        free = self.max_running - len(self._with_status(RUNNING))
+        for job in self._pending_order()[: max(0, free)]:
+            self._start(job)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Returns the job with the given id (updated) or None if it is unknown.
+        """
+        self.poll()
+        return self._jobs.get(job_id)
+
+    def poll(self):
+        """
+        Processes the events sent by the workers and starts the waiting jobs
+        if there are free slots.
+
+        All the running jobs are updated, not only the ones followed by a
+        session, so the slots of the abandoned jobs are also released.
+        """
+        with self._lock:
+            self._update()
+
+    def _update(self):
+        for job in self._with_status(RUNNING):
+            self._receive(job)
+        self._start_pending()
+        self._evict_finished()
+
+    def _receive(self, job: Job):
+        # Checked before reading the events so the ones sent just before the
+        # worker exits are not lost
+        alive = job._process.poll() is None
+        while job._connection.poll():
+            try:
+                kind, value = job._connection.recv()
+            except EOFError:
+                break
+            if kind == "progress":
+                job.progress.update(value)
+            elif kind == "result":
+                job.result = value
+                job._process.wait()
+                job._finish(DONE)
+                self._durations.append(job.finished - job.started)
+                return
+            elif kind == "error":
+                job.error = value
+                job._process.wait()
+                job._finish(FAILED)
+                return
+        if not alive:
+            job.error = "The worker process finished unexpectedly."
+            job._finish(FAILED)
+
+    def queue_status(self, job: Job) -> Optional[tuple[int, float]]:
+        """
+        Returns the position of a job in the queue and its estimated start.
+
+        The start is estimated with the mean duration of the last jobs that
+        finished (DEFAULT_JOB_TIME if none did).
+
+        Parameters
+        ----------
+        job : Job
+            The job.
+
+        Returns
+        -------
+        tuple of (int, float) or None
+            The position in the queue (1 is the next job to start) and the
+            estimated seconds until it starts, or None if the job is not
+            waiting.
+        """
+        with self._lock:
+            if job.status != PENDING:
+                return None
+            duration = (
+                sum(self._durations) / len(self._durations)
+                if self._durations
+                else DEFAULT_JOB_TIME
+            )
+            now = time.time()
+            # Seconds until each slot is free
+            slots = sorted(
+                max(0.0, duration - (now - other.started))
+                for other in self._with_status(RUNNING)
+            )
+            slots += [0.0] * max(0, self.max_running - len(slots))
+            for position, other in enumerate(self._pending_order(), 1):
+                start = slots.pop(0)
+                if other is job:
+                    return position, start
+                slots.append(start + duration)
+                slots.sort()
+        return None
+
+    def cancel(self, job_id: str):
+        """
+        Removes a job from the queue or stops its worker if it is running.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.is_finished:
+                return
+            stopped = job._process if job.status == RUNNING else None
+            if stopped is not None:
+                _stop_process(stopped)
+            job._finish(CANCELLED)
+            self._start_pending()
+            self._evict_finished()
+        # Waited without the lock so the other sessions are not blocked
+        if stopped is not None:
+            stopped.wait()
+
+    def shutdown(self):
+        """
+        Stops the running jobs and empties the queue.
+        """
+        with self._lock:
+            stopped = [job._process for job in self._with_status(RUNNING)]
+            for job in self._with_status(RUNNING):
+                _stop_process(job._process)
+                job._finish(CANCELLED)
+            for job in self._with_status(PENDING):
+                job._finish(CANCELLED)
+        for process in stopped:
+            process.wait()
+
+    def _evict_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+
+def _stop_process(process: subprocess.Popen):
+    """
+    Terminates a worker and the processes it started.
+
+    It does not wait for the worker to exit, the caller has to wait for it.
+    """
+    try:
+        # The worker leads its own process group
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        process.terminate()
+
+
+def session_user() -> str:
+    """
+    Returns the identifier of the user of the current session.
+
+    The sessions are anonymous, so each browser session is a user.
+    """
+    ctx = get_script_run_ctx()
+    return "" if ctx is None else ctx.session_id
+
+
+@st.experimental_singleton
+def get_job_manager() -> JobManager:
+    """
+    Returns the job manager shared by all the sessions of the server.
+
+    The number of jobs running at the same time can be set with the
+    GADDLEMAPS_MAX_JOBS environment variable (the default is the number of
+    CPUs, most of a job is serial) and the number of processes used to align
+    the molecules of each job with GADDLEMAPS_ALIGN_WORKERS (the default is
+    the number of CPUs divided by the running jobs, at least 1). The length
+    of the queue is set with GADDLEMAPS_QUEUE_LENGTH and
+    GADDLEMAPS_JOBS_PER_USER.
+    """
+    cpus = os.cpu_count() or 1
+    max_running = int(os.environ.get("GADDLEMAPS_MAX_JOBS") or cpus)
+    workers = os.environ.get("GADDLEMAPS_ALIGN_WORKERS")
+    return JobManager(
+        max_running=max_running,
+        max_queued=int(
+            os.environ.get("GADDLEMAPS_QUEUE_LENGTH") or DEFAULT_QUEUE_LENGTH
+        ),
+        max_per_user=int(
+            os.environ.get("GADDLEMAPS_JOBS_PER_USER") or DEFAULT_JOBS_PER_USER
+        ),
+        align_workers=int(workers) if workers else max(1, cpus // max_running),
+    )
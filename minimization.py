@@ -0,0 +1,399 @@
+import sys
+from collections import deque
+from typing import Callable, Optional
+
+import numpy as np
+
+# Probability factor of accepting a worse configuration (the default of
+# gaddlemaps._backend.accept_metropolis)
+ACCEPTANCE = 0.01
+# Maximum number of trial moves evaluated at once
+MAX_BATCH = 64
+# The batches are this many times the mean number of moves checked until one
+# is accepted. The moves after the accepted one are wasted but they are
+# cheaper than evaluating another batch.
+BATCH_FACTOR = 3.0
+# Weight of the last accepted move in the mean number of moves checked
+BATCH_SMOOTHING = 0.1
+# Maximum number of elements of the arrays with the distances of a batch. The
+# batches are smaller for large molecules so they take a few MB.
+BATCH_ELEMENTS = 2**20
+
+TRANSLATION = 0
+ROTATION = 1
+ATOM_MOVE = 2
+
+
+class BatchedChi2:
+    """
+    Computes the Chi2 of the python engine for a batch of configurations.
+
+    The Chi2 is the same as the one of gaddlemaps._backend.Chi2Calculator:
+    the sum of the squared distances between the restricted pairs of atoms
+    and from each free atom of the fixed molecule to the nearest atom of the
+    moving one, multiplied by 1.1 for each atom of the moving molecule that
+    is not the nearest to any atom (nor restricted). The parts that do not
+    depend on the moving molecule are computed once.
+
+    Parameters
+    ----------
+    mol1 : numpy.ndarray((N, 3))
+        The positions of the fixed molecule.
+    mol2 : numpy.ndarray((M, 3))
+        The positions of the moving molecule.
+    restrictions : list of tuple of int, optional
+        The pairs of indexes of the atoms of mol1 and mol2 that are kept
+        close.
+
+    Attributes
+    ----------
+    max_batch : int
+        The maximum number of configurations evaluated at once.
+    """
+
+    def __init__(
+        self,
+        mol1: np.ndarray,
+        mol2: np.ndarray,
+        restrictions: Optional[list[tuple[int, int]]] = None,
+    ):
+        pairs = np.array(restrictions or [], dtype=int).reshape(-1, 2)
+        free = np.ones(len(mol1), dtype=bool)
+        free[pairs[:, 0]] = False
+        # The coordinates of the free atoms in rows (x, y and z)
+        self._free = np.asarray(mol1[free], dtype=float).T.copy()
+        self._restricted = np.asarray(mol1[pairs[:, 0]], dtype=float)
+        self._restricted_index = pairs[:, 1]
+        self._covered = np.zeros(len(mol2), dtype=bool)
+        self._covered[pairs[:, 1]] = True
+        elements = max(1, self._free.shape[1]) * len(mol2) * 3
+        self.max_batch = max(1, min(MAX_BATCH, BATCH_ELEMENTS // elements))
+
+    def __call__(self, tests: np.ndarray) -> np.ndarray:
+        """
+        Returns the Chi2 of each configuration of the moving molecule.
+
+        Parameters
+        ----------
+        tests : numpy.ndarray((K, M, 3))
+            The positions of the moving molecule in each configuration.
+
+        Returns
+        -------
+        numpy.ndarray(K)
+            The Chi2 of the configurations.
+        """
+        differences = self._restricted - tests[:, self._restricted_index]
+        chi2 = np.sum(differences**2, axis=(1, 2))
+        covered = np.repeat(self._covered[None], len(tests), axis=0)
+        if self._free.shape[1]:
+            # (K, M, N) squared distances, computed by coordinates because
+            # the reductions over short last axes are slow in numpy
+            x, y, z = tests.transpose(2, 0, 1)[:, :, :, None]
+            distances = (x - self._free[0]) ** 2
+            distances += (y - self._free[1]) ** 2
+            distances += (z - self._free[2]) ** 2
+            chi2 += np.sum(distances.min(axis=1), axis=1)
+            nearest = distances.argmin(axis=1)
+            covered[np.arange(len(tests))[:, None], nearest] = True
+        return chi2 * 1.1 ** (len(self._covered) - covered.sum(axis=1))
+
+
+class AtomMoves:
+    """
+    Moves single atoms of a batch of configurations restoring the bonds.
+
+    It is the move of gaddlemaps.move_mol_atom: the atom is displaced in a
+    direction perpendicular to its bonds and then the bonded atoms are pulled
+    back to their bond lengths, going through the molecule from the moved
+    atom. The order of that walk and the atoms that define the direction
+    only depend on the bonds, so they are found once for each atom.
+
+    Parameters
+    ----------
+    bonds_info : dict of int: list of tuple of (int, float)
+        The bonded atoms of each atom and the bond lengths.
+    sigma_scale : float
+        The factor that scales the bond length to get the width of the
+        distribution of the displacements.
+
+    Raises
+    ------
+    ValueError
+        If the atoms are not connected.
+    """
+
+    def __init__(
+        self, bonds_info: dict[int, list[tuple[int, float]]], sigma_scale: float
+    ):
+        n_atoms = len(bonds_info)
+        walks = [_bond_walk(bonds_info, atom) for atom in range(n_atoms)]
+        if any(len(walk) != n_atoms - 1 for walk in walks):
+            raise ValueError("The atoms of the molecule must be connected.")
+        # (atom, step, 3) arrays with the bonds restored in each step
+        walks = np.array(walks, dtype=float).reshape(n_atoms, n_atoms - 1, 3)
+        self._pulling = walks[:, :, 0].astype(int)
+        self._pulled = walks[:, :, 1].astype(int)
+        self._lengths = walks[:, :, 2]
+        self._n_bonded = np.array([len(bonds_info[i]) for i in range(n_atoms)])
+        self._sigma = np.array(
+            [bonds_info[i][0][1] * sigma_scale for i in range(n_atoms)]
+        )
+        # The direction of the displacement is perpendicular to the vector
+        # from atom b to atom a and to a random vector, or to the vector from
+        # atom c to atom a if there are 3 or more bonds (the missing bonded
+        # atoms are the atom itself)
+        bonded = [
+            [index for index, _ in bonds_info[i]] + [i, i] for i in range(n_atoms)
+        ]
+        self._a, self._b, self._c = np.array([atoms[:3] for atoms in bonded]).T
+
+    def __call__(self, positions: np.ndarray, amount: int) -> np.ndarray:
+        """
+        Returns amount configurations with a random atom moved.
+
+        Parameters
+        ----------
+        positions : numpy.ndarray((M, 3))
+            The current positions of the molecule.
+        amount : int
+            The number of configurations.
+
+        Returns
+        -------
+        numpy.ndarray((amount, M, 3))
+            The new configurations.
+        """
+        atoms = np.random.randint(len(positions), size=amount)
+        reference = positions[self._a[atoms]] - positions[self._b[atoms]]
+        other = np.random.rand(amount, 3)
+        several = np.flatnonzero(self._n_bonded[atoms] >= 3)
+        if len(several):
+            other[several] = (
+                positions[self._a[atoms[several]]] - positions[self._c[atoms[several]]]
+            )
+        direction = _cross(other, reference)
+        if len(several):
+            # As np.random.choice([-1, 1]) for each atom
+            direction[several] *= 2 * np.random.randint(2, size=(len(several), 1)) - 1
+        direction /= _norm(direction)
+        tests = np.repeat(positions[None], amount, axis=0)
+        # The atoms are indexed in the flattened configurations
+        flat = tests.reshape(-1, 3)
+        offsets = np.arange(amount) * len(positions)
+        flat[offsets + atoms] += direction * np.random.normal(0, self._sigma[atoms])[
+            :, None
+        ]
+        pulling = self._pulling[atoms] + offsets[:, None]
+        pulled = self._pulled[atoms] + offsets[:, None]
+        lengths = self._lengths[atoms]
+        for step in range(pulled.shape[1]):
+            difference = flat[pulling[:, step]] - flat[pulled[:, step]]
+            modulo = _norm(difference)
+            flat[pulled[:, step]] += (modulo - lengths[:, step, None]) * (
+                difference / modulo
+            )
+        return tests
+
+
+def _cross(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # np.cross of (K, 3) arrays without its overhead for small arrays
+    return np.column_stack(
+        (
+            a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+            a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+            a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0],
+        )
+    )
+
+
+def _norm(vectors: np.ndarray) -> np.ndarray:
+    # The norms of (K, 3) vectors as a (K, 1) array
+    return np.sqrt(np.einsum("ij,ij->i", vectors, vectors))[:, None]
+
+
+def _bond_walk(
+    bonds_info: dict[int, list[tuple[int, float]]], atom: int
+) -> list[tuple[int, int, float]]:
+    # The (pulling atom, pulled atom, bond length) in the order followed by
+    # move_mol_atom when the atom is moved
+    waiting = set(bonds_info) - {atom}
+    queue = deque()
+    for bonded, length in bonds_info[atom]:
+        queue.append((atom, bonded, length))
+        waiting.discard(bonded)
+    walk = []
+    while queue:
+        pulling, pulled, length = queue.pop()
+        walk.append((pulling, pulled, length))
+        for bonded, bond_length in bonds_info[pulled]:
+            if bonded in waiting:
+                queue.append((pulled, bonded, bond_length))
+                waiting.remove(bonded)
+    return walk
+
+
+def rotation_matrices(axes: np.ndarray, angles: np.ndarray) -> np.ndarray:
+    """
+    Returns the rotation matrices of several axes and angles.
+
+    The matrices are the ones of gaddlemaps._auxilliary.rotation_matrix.
+
+    Parameters
+    ----------
+    axes : numpy.ndarray((K, 3))
+        The axes of rotation.
+    angles : numpy.ndarray(K)
+        The angles in radians.
+
+    Returns
+    -------
+    numpy.ndarray((K, 3, 3))
+        The rotation matrices.
+    """
+    axes = axes / _norm(axes)
+    outer = axes[:, :, None] * axes[:, None, :]
+    x, y, z = axes.T
+    skew = np.zeros((len(axes), 3, 3))
+    skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = z, -y, x
+    skew[:, 1, 0], skew[:, 2, 0], skew[:, 2, 1] = -z, y, -x
+    cos = np.cos(angles)[:, None, None]
+    sin = np.sin(angles)[:, None, None]
+    return outer + cos * (np.eye(3) - outer) + sin * skew
+
+
+def batched_minimize_molecules(
+    mol1_positions: np.ndarray,
+    mol2_positions: np.ndarray,
+    mol2_com: np.ndarray,
+    sigma_scale: float,
+    n_steps: int,
+    restriction: list[tuple[int, int]],
+    mol2_bonds_info: dict[int, list[tuple[int, float]]],
+    displacement_module: float,
+    sim_type: tuple[int, ...],
+    statistics: Optional[dict[str, int]] = None,
+    check_stop: Optional[Callable[[], None]] = None,
+) -> np.ndarray:
+    """
+    Minimizes the Chi2 between two molecules evaluating the moves in batches.
+
+    It is the Monte Carlo of the python engine of gaddlemaps
+    (gaddlemaps._backend._minimize_molecules) with the same moves, Chi2 and
+    acceptance criterion, and it takes the same arguments. Several trial
+    moves are drawn from the current configuration and their Chi2 are
+    computed at once (see BatchedChi2). They are checked in order and the
+    first accepted one is taken, so the moves after it, that were drawn from
+    an outdated configuration, are discarded. Each rejected move counts as a
+    step as in the serial engine, so the chain and the number of steps are
+    the same up to the random numbers drawn. The size of the batches follows
+    the acceptance rate: it is BATCH_FACTOR times the running mean of the
+    moves checked until one is accepted and it is doubled while no move is
+    accepted (up to BatchedChi2.max_batch).
+
+    Parameters
+    ----------
+    mol1_positions : numpy.ndarray((N, 3))
+        The positions of the molecule that does not move.
+    mol2_positions : numpy.ndarray((M, 3))
+        The initial positions of the molecule that moves.
+    mol2_com : numpy.ndarray(3)
+        The geometric center of the moving molecule (unused, it is computed
+        again for each rotation as in the serial engine).
+    sigma_scale : float
+        The factor that scales the width of the single atom displacements.
+    n_steps : int
+        The number of steps without improving the Chi2 that finish the
+        minimization.
+    restriction : list of tuple of int
+        The pairs of atoms of both molecules that are kept close.
+    mol2_bonds_info : dict of int: list of tuple of (int, float)
+        The bonds of the moving molecule.
+    displacement_module : float
+        The width of the translations.
+    sim_type : tuple of int
+        The types of moves: TRANSLATION, ROTATION or ATOM_MOVE.
+    statistics : dict of str: int, optional
+        If given, the number of trial moves ("trials"), the accepted ones
+        ("accepted") and the ones that improved the Chi2 ("improvements")
+        are added to it.
+    check_stop : callable, optional
+        Function called before each batch of moves. It can raise an exception
+        to stop the minimization.
+
+    Returns
+    -------
+    numpy.ndarray((M, 3))
+        The final positions of the moving molecule.
+    """
+    chi2_batch = BatchedChi2(mol1_positions, mol2_positions, restriction)
+    atom_moves = None
+    if ATOM_MOVE in sim_type:
+        atom_moves = AtomMoves(mol2_bonds_info, sigma_scale)
+    sim_type = np.asarray(sim_type)
+    chi2 = chi2_batch(mol2_positions[None])[0]
+    chi2_min = chi2
+    counter = trials = accepted = improvements = 0
+    # Mean number of moves checked until one is accepted
+    checked = 1.0
+    size = 1
+    while counter < n_steps:
+        if check_stop is not None:
+            check_stop()
+        size = min(size, chi2_batch.max_batch, n_steps - counter)
+        # As np.random.choice(sim_type, size) but faster
+        changes = sim_type[np.random.randint(len(sim_type), size=size)]
+        tests = np.empty((size,) + mol2_positions.shape)
+        translations = changes == TRANSLATION
+        if translations.any():
+            tests[translations] = mol2_positions + np.random.normal(
+                0, displacement_module, (translations.sum(), 1, 3)
+            )
+        rotations = changes == ROTATION
+        if rotations.any():
+            amount = rotations.sum()
+            center = np.mean(mol2_positions, axis=0)
+            matrices = rotation_matrices(
+                np.random.uniform(-1, 1, (amount, 3)),
+                np.random.normal(0, np.pi / 4.0, amount),
+            )
+            tests[rotations] = (mol2_positions - center) @ matrices + center
+        moves = changes == ATOM_MOVE
+        if moves.any():
+            tests[moves] = atom_moves(mol2_positions, moves.sum())
+        chi2_new = chi2_batch(tests)
+        # The Metropolis criterion of gaddlemaps._backend.accept_metropolis
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factor = chi2 / chi2_new
+        accept = (factor >= 1) | (np.random.rand(size) <= ACCEPTANCE * factor)
+        if not accept.any():
+            counter += size
+            trials += size
+            size *= 2
+            continue
+        first = int(np.argmax(accept))
+        trials += first + 1
+        accepted += 1
+        counter += first
+        checked += BATCH_SMOOTHING * (first + 1 - checked)
+        size = int(np.ceil(BATCH_FACTOR * checked))
+        mol2_positions = tests[first]
+        chi2 = chi2_new[first]
+        if chi2 < chi2_min:
+            chi2_min = chi2
+            improvements += 1
+            sys.stdout.write("\r")
+            sys.stdout.write("\tChi2 = %10.9f" % (chi2_min))
+            sys.stdout.flush()
+            counter = 0
+            continue
+        counter += 1
+    print("\n")
+    if statistics is not None:
+        for key, value in (
+            ("trials", trials),
+            ("accepted", accepted),
+            ("improvements", improvements),
+        ):
+            statistics[key] = statistics.get(key, 0) + value
+    return mol2_positions
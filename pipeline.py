@@ -0,0 +1,145 @@
+from typing import Any, Callable, Hashable, Iterable
+
+
+class StageGraph:
+    """
+    Keeps track of the stages of the mapping and their dependencies.
+
+    Each stage has a function that returns a hashable key with its own inputs
+    (e.g. the restrictions of a molecule or the scale factor) and a list of
+    stages it depends on. The full key of a stage combines its own key with
+    the keys of its dependencies, so a change in the inputs of one stage
+    invalidates all the stages that depend on it. When a stage is run, its
+    key is recorded and it is not run again until the key changes.
+
+    The stages can be registered again (e.g. when a molecule is added) without
+    losing the record of the ones that were already run.
+    """
+
+    def __init__(self):
+        self._stages: dict[
+            str, tuple[Callable[[], Hashable], Callable[[], Any], tuple[str, ...]]
+        ] = {}
+        self._done: dict[str, Hashable] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._stages
+
+    def add_stage(
+        self,
+        name: str,
+        key: Callable[[], Hashable],
+        run: Callable[[], Any],
+        depends_on: Iterable[str] = (),
+    ):
+        """
+        Registers a stage (or replaces the one with the same name).
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        key : callable
+            Function that returns a hashable object with the inputs of the
+            stage.
+        run : callable
+            Function that executes the stage.
+        depends_on : iterable of str, optional
+            The names of the stages that have to be run before this one.
+        """
+        self._stages[name] = (key, run, tuple(depends_on))
+
+    def remove_stage(self, name: str):
+        """
+        Removes a stage and the record of its last run.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        """
+        self._stages.pop(name, None)
+        self._done.pop(name, None)
+
+    def stages(self, prefix: str = "") -> list[str]:
+        """
+        Returns the names of the registered stages starting with prefix.
+        """
+        return [name for name in self._stages if name.startswith(prefix)]
+
+    def key(self, name: str) -> Hashable:
+        """
+        Returns the current key of a stage including its dependencies.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+
+        Returns
+        -------
+        Hashable
+            The key of the stage.
+        """
+        key, _, depends_on = self._stages[name]
+        return (key(), tuple(self.key(dep) for dep in depends_on))
+
+    def is_up_to_date(self, name: str) -> bool:
+        """
+        Returns True if the stage was run with the current inputs.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        """
+        return name in self._done and self._done[name] == self.key(name)
+
+    def mark_done(self, name: str, key: Hashable):
+        """
+        Records that a stage was run (somewhere else) with the given key.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        key : Hashable
+            The full key of the stage (see key method) when it was run.
+        """
+        self._done[name] = key
+
+    def invalidate(self, name: str = None):
+        """
+        Forgets the last run of a stage (or all of them if name is None).
+        """
+        if name is None:
+            self._done.clear()
+        else:
+            self._done.pop(name, None)
+
+    def run(self, name: str) -> list[str]:
+        """
+        Runs the stage and the dependencies that are not up to date.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+
+        Returns
+        -------
+        list of str
+            The names of the stages that were run, in execution order.
+        """
+        _, run, depends_on = self._stages[name]
+        executed = []
+        for dep in depends_on:
+            executed += self.run(dep)
+        if not self.is_up_to_date(name):
+            # The key is computed before running because some stages change
+            # their own inputs (e.g. aligned positions)
+            key = self.key(name)
+            run()
+            self._done[name] = key
+            executed.append(name)
+        return executed
@@ -0,0 +1,234 @@
+import base64
+import json
+from typing import Optional
+
+import numpy as np
+import py3Dmol
+
+from exports import read_compressed_gro
+
+# Maximum number of atoms drawn in the preview of the mapped system
+DEFAULT_PREVIEW_ATOMS = 100_000
+# Precision of the coordinates sent to the browser (in nm). It is the one of
+# the .gro files, so the preview does not lose information.
+COORDINATE_STEP = 0.001
+# Colors of the residue types in the preview
+PALETTE = (
+    "#1f77b4",
+    "#ff7f0e",
+    "#2ca02c",
+    "#d62728",
+    "#9467bd",
+    "#8c564b",
+    "#e377c2",
+    "#7f7f7f",
+    "#bcbd22",
+    "#17becf",
+)
+AXES = ("x", "y", "z")
+
+# Builds the atoms of the model from the buffers in the browser. The
+# coordinates are integers in COORDINATE_STEP units from the origin (or
+# float32 if they do not fit in 16 bits) and 3Dmol.js uses Angstroms.
+_ADD_ATOMS_JS = """
+(function(preview) {
+    function decode(text, type) {
+        var bytes = Uint8Array.from(atob(text), function(c) {
+            return c.charCodeAt(0);
+        });
+        return new type(bytes.buffer);
+    }
+    var type = preview.quantized ? Uint16Array : Float32Array;
+    var coords = decode(preview.coordinates, type);
+    var kinds = decode(preview.kinds, Uint16Array);
+    var origin = preview.origin;
+    var step = preview.step;
+    var atoms = new Array(kinds.length);
+    for (var i = 0; i < kinds.length; i++) {
+        atoms[i] = {
+            index: i,
+            serial: i,
+            x: 10 * (origin[0] + step * coords[3 * i]),
+            y: 10 * (origin[1] + step * coords[3 * i + 1]),
+            z: 10 * (origin[2] + step * coords[3 * i + 2]),
+            resn: preview.resnames[kinds[i]],
+            elem: "C",
+            bonds: [],
+        };
+    }
+    viewer_UNIQUEID.addModel().addAtoms(atoms);
+})(%(preview)s);
+"""
+
+
+class SystemPreview:
+    """
+    The positions and residues of a mapped system to preview it.
+
+    The .gro file is parsed once and the parts of the system to draw are
+    selected by whole residues, so the overlaps between the molecules can be
+    seen in the decimated system.
+
+    Parameters
+    ----------
+    content : bytes
+        The gzip compressed .gro file with the system.
+
+    Attributes
+    ----------
+    positions : numpy.ndarray((N, 3))
+        The positions of the atoms.
+    residue_starts : numpy.ndarray(M + 1)
+        The index of the first atom of each residue followed by the number of
+        atoms.
+    resnames : numpy.ndarray
+        The different residue names.
+    residue_kinds : numpy.ndarray(M)
+        The index in resnames of each residue.
+    centers : numpy.ndarray((M, 3))
+        The geometric center of each residue.
+    """
+
+    def __init__(self, content: bytes):
+        arrays = read_compressed_gro(content, ("resids", "resnames", "positions"))
+        self.positions = arrays["positions"]
+        resids = arrays["resids"]
+        resnames = arrays["resnames"]
+        # A new residue starts when the number or the name changes
+        changes = np.flatnonzero(
+            (resids[1:] != resids[:-1]) | (resnames[1:] != resnames[:-1])
+        )
+        self.residue_starts = np.concatenate(
+            ([0], changes + 1, [len(resids)])
+        ).astype(int)
+        self.resnames, self.residue_kinds = np.unique(
+            resnames[self.residue_starts[:-1]], return_inverse=True
+        )
+        sizes = np.diff(self.residue_starts)
+        self.centers = (
+            np.add.reduceat(self.positions, self.residue_starts[:-1], dtype=float)
+            / sizes[:, None]
+        )
+
+    @property
+    def n_atoms(self) -> int:
+        return len(self.positions)
+
+    def atoms(self, residues: np.ndarray) -> np.ndarray:
+        """
+        Returns the indexes of the atoms of some residues.
+        """
+        starts = self.residue_starts[residues]
+        sizes = self.residue_starts[residues + 1] - starts
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return np.repeat(starts, sizes) + offsets
+
+    def select(
+        self,
+        max_atoms: int = DEFAULT_PREVIEW_ATOMS,
+        per_type: Optional[int] = None,
+        slab: Optional[tuple[int, float, float]] = None,
+    ) -> np.ndarray:
+        """
+        Selects the residues drawn in the preview.
+
+        The residues are filtered by the slab first, then by the maximum of
+        residues of each type and, if there are still more than max_atoms,
+        they are evenly subsampled.
+
+        Parameters
+        ----------
+        max_atoms : int, optional
+            The maximum number of atoms of the selected residues. The default
+            is DEFAULT_PREVIEW_ATOMS.
+        per_type : int, optional
+            The maximum number of residues of each type. By default, there is
+            no limit.
+        slab : tuple of (int, float, float), optional
+            The axis (0, 1 or 2) and the minimum and maximum coordinates (in
+            nm) of the centers of the selected residues. By default, all the
+            system is selected.
+
+        Returns
+        -------
+        numpy.ndarray
+            The sorted indexes of the selected residues.
+        """
+        selected = np.arange(len(self.residue_kinds))
+        if slab is not None:
+            axis, low, high = slab
+            coordinates = self.centers[:, axis]
+            selected = selected[(coordinates >= low) & (coordinates <= high)]
+        if per_type is not None:
+            kinds = self.residue_kinds[selected]
+            kept = []
+            for kind in range(len(self.resnames)):
+                residues = selected[kinds == kind]
+                if len(residues) > per_type:
+                    residues = residues[_evenly_spaced(len(residues), per_type)]
+                kept.append(residues)
+            selected = np.sort(np.concatenate(kept))
+        sizes = self.residue_starts[selected + 1] - self.residue_starts[selected]
+        total = sizes.sum()
+        if total > max_atoms:
+            amount = int(len(selected) * max_atoms / total)
+            selected = selected[_evenly_spaced(len(selected), amount)]
+        return selected
+
+    def html(self, residues: np.ndarray, width: int = 800, height: int = 600) -> str:
+        """
+        Returns the HTML of a view with some residues of the system.
+
+        The coordinates and residue types of the atoms are embedded as binary
+        buffers (encoded in base64) instead of the text of a .gro file. Each
+        residue type is drawn with a color of PALETTE.
+
+        Parameters
+        ----------
+        residues : numpy.ndarray
+            The indexes of the residues to draw (see select).
+        width : int, optional
+            The width of the view. The default is 800.
+        height : int, optional
+            The height of the view. The default is 600.
+
+        Returns
+        -------
+        str
+            The HTML of the view.
+        """
+        atoms = self.atoms(residues)
+        positions = self.positions[atoms]
+        origin = positions.min(axis=0) if len(atoms) else np.zeros(3)
+        steps = np.rint((positions - origin) / COORDINATE_STEP)
+        quantized = not len(atoms) or bool(steps.max() < 2**16)
+        if quantized:
+            coordinates = steps.astype("<u2")
+        else:
+            coordinates = positions.astype("<f4") - origin.astype("<f4")
+        kinds = np.repeat(
+            self.residue_kinds[residues],
+            self.residue_starts[residues + 1] - self.residue_starts[residues],
+        )
+        preview = {
+            "coordinates": base64.b64encode(coordinates.tobytes()).decode(),
+            "kinds": base64.b64encode(kinds.astype("<u2").tobytes()).decode(),
+            "resnames": self.resnames.tolist(),
+            "origin": origin.tolist(),
+            "step": COORDINATE_STEP if quantized else 1,
+            "quantized": quantized,
+        }
+        view = py3Dmol.view(width=width, height=height)
+        view.startjs += _ADD_ATOMS_JS % {"preview": json.dumps(preview)}
+        for kind, resname in enumerate(self.resnames):
+            view.setStyle(
+                {"resn": resname},
+                {"sphere": {"radius": 1.2, "color": PALETTE[kind % len(PALETTE)]}},
+            )
+        view.zoomTo()
+        return view._make_html()
+
+
+def _evenly_spaced(length: int, amount: int) -> np.ndarray:
+    # Indexes of amount elements evenly spaced in a sequence
+    return np.linspace(0, length - 1, amount).astype(int)
@@ -0,0 +1,189 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, suppress
+from typing import Any, Optional
+
+try:
+    import resource
+except ImportError:  # Not available in Windows
+    resource = None  # type: ignore
+
+# Seconds between two measurements of the memory during a phase
+RSS_SAMPLING_INTERVAL = 0.05
+
+
+def memory_usage() -> tuple[Optional[float], Optional[float]]:
+    """
+    Returns the current and peak resident memory of the process in MB.
+
+    Each value is None if it can not be measured in the platform.
+    """
+    current = peak = None
+    with suppress(OSError, ValueError, IndexError):
+        with open("/proc/self/statm") as fstatm:
+            pages = int(fstatm.read().split()[1])
+        current = pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # In bytes in macOS and in kB in Linux
+        peak /= 2**20 if sys.platform == "darwin" else 2**10
+    return current, peak
+
+
+class _RssSampler(threading.Thread):
+    """
+    Thread that keeps the maximum resident memory of the process during each
+    open phase.
+
+    The memory is measured for the whole process, so a single sampler is
+    shared by all the profilers. It only samples while a phase is open.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self._peaks: dict[int, Optional[float]] = {}
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+
+    def open(self) -> int:
+        """
+        Starts following a phase and returns its identifier.
+        """
+        current = memory_usage()[0]
+        with self._lock:
+            self._opened += 1
+            self._peaks[self._opened] = current
+            self._active.set()
+            return self._opened
+
+    def close(self, phase_id: int) -> Optional[float]:
+        """
+        Stops following a phase and returns its peak memory.
+        """
+        self._sample()
+        with self._lock:
+            peak = self._peaks.pop(phase_id)
+            if not self._peaks:
+                self._active.clear()
+        return peak
+
+    def _sample(self):
+        current = memory_usage()[0]
+        if current is None:
+            return
+        with self._lock:
+            for phase_id, peak in self._peaks.items():
+                if peak is None or current > peak:
+                    self._peaks[phase_id] = current
+
+    def run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+            self._sample()
+
+
+_samplers: dict[float, _RssSampler] = {}
+_samplers_lock = threading.Lock()
+
+
+def _get_sampler(interval: float) -> _RssSampler:
+    with _samplers_lock:
+        if interval not in _samplers:
+            _samplers[interval] = _RssSampler(interval)
+            _samplers[interval].start()
+        return _samplers[interval]
+
+
+def _children_cpu_time() -> float:
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class PhaseProfiler:
+    """
+    Records the wall time, CPU time and peak memory of the phases of a mapping.
+
+    The CPU time includes the worker processes that finished during the phase
+    and, as the peak memory, it is measured for the whole process, so the
+    phases run in the server also include the work of other sessions running
+    at the same time. Only the last run of each phase is kept.
+
+    Attributes
+    ----------
+    phases : dict of str: dict
+        For each phase, its wall_time and cpu_time (in seconds) and
+        peak_rss (in MB, None if it can not be measured).
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.phases: dict[str, dict[str, Any]] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Measures the code run inside the context as the given phase.
+
+        Parameters
+        ----------
+        name : str
+            The name of the phase.
+        """
+        sampler = _get_sampler(self.interval)
+        phase_id = sampler.open()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time() + _children_cpu_time()
+        try:
+            yield
+        finally:
+            self.phases.pop(name, None)
+            self.phases[name] = {
+                "wall_time": time.perf_counter() - start_wall,
+                "cpu_time": time.process_time() + _children_cpu_time() - start_cpu,
+                "peak_rss": sampler.close(phase_id),
+            }
+
+    def update(self, phases: dict[str, dict[str, Any]]):
+        """
+        Adds the phases measured by another profiler (e.g. in a worker).
+        """
+        for name, values in phases.items():
+            self.phases.pop(name, None)
+            self.phases[name] = dict(values)
+
+    def clear(self, prefix: str = ""):
+        """
+        Forgets the phases whose name starts with prefix.
+        """
+        for name in [name for name in self.phases if name.startswith(prefix)]:
+            del self.phases[name]
+
+    def to_json(self) -> str:
+        """
+        Returns the phases as a JSON document.
+        """
+        return json.dumps({"phases": self.phases}, indent=2)
+
+    def markdown(self) -> str:
+        """
+        Returns a markdown table with the phases.
+        """
+        lines = [
+            "| Phase | Wall time (s) | CPU time (s) | Peak memory (MB) |",
+            "| ----------- | ----------- | ----------- | ----------- |",
+        ]
+        for name, values in self.phases.items():
+            peak = values["peak_rss"]
+            lines.append(
+                f"| {name} | {values['wall_time']:.3f} | {values['cpu_time']:.3f} "
+                f"| {'-' if peak is None else f'{peak:.0f}'} |"
+            )
+        return "\n".join(lines)
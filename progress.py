@@ -0,0 +1,215 @@
+import re
+import time
+from typing import Any, Callable, Optional
+
+# Stages of the mapping reported in the progress events
+ALIGN = "align"
+CACHED = "cached"
+EXCHANGE_MAPS = "exchange_maps"
+EXTRAPOLATE = "extrapolate"
+TRAJECTORY = "trajectory"
+
+# Minimum time in seconds between two events of the same stage and molecule
+PROGRESS_INTERVAL = 0.25
+
+ProgressEvent = dict[str, Any]
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+def progress_event(
+    stage: str,
+    molecule: Optional[str] = None,
+    step: Optional[int] = None,
+    chi2: Optional[float] = None,
+) -> ProgressEvent:
+    """
+    Returns a progress event of the mapping.
+
+    Parameters
+    ----------
+    stage : str
+        One of ALIGN, CACHED (alignment loaded from the cache), EXCHANGE_MAPS,
+        EXTRAPOLATE or TRAJECTORY.
+    molecule : str, optional
+        The name of the molecule the stage works on.
+    step : int, optional
+        The number of steps done in the stage (improvements of the Chi2 in
+        the alignment, mapped frames in the trajectory).
+    chi2 : float, optional
+        The best Chi2 of the alignment found so far.
+
+    Returns
+    -------
+    dict
+        The event.
+    """
+    return {"stage": stage, "molecule": molecule, "step": step, "chi2": chi2}
+
+
+class Chi2Stream:
+    """
+    File-like object that reads the Chi2 printed by the alignment engines.
+
+    Each time the engine prints a better Chi2, on_chi2 is called with the
+    number of improvements so far and the new value. Only the new text is
+    scanned in each write, so the cost does not grow with the output.
+
+    Parameters
+    ----------
+    on_chi2 : callable, optional
+        Function called with (step, chi2).
+
+    Attributes
+    ----------
+    step : int
+        The number of Chi2 values printed.
+    chi2 : float or None
+        The last Chi2 printed.
+    """
+
+    # The value is complete when it is followed by another character
+    _CHI2 = re.compile(r"Chi2 = *([-+.\w]+)(?=[^-+.\w])")
+    # Longer tails without a Chi2 in progress are not kept
+    _MAX_TAIL = 64
+
+    def __init__(self, on_chi2: Optional[Callable[[int, float], None]] = None):
+        self.on_chi2 = on_chi2
+        self.step = 0
+        self.chi2: Optional[float] = None
+        self._tail = ""
+
+    def write(self, text: str) -> int:
+        buffer = self._tail + text
+        end = 0
+        for match in self._CHI2.finditer(buffer):
+            end = match.end()
+            self.step += 1
+            self.chi2 = float(match.group(1))
+            if self.on_chi2 is not None:
+                self.on_chi2(self.step, self.chi2)
+        self._tail = buffer[end:][-self._MAX_TAIL :]
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class ThrottledCallback:
+    """
+    Forwards the progress events at a limited rate.
+
+    The events of a new stage or molecule are forwarded at once, the rest
+    only if interval seconds passed since the last one. The last event
+    skipped is forwarded before the next stage starts (or with flush), so
+    the final value of each stage is never lost.
+
+    Parameters
+    ----------
+    callback : callable
+        The function that receives the events.
+    interval : float, optional
+        The minimum time in seconds between two events of the same stage. The
+        default is PROGRESS_INTERVAL.
+    """
+
+    def __init__(
+        self, callback: ProgressCallback, interval: float = PROGRESS_INTERVAL
+    ):
+        self.callback = callback
+        self.interval = interval
+        self._last_key = None
+        self._last_time = 0.0
+        self._pending: Optional[ProgressEvent] = None
+
+    def __call__(self, event: ProgressEvent):
+        key = (event["stage"], event["molecule"])
+        now = time.monotonic()
+        if key == self._last_key and now - self._last_time < self.interval:
+            self._pending = event
+            return
+        if key != self._last_key:
+            self.flush()
+        self._pending = None
+        self._last_key = key
+        self._last_time = now
+        self.callback(event)
+
+    def flush(self):
+        """
+        Forwards the last skipped event, if any.
+        """
+        if self._pending is not None:
+            event, self._pending = self._pending, None
+            self._last_time = time.monotonic()
+            self.callback(event)
+
+
+class ProgressState:
+    """
+    The state of a mapping built from its progress events.
+
+    Only the last event of each stage and molecule is kept, so the state (and
+    the text displayed in the app) does not grow with the number of events.
+
+    Attributes
+    ----------
+    version : int
+        The number of events received. It can be used to know if the state
+        changed.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._events: dict[tuple[str, Optional[str]], ProgressEvent] = {}
+        self._last: Optional[ProgressEvent] = None
+
+    def update(self, event: ProgressEvent):
+        """
+        Updates the state with a new event.
+        """
+        self._events[(event["stage"], event["molecule"])] = event
+        self._last = event
+        self.version += 1
+
+    @property
+    def stage(self) -> Optional[str]:
+        """
+        str or None : The stage of the last event.
+        """
+        return None if self._last is None else self._last["stage"]
+
+    def status(self) -> str:
+        """
+        Returns a short description of the current stage.
+        """
+        if self._last is None:
+            return "Starting the mapping..."
+        return _event_text(self._last).split("\n")[0]
+
+    def markdown(self) -> str:
+        """
+        Returns the progress of all the stages to display in the app.
+        """
+        return "\n\n".join(_event_text(event) for event in self._events.values())
+
+
+def _event_text(event: ProgressEvent) -> str:
+    stage, molecule = event["stage"], event["molecule"]
+    if stage == ALIGN:
+        text = f"Aligning {molecule}:\n\n"
+        if event["chi2"] is None:
+            return text + "Chi2"
+        text += f"Chi2 = {event['chi2']:10.9f}"
+        if event["step"] is not None:
+            text += f" ({event['step']} improvements)"
+        return text
+    if stage == CACHED:
+        chi2 = "" if event["chi2"] is None else f" = {event['chi2']:10.9f}"
+        return f"Aligning {molecule}:\n\nChi2{chi2} (cached)"
+    if stage == EXCHANGE_MAPS:
+        return f"Calculating the exchange map of {molecule}..."
+    if stage == EXTRAPOLATE:
+        return "Generating the mapped system..."
+    if stage == TRAJECTORY:
+        return f"Mapping the trajectory... ({event['step'] or 0} frames)"
+    return stage
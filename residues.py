@@ -0,0 +1,208 @@
+from collections import Counter
+from io import TextIOWrapper
+from typing import Union
+
+import numpy as np
+from gaddlemaps.components import (
+    AtomGro,
+    Molecule,
+    MoleculeTop,
+    Residue,
+    System,
+    SystemGro,
+)
+
+
+class ResidueIndex:
+    """
+    Index of the residues of a system built once after parsing its .gro file.
+
+    For each type of residue, it keeps the positions where it appears in the
+    system and, for each residue, the index of its first atom. With them, the
+    molecules of a topology are found checking only the residues where they
+    can start instead of scanning the whole system, and the atoms of any
+    residue are read directly from the file.
+
+    Parameters
+    ----------
+    system_gro : gaddlemaps.components.SystemGro
+        The parsed .gro file.
+
+    Attributes
+    ----------
+    kinds : numpy.ndarray(N)
+        The index in system_gro.different_molecules of each residue.
+    atom_starts : numpy.ndarray(N + 1)
+        The index of the first atom of each residue followed by the number of
+        atoms in the system.
+    composition : Counter of str: int
+        For each residue name, how many residues there are in the system.
+    """
+
+    def __init__(self, system_gro: SystemGro):
+        runs = np.array(list(system_gro._pk_ammount_ordered_gen()), dtype=int)
+        runs = runs.reshape(-1, 2)
+        self.kinds = np.repeat(runs[:, 0], runs[:, 1])
+        lengths = np.array([len(res) for res in system_gro.different_molecules])
+        self.atom_starts = np.zeros(len(self.kinds) + 1, dtype=int)
+        np.cumsum(lengths[self.kinds], out=self.atom_starts[1:])
+        order = np.argsort(self.kinds, kind="stable")
+        bounds = np.searchsorted(
+            self.kinds[order], np.arange(len(system_gro.different_molecules) + 1)
+        )
+        self._occurrences = [
+            order[start:end] for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        self.composition: Counter[str] = Counter()
+        for kind, amount in runs:
+            self.composition[system_gro.different_molecules[kind].resname] += amount
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def occurrences(self, kind: int) -> np.ndarray:
+        """
+        Returns the positions of the residues of a type in the system.
+
+        Parameters
+        ----------
+        kind : int
+            The index of the residue type in system_gro.different_molecules.
+
+        Returns
+        -------
+        numpy.ndarray
+            The sorted positions of the residues.
+        """
+        return self._occurrences[kind]
+
+    def residues(self, system_gro: SystemGro, start: int, stop: int) -> list[Residue]:
+        """
+        Reads the residues from start to stop (not included) of the system.
+
+        Parameters
+        ----------
+        system_gro : gaddlemaps.components.SystemGro
+            The parsed .gro file the index was built from.
+        start, stop : int
+            The positions of the first and after the last residue.
+
+        Returns
+        -------
+        list of gaddlemaps.components.Residue
+            The residues.
+        """
+        fgro = system_gro._open_fgro
+        residues = []
+        for res_start, res_end in zip(
+            self.atom_starts[start:stop], self.atom_starts[start + 1 : stop + 1]
+        ):
+            fgro.seek_atom(int(res_start))
+            residues.append(
+                Residue([AtomGro(next(fgro)) for _ in range(res_end - res_start)])
+            )
+        return residues
+
+    def find_molecules(self, sequence: np.ndarray, available: np.ndarray) -> np.ndarray:
+        """
+        Finds the molecules formed by a sequence of residues.
+
+        As System.add_molecule_top does, the molecules are taken from the
+        first residue of the system on, without overlapping.
+
+        Parameters
+        ----------
+        sequence : numpy.ndarray
+            The types of the residues of the molecule.
+        available : numpy.ndarray(N)
+            The type of each residue of the system or -1 if it is already part
+            of another molecule.
+
+        Returns
+        -------
+        numpy.ndarray
+            The position of the first residue of each molecule found.
+        """
+        n_res = len(sequence)
+        candidates = self.occurrences(sequence[0])
+        candidates = candidates[candidates + n_res <= len(available)]
+        match = np.ones(len(candidates), dtype=bool)
+        for offset, kind in enumerate(sequence):
+            match &= available[candidates + offset] == kind
+        starts = candidates[match]
+        if n_res == 1 or not len(starts):
+            return starts
+        # Molecules that overlap with the previous one are discarded
+        selected = []
+        end = -1
+        for start in starts.tolist():
+            if start >= end:
+                selected.append(start)
+                end = start + n_res
+        return np.array(selected, dtype=int)
+
+
+def residue_index(system: System) -> ResidueIndex:
+    """
+    Returns the residue index of a system, building it the first time.
+
+    The index is stored in system.system_gro, so it is shared by the copies
+    of the system.
+    """
+    index = getattr(system.system_gro, "residue_index", None)
+    if index is None:
+        index = ResidueIndex(system.system_gro)
+        system.system_gro.residue_index = index
+    return index
+
+
+def add_ftop(system: System, ftop: Union[str, TextIOWrapper]):
+    """
+    Adds and identifies the molecule from the ftop to the system.
+
+    It gives the same result as System.add_ftop but the molecules are found
+    with the residue index of the system.
+
+    Parameters
+    ----------
+    system : gaddlemaps.components.System
+        The system where the molecule is added.
+    ftop : str or TextIOWrapper
+        Path to the file (or opened file) with the topology of the molecule.
+
+    Raises
+    ------
+    IOError
+        If the molecule is not found in the system.
+    """
+    mol_top = MoleculeTop(ftop)
+    index = residue_index(system)
+    gro_mols_resnames = system.system_gro.molecules_resname_len_index
+    sequence = []
+    for resname_len_top in mol_top.resname_len_list:
+        if resname_len_top not in gro_mols_resnames:
+            raise IOError(f"The molecule {mol_top.name} is not in the gro file")
+        sequence.append(gro_mols_resnames[resname_len_top])
+    available = system._available_mgro_ordered
+    starts = index.find_molecules(np.array(sequence), available)
+    if not len(starts):
+        raise IOError(
+            f"The sequence of residues found for {mol_top.name} is not found in "
+            "the gro file, so the molecule is not recognized in the system."
+        )
+    n_res = len(sequence)
+    first = int(starts[0])
+    molecule = Molecule(
+        mol_top, index.residues(system.system_gro, first, first + n_res)
+    )
+    mol_index = len(system.different_molecules)
+    system.different_molecules.append(molecule)
+    end = None
+    for start in starts.tolist():
+        if start == end:
+            system._molecules_ordered[-1][2] += 1
+        else:
+            system._molecules_ordered.append([mol_index, start, 1])
+        end = start + n_res
+    available[(starts[:, None] + np.arange(n_res)).ravel()] = -1
+    system._molecules_ordered.sort(key=lambda x: x[1])
@@ -0,0 +1,146 @@
+import re
+from fnmatch import fnmatchcase
+from typing import Sequence
+
+import numpy as np
+from gaddlemaps.components import Molecule
+
+# Keywords of the selection expressions and the attribute they match
+KEYWORDS = ("index", "name", "resid", "resname")
+
+_RANGE = re.compile(r"^(-?\d+)(?:-(-?\d+))?$")
+
+
+class SelectionError(ValueError):
+    """
+    Raised when a selection expression is not valid for a molecule.
+    """
+
+
+def _parse_range(text: str) -> tuple[int, int]:
+    match = _RANGE.match(text)
+    if match is None:
+        raise SelectionError(f"'{text}' is not a number or a range (e.g. 2-5)")
+    first = int(match.group(1))
+    last = first if match.group(2) is None else int(match.group(2))
+    if last < first:
+        raise SelectionError(f"The range '{text}' is empty")
+    return first, last
+
+
+class AtomTable:
+    """
+    The names and residues of the atoms of a molecule indexed by value.
+
+    It is used to resolve the selection expressions of the constraints. An
+    expression is a list of items separated by commas and the selection is
+    the union of the atoms of all of them. Each item is one of:
+
+    - An atom index or a range of indexes (both included): 3, 0-5.
+    - index followed by indexes or ranges: index 3 7-9.
+    - name followed by atom names, with * and ? wildcards: name C1 N*.
+    - resid followed by residue numbers or ranges: resid 2 4-6.
+    - resname followed by residue names: resname EMI.
+
+    Parameters
+    ----------
+    names, resids, resnames : sequence
+        The name, residue number and residue name of each atom.
+    """
+
+    def __init__(
+        self, names: Sequence[str], resids: Sequence[int], resnames: Sequence[str]
+    ):
+        self.n_atoms = len(names)
+        self._resids = np.array(resids, dtype=int)
+        self._by_value: dict[str, dict] = {
+            "name": self._group(names),
+            "resname": self._group(resnames),
+        }
+
+    @staticmethod
+    def _group(values: Sequence) -> dict:
+        groups: dict = {}
+        for index, value in enumerate(values):
+            groups.setdefault(value, []).append(index)
+        return {value: np.array(indexes) for value, indexes in groups.items()}
+
+    @classmethod
+    def from_molecule(cls, molecule: Molecule) -> "AtomTable":
+        """
+        Builds the table of the atoms of a molecule.
+        """
+        atoms = [atom for residue in molecule.residues for atom in residue]
+        return cls(
+            [atom.name for atom in atoms],
+            [atom.resid for atom in atoms],
+            [atom.resname for atom in atoms],
+        )
+
+    def _item(self, keyword: str, values: list[str]) -> list[np.ndarray]:
+        if not values:
+            raise SelectionError(f"'{keyword}' must be followed by some values")
+        selected = []
+        for value in values:
+            if keyword == "index":
+                first, last = _parse_range(value)
+                if first < 0 or last >= self.n_atoms:
+                    raise SelectionError(
+                        f"The index '{value}' is out of the range of the atoms "
+                        f"(0-{self.n_atoms - 1})"
+                    )
+                selected.append(np.arange(first, last + 1))
+            elif keyword == "resid":
+                first, last = _parse_range(value)
+                mask = (self._resids >= first) & (self._resids <= last)
+                matches = [np.flatnonzero(mask)]
+            else:
+                groups = self._by_value[keyword]
+                if value in groups:
+                    matches = [groups[value]]
+                else:
+                    matches = [
+                        indexes
+                        for group, indexes in groups.items()
+                        if fnmatchcase(group, value)
+                    ]
+            if keyword != "index":
+                if not matches or not any(len(match) for match in matches):
+                    raise SelectionError(f"No atom matches '{keyword} {value}'")
+                selected += matches
+        return selected
+
+    def select(self, expression: str) -> list[int]:
+        """
+        Returns the indexes of the atoms selected by an expression.
+
+        Parameters
+        ----------
+        expression : str
+            The selection expression (see the class documentation).
+
+        Returns
+        -------
+        list of int
+            The sorted indexes of the selected atoms (empty if the expression
+            is empty).
+
+        Raises
+        ------
+        SelectionError
+            If the expression is not valid or an item does not select any
+            atom.
+        """
+        selected: list[np.ndarray] = []
+        for item in expression.split(","):
+            words = item.split()
+            if not words:
+                continue
+            keyword = words[0].lower()
+            if keyword in KEYWORDS:
+                selected += self._item(keyword, words[1:])
+            else:
+                selected += self._item("index", words)
+        if not selected:
+            return []
+        return np.unique(np.concatenate(selected)).tolist()
@@ -0,0 +1,268 @@
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional, TextIO
+
+import numpy as np
+from gaddlemaps.parsers import GroFile, dump_lattice_gro, extract_lattice_gro
+
+from progress import TRAJECTORY
+from residues import residue_index
+from utilities import GlobalInformation, gro_atom_lines
+
+# Number of frames sent to a worker process at once
+FRAMES_PER_TASK = 4
+# Minimum number of frames per worker process to map a trajectory in
+# parallel. Each worker loads the mapping again, which takes longer than
+# mapping a few frames.
+MIN_FRAMES_PER_WORKER = 4
+
+# (comment, resids, positions, box_matrix) of a frame
+Frame = tuple[str, np.ndarray, np.ndarray, np.ndarray]
+
+
+def read_gro_frames(fopen: TextIO) -> Iterator[Frame]:
+    """
+    Reads the frames of a .gro file with one or more frames one at a time.
+
+    Only the residue numbers, the positions and the box of each frame are
+    read, the rest of the information is taken from the mapped system.
+
+    Parameters
+    ----------
+    fopen : TextIO
+        The opened .gro file.
+
+    Yields
+    ------
+    comment : str
+        The comment line of the frame.
+    resids : numpy.ndarray(N)
+        The residue number of each atom.
+    positions : numpy.ndarray((N, 3))
+        The positions of the atoms.
+    box_matrix : numpy.ndarray((3, 3))
+        The lattice vectors of the box.
+
+    Raises
+    ------
+    ValueError
+        If a frame is incomplete or its number of atoms is wrong.
+    """
+    for index in itertools.count():
+        comment = fopen.readline()
+        if not comment.strip():
+            return
+        try:
+            n_atoms = int(fopen.readline())
+        except ValueError:
+            raise ValueError(f"Wrong number of atoms in the frame {index}")
+        lines = list(itertools.islice(fopen, n_atoms))
+        box = fopen.readline()
+        if len(lines) != n_atoms or not box.strip():
+            raise ValueError(f"The frame {index} is incomplete")
+        width = GroFile.determine_format(lines[0])["position"][0]
+        columns = [(20 + i * width, 20 + (i + 1) * width) for i in range(3)]
+        resids = np.array([line[:5] for line in lines], dtype=int)
+        positions = np.array(
+            [[line[start:end] for start, end in columns] for line in lines],
+            dtype=float,
+        )
+        yield comment.rstrip("\n"), resids, positions, extract_lattice_gro(box)
+
+
+class FrameMapper:
+    """
+    Applies the exchange maps of a mapping to frames of the initial system.
+
+    The molecules of the system, the atoms they take in the frames and the
+    names of the mapped atoms are found once. Mapping a frame only moves a
+    molecule of each type to the positions of the frame and applies its
+    exchange map, as Manager.extrapolate_system does with the system.
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        The mapping with the exchange maps calculated.
+    """
+
+    def __init__(self, information: GlobalInformation):
+        system = information.system
+        self.n_atoms = system.system_gro.n_atoms
+        residue_starts = residue_index(system).atom_starts
+        self._maps = {}
+        atoms = {}
+        for mol_name in information.end_molecules:
+            alignment = information.molecule_correspondence[mol_name]
+            template = alignment.start.copy()
+            new_mol = alignment.exchange_map(template)
+            self._maps[mol_name] = (alignment.exchange_map, template)
+            atoms[mol_name] = (
+                [atom.resname for atom in new_mol],
+                [atom.name for atom in new_mol],
+                new_mol.atoms_velocities,
+            )
+        # (name, first atom, last atom, first atom of each residue)
+        self._molecules: list[tuple[str, int, int, np.ndarray]] = []
+        resnames: list[str] = []
+        names: list[str] = []
+        velocities = []
+        for index, res_start, res_end in system._molecules_ordered_all_gen():
+            mol_name = system.different_molecules[index].name
+            if mol_name not in self._maps:
+                continue
+            starts = residue_starts[res_start:res_end]
+            self._molecules.append(
+                (mol_name, starts[0], residue_starts[res_end], starts)
+            )
+            resnames += atoms[mol_name][0]
+            names += atoms[mol_name][1]
+            velocities.append(atoms[mol_name][2])
+        if not self._molecules:
+            raise ValueError("There are no molecules to map in the system")
+        self._resnames = resnames
+        self._names = names
+        self._atomids = range(1, len(names) + 1)
+        # The velocities of the mapped molecules do not change
+        self._velocities: Optional[np.ndarray] = None
+        if all(vel is not None for vel in velocities):
+            self._velocities = np.concatenate(velocities)
+
+    def map_frame(self, frame: Frame) -> str:
+        """
+        Maps a frame and returns it in the .gro format.
+
+        Parameters
+        ----------
+        frame : tuple
+            The frame as yielded by read_gro_frames.
+
+        Returns
+        -------
+        str
+            The mapped frame in the same format as the mapped system.
+
+        Raises
+        ------
+        ValueError
+            If the frame does not have the atoms of the system.
+        """
+        comment, resids, positions, box_matrix = frame
+        if len(positions) != self.n_atoms:
+            raise ValueError(
+                f"The frame has {len(positions)} atoms but the system has "
+                f"{self.n_atoms}"
+            )
+        new_resids: list[int] = []
+        new_positions = []
+        for mol_name, start, end, residue_starts in self._molecules:
+            exchange_map, template = self._maps[mol_name]
+            template.atoms_positions = positions[start:end]
+            template.resids = resids[residue_starts].tolist()
+            new_mol = exchange_map(template)
+            new_resids += [atom.gro_resid for atom in new_mol]
+            new_positions.append(new_mol.atoms_positions)
+        lines = gro_atom_lines(
+            new_resids,
+            self._resnames,
+            self._names,
+            self._atomids,
+            np.concatenate(new_positions),
+            self._velocities,
+        )
+        n_atoms = "{:{figures}d}".format(
+            len(self._names), figures=GroFile.NUMBER_FIGURES
+        )
+        return "\n".join([comment, n_atoms, lines, dump_lattice_gro(box_matrix), ""])
+
+
+_worker_mapper: Optional[FrameMapper] = None
+
+
+def _init_worker(spec: dict):
+    global _worker_mapper
+    information = GlobalInformation.from_job_spec(spec)
+    information.calculate_exchange_maps(spec["scale_factor"])
+    _worker_mapper = FrameMapper(information)
+
+
+def _map_frames(frames: list[Frame]) -> str:
+    return "".join(_worker_mapper.map_frame(frame) for frame in frames)
+
+
+def map_trajectory(
+    information: GlobalInformation,
+    ftraj: TextIO,
+    fout: TextIO,
+    workers: int = 1,
+    frames_per_task: int = FRAMES_PER_TASK,
+) -> int:
+    """
+    Maps all the frames of a trajectory of the system.
+
+    The frames are read, mapped and written one after another, so the memory
+    used does not depend on the length of the trajectory. The exchange maps
+    are calculated (if needed) with the current scale factor and reused for
+    all the frames. The number of frames written is sent to the progress
+    callback of information.
+
+    With several workers, the frames are mapped in a pool of processes that
+    load the mapping again from its job_spec. Only a few tasks per worker
+    are kept in flight and the mapped frames are written in order. If the
+    trajectory has fewer than MIN_FRAMES_PER_WORKER frames per worker, they
+    are mapped in the current process.
+
+    Parameters
+    ----------
+    information : GlobalInformation
+        The mapping with all the molecules aligned.
+    ftraj : TextIO
+        The opened .gro file with the frames of the system in the initial
+        resolution.
+    fout : TextIO
+        The file where the mapped frames are written.
+    workers : int, optional
+        The number of processes used to map the frames. If 1 (the default)
+        they are mapped in the current process.
+    frames_per_task : int, optional
+        The number of frames sent to a worker at once. The default is
+        FRAMES_PER_TASK.
+
+    Returns
+    -------
+    int
+        The number of mapped frames.
+    """
+    information.calculate_exchange_maps(information.scale_factor)
+    frames = read_gro_frames(ftraj)
+    first_frames = list(itertools.islice(frames, MIN_FRAMES_PER_WORKER * workers))
+    frames = itertools.chain(first_frames, frames)
+    n_frames = 0
+    if len(first_frames) < MIN_FRAMES_PER_WORKER * workers or workers <= 1:
+        mapper = FrameMapper(information)
+        for frame in frames:
+            fout.write(mapper.map_frame(frame))
+            n_frames += 1
+            information.report_progress(TRAJECTORY, step=n_frames)
+        return n_frames
+
+    context = multiprocessing.get_context("spawn")
+    spec = information.job_spec()
+    tasks = iter(lambda: list(itertools.islice(frames, frames_per_task)), [])
+    with ProcessPoolExecutor(
+        workers, context, initializer=_init_worker, initargs=(spec,)
+    ) as pool:
+        pending: deque = deque()
+        for task in tasks:
+            pending.append((len(task), pool.submit(_map_frames, task)))
+            while len(pending) >= 2 * workers or (pending and pending[0][1].done()):
+                size, future = pending.popleft()
+                fout.write(future.result())
+                n_frames += size
+                information.report_progress(TRAJECTORY, step=n_frames)
+        for size, future in pending:
+            fout.write(future.result())
+            n_frames += size
+            information.report_progress(TRAJECTORY, step=n_frames)
+    return n_frames
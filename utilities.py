@@ -1,18 +1,124 @@
-import sys
-from contextlib import contextmanager
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout, suppress
 from io import StringIO
-from typing import Optional
+from typing import Any, Callable, Hashable, Optional, Sequence, TextIO
 
+import numpy as np
 import py3Dmol
 import streamlit as st
-from gaddlemaps import Alignment, Manager
-from gaddlemaps.components import Molecule
-from stmol import showmol
-from streamlit.scriptrunner import get_script_run_ctx
-from streamlit.uploaded_file_manager import UploadedFile
+import streamlit.components.v1 as st_components
+import gaddlemaps._alignment
+import gaddlemaps._backend
+from gaddlemaps import Alignment, ExchangeMap, Manager
+from gaddlemaps._backend import (
+    _minimize_molecules,
+    check_backend_installed,
+    minimize_molecules,
+)
+from gaddlemaps.components import Molecule, System
+from scipy.spatial.transform import Rotation
+from streamlit.uploaded_file_manager import UploadedFile, UploadedFileRec
+
+from exports import EXPORT_FORMATS, compress_file
+from minimization import batched_minimize_molecules
+from pipeline import StageGraph
+from preview import SystemPreview
+from profiling import PhaseProfiler, memory_usage
+from progress import (
+    ALIGN,
+    CACHED,
+    EXCHANGE_MAPS,
+    EXTRAPOLATE,
+    Chi2Stream,
+    ProgressCallback,
+    progress_event,
+)
+from residues import add_ftop
+from selection import AtomTable
 
 Restrictions = dict[str, Optional[list[tuple[int, int]]]]
 
+CPP_ENGINE = "C++"
+# The python engine evaluating the trial moves in batches (see minimization)
+BATCHED_ENGINE = "Python (batched)"
+PYTHON_ENGINE = "Python"
+# Used instead of the engine for the alignments loaded from the cache
+CACHED_ALIGNMENT = "cache"
+
+# Molecules with more atoms are simplified in the 3D views by default
+DEFAULT_ATOM_BUDGET = 3000
+
+# Uploaded files larger than this (in bytes) are read from a temporary file
+# instead of being decoded in memory
+SPILL_THRESHOLD = int(float(os.environ.get("GADDLEMAPS_SPILL_MB", 16)) * 2**20)
+
+
+def available_engines() -> list[str]:
+    """
+    Returns the alignment engines that can be used, the fastest first.
+
+    The C++ engine is only available if the compiled backend of gaddlemaps
+    (cython_backend) is installed.
+    """
+    if check_backend_installed():
+        return [CPP_ENGINE, BATCHED_ENGINE, PYTHON_ENGINE]
+    return [BATCHED_ENGINE, PYTHON_ENGINE]
+
+
+@contextmanager
+def alignment_engine(engine: str, check_stop: Optional[Callable[[], None]] = None):
+    """
+    Makes the alignments use the given engine.
+
+    Parameters
+    ----------
+    engine : str
+        CPP_ENGINE, BATCHED_ENGINE or PYTHON_ENGINE.
+    check_stop : callable, optional
+        Function called by the python engines before each batch of moves
+        (BATCHED_ENGINE) or each move (PYTHON_ENGINE). It can raise an
+        exception to stop the alignment. The C++ engine can not call it.
+
+    Raises
+    ------
+    ValueError
+        If the engine is not available.
+    """
+    if engine not in available_engines():
+        raise ValueError(f"The {engine} alignment engine is not available.")
+    old_minimize = gaddlemaps._alignment.minimize_molecules
+    old_accept = gaddlemaps._backend.accept_metropolis
+    minimize = {
+        CPP_ENGINE: minimize_molecules,
+        BATCHED_ENGINE: batched_minimize_molecules,
+        PYTHON_ENGINE: _minimize_molecules,
+    }[engine]
+    if check_stop is not None and engine == BATCHED_ENGINE:
+        minimize = functools.partial(minimize, check_stop=check_stop)
+    elif check_stop is not None and engine == PYTHON_ENGINE:
+        # The engine of gaddlemaps has no hook, its acceptance test is called
+        # once per move
+
+        def accept_metropolis(*args) -> bool:
+            check_stop()
+            return old_accept(*args)
+
+        gaddlemaps._backend.accept_metropolis = accept_metropolis
+    gaddlemaps._alignment.minimize_molecules = minimize
+    try:
+        yield
+    finally:
+        gaddlemaps._alignment.minimize_molecules = old_minimize
+        gaddlemaps._backend.accept_metropolis = old_accept
+
 
 def get_mol_view(
     gro_content: str,
@@ -20,11 +126,13 @@ def get_mol_view(
     height: int = 400,
     style: dict = None,
     view: Optional[py3Dmol.view] = None,
+    hoverable: bool = True,
 ) -> py3Dmol.view:
     """
     Takes the content of a .gro file and returns a py3Dmol.view object
 
-    Adds the function to hover atoms and display their index.
+    Adds the function to hover atoms and display their index, name and
+    residue number.
 
     Parameters
     ----------
@@ -37,6 +145,12 @@ def get_mol_view(
     style : dict, optional
         The style of the view (input to the setStyle method). The default is
         {'sphere': {}}.
+    view : py3Dmol.view, optional
+        The view to add the model to. The default is None, which means that a
+        new view is created.
+    hoverable : bool, optional
+        If False, the hover labels with the atom indexes are not added. The
+        default is True.
 
     Returns
     -------
@@ -51,12 +165,14 @@ def get_mol_view(
     view.setStyle(style)
     view.center()
     view.zoomTo()
+    if not hoverable:
+        return view
     view.setHoverable(
         {},
         True,
         """function(atom,viewer,event,container) {
                    if(!atom.label) {
-                    atom.label = viewer.addLabel(atom.index,{position: atom, backgroundColor: 'mintcream', fontColor:'black'});
+                    atom.label = viewer.addLabel(atom.index + ' ' + atom.atom + ' (resid ' + atom.resi + ')',{position: atom, backgroundColor: 'mintcream', fontColor:'black'});
                    }}""",
         """function(atom,viewer) { 
                    if(atom.label) {
@@ -68,6 +184,166 @@ def get_mol_view(
     return view
 
 
+def gro_atom_lines(
+    resids: Sequence[int],
+    resnames: Sequence[str],
+    names: Sequence[str],
+    atomids: Sequence[int],
+    positions: np.ndarray,
+    velocities: Optional[np.ndarray] = None,
+) -> str:
+    """
+    Returns the lines of the given atoms in a .gro file
+
+    The lines are the same as the ones written by gaddlemaps (see
+    GroFile.parse_atomlist) but all the atoms are formatted at once.
+
+    Parameters
+    ----------
+    resids, resnames, names, atomids : sequence
+        The residue number, residue name, name and number of each atom.
+    positions : numpy.ndarray((N, 3))
+        The positions of the atoms.
+    velocities : numpy.ndarray((N, 3)), optional
+        The velocities of the atoms.
+
+    Returns
+    -------
+    str
+        The atom lines separated by new lines (without the last one).
+    """
+    # Numbers are wrapped as in GroFile.parse_atomlist
+    numbers = np.array([resids, atomids], dtype=int).reshape(2, -1)
+    numbers = numbers % 99999 + (numbers > 99999)
+    columns = [numbers[0].tolist(), resnames, names, numbers[1].tolist()]
+    columns += np.asarray(positions).T.tolist()
+    line_format = "%5d%-5.5s%5.5s%5d" + "%8.3f" * 3
+    if velocities is not None:
+        columns += np.asarray(velocities).T.tolist()
+        line_format += "%8.4f" * 3
+    values = tuple(value for row in zip(*columns) for value in row)
+    return "\n".join([line_format] * len(resnames)) % values
+
+
+def gro_content(
+    resids: Sequence[int],
+    resnames: Sequence[str],
+    names: Sequence[str],
+    atomids: Sequence[int],
+    positions: np.ndarray,
+    velocities: Optional[np.ndarray] = None,
+) -> str:
+    """
+    Returns the content of a .gro file with the given atoms
+
+    See gro_atom_lines for the description of the parameters.
+
+    Returns
+    -------
+    str
+        The content of the .gro file.
+    """
+    body = gro_atom_lines(resids, resnames, names, atomids, positions, velocities)
+    box = "    0.0000    0.0000    0.0000"
+    return "\n".join(["test", f"{len(resnames)}", body, box])
+
+
+def molecule_gro_content(molecule: Molecule, resname: Optional[str] = None) -> str:
+    """
+    Returns the content of a .gro file with the atoms of a molecule
+
+    Parameters
+    ----------
+    molecule : gaddlemaps.components.Molecule
+        The molecule to write.
+    resname : str, optional
+        If given, it is written as the residue name of all the atoms instead
+        of the ones of the molecule.
+
+    Returns
+    -------
+    str
+        The content of the .gro file.
+    """
+    atoms = [atom for residue in molecule.residues for atom in residue]
+    velocities = molecule.atoms_velocities
+    if velocities is None and any(atom.velocity is not None for atom in atoms):
+        # Only some atoms have velocities, they are formatted one by one
+        lines = ["test", f"{len(molecule)}"]
+        for atom in atoms:
+            line = atom.gro_line(parsed=False)
+            if resname is not None:
+                line = f"{line[:5]}{resname:<5.5}{line[10:]}"
+            lines.append(line)
+        lines += ["    0.0000    0.0000    0.0000"]
+        return "\n".join(lines)
+    resids, resnames, names, atomids = zip(
+        *[(atom.resid, atom.resname, atom.name, atom.atomid) for atom in atoms]
+    )
+    if resname is not None:
+        resnames = [resname] * len(atoms)
+    return gro_content(
+        resids, resnames, names, atomids, molecule.atoms_positions, velocities
+    )
+
+
+def reduced_gro_content(
+    molecule: Molecule, atom_budget: int, resname: Optional[str] = None
+) -> tuple[str, str]:
+    """
+    Returns the content of a .gro file with a simplified molecule
+
+    If the molecule has more atoms than atom_budget, each residue is
+    replaced by a bead in its geometric center. If there are still too many
+    beads, the atoms are evenly subsampled instead.
+
+    Parameters
+    ----------
+    molecule : gaddlemaps.components.Molecule
+        The molecule to write.
+    atom_budget : int
+        The maximum number of atoms to write.
+    resname : str, optional
+        If given, it is written as the residue name of all the atoms instead
+        of the ones of the molecule.
+
+    Returns
+    -------
+    content : str
+        The content of the .gro file.
+    description : str
+        What was represented (empty if the molecule was not simplified).
+    """
+    if len(molecule) <= atom_budget:
+        return molecule_gro_content(molecule, resname), ""
+    residues = molecule.residues
+    if len(residues) <= atom_budget:
+        sizes = [len(residue) for residue in residues]
+        residue_index = np.repeat(np.arange(len(residues)), sizes)
+        positions = np.zeros((len(residues), 3))
+        np.add.at(positions, residue_index, molecule.atoms_positions)
+        positions /= np.array(sizes)[:, None]
+        names = [residue.resname for residue in residues]
+        content = gro_content(
+            [residue.resid for residue in residues],
+            names if resname is None else [resname] * len(residues),
+            names,
+            range(1, len(residues) + 1),
+            positions,
+        )
+        return content, f"{len(residues)} residue centers"
+    step = -(-len(molecule) // atom_budget)
+    atoms = [atom for residue in residues for atom in residue][::step]
+    content = gro_content(
+        [atom.resid for atom in atoms],
+        [atom.resname if resname is None else resname for atom in atoms],
+        [atom.name for atom in atoms],
+        [atom.atomid for atom in atoms],
+        molecule.atoms_positions[::step],
+    )
+    return content, f"1 of every {step} atoms"
+
+
 def represent_molecule(
     molecule: Molecule,
     width: int = 616,
@@ -75,11 +351,14 @@ def represent_molecule(
     style: dict = None,
     return_showmol=True,
     view: Optional[py3Dmol.view] = None,
+    atom_budget: Optional[int] = DEFAULT_ATOM_BUDGET,
 ) -> Optional[py3Dmol.view]:
     """
     Takes a Molecule (gaddlemaps object) and returns a py3Dmol.view object
 
-    Adds the function to hover atoms and display their index.
+    Adds the function to hover atoms and display their index, name and
+    residue number. Molecules with more atoms than atom_budget are simplified
+    (see reduced_gro_content) and the hover labels are not added.
 
     Parameters
     ----------
@@ -99,28 +378,141 @@ def represent_molecule(
     view : py3Dmol.view, optional
         The view to be used to represent the molecule. The default is None,
         which means that a new view is created.
+    atom_budget : int or None, optional
+        The maximum number of atoms drawn. If None, all the atoms are drawn.
+        The default is DEFAULT_ATOM_BUDGET.
 
     Returns
     -------
     py3Dmol.view or None
         The py3Dmol.view object containing the molecules in the .gro file.
     """
-    lines = ["test", f"{len(molecule)}"]
-    for atom in molecule:
-        atom = atom.copy()
-        lines.append(atom.gro_line(parsed=False))
-    lines += ["    0.0000    0.0000    0.0000"]
-    gro_content = "\n".join(lines)
-    view = get_mol_view(gro_content, width=width, height=height, style=style, view=view)
+    if atom_budget is None:
+        gro_content, simplification = molecule_gro_content(molecule), ""
+    else:
+        gro_content, simplification = reduced_gro_content(molecule, atom_budget)
+    if simplification:
+        st.caption(
+            f"Simplified view of {molecule.name} ({len(molecule)} atoms): "
+            f"{simplification} are shown"
+        )
+    view = get_mol_view(
+        gro_content,
+        width=width,
+        height=height,
+        style=style,
+        view=view,
+        hoverable=not simplification,
+    )
     if return_showmol:
-        showmol(view, height=height, width=width)
+        st_components.html(view._make_html(), height=height, width=width)
         return None
     else:
         return view
 
 
+class RenderCache:
+    """
+    The HTML of the last 3D view shown in each place (slot) of the page.
+
+    A slot only keeps the view of its last key, so the views of the previous
+    alignments are replaced as soon as the new ones are shown. The views can
+    also be evicted explicitly when an alignment changes.
+    """
+
+    def __init__(self):
+        # slot: (key, html, captions)
+        self._views: dict[str, tuple[str, str, list[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._views)
+
+    def get_or_render(
+        self, slot: str, key: str, render: Callable[[], tuple[str, list[str]]]
+    ) -> tuple[str, list[str]]:
+        """
+        Returns the view of a slot, rendering it if the key changed.
+
+        Parameters
+        ----------
+        slot : str
+            The place of the page where the view is shown.
+        key : str
+            The hash of everything the view depends on.
+        render : callable
+            Function that returns the HTML of the view and the captions
+            shown with it.
+
+        Returns
+        -------
+        html : str
+            The HTML of the view.
+        captions : list of str
+            The captions shown with the view.
+        """
+        cached = self._views.get(slot)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+        html, captions = render()
+        self._views[slot] = (key, html, captions)
+        return html, captions
+
+    def evict(self, prefix: str = ""):
+        """
+        Forgets the views of the slots whose name starts with prefix.
+        """
+        for slot in [slot for slot in self._views if slot.startswith(prefix)]:
+            del self._views[slot]
+
+
+def comparative_view_html(
+    align: Alignment,
+    width: int = 616,
+    height: int = 400,
+    atom_budget: Optional[int] = DEFAULT_ATOM_BUDGET,
+) -> tuple[str, list[str]]:
+    """
+    Returns the HTML of the view with the overlap of the molecules of align
+
+    See represent_molecule_comparative for the description of the
+    parameters. The molecules are not modified.
+
+    Returns
+    -------
+    html : str
+        The HTML of the view.
+    captions : list of str
+        The descriptions of the simplified molecules.
+    """
+    view = py3Dmol.view(width=width, height=height)
+    captions = []
+    for molecule, resname in ((align.end, "END"), (align.start, "START")):
+        if atom_budget is None:
+            content = molecule_gro_content(molecule, resname)
+            simplification = ""
+        else:
+            content, simplification = reduced_gro_content(
+                molecule, atom_budget, resname
+            )
+        if simplification:
+            captions.append(
+                f"Simplified view of {molecule.name} ({len(molecule)} atoms): "
+                f"{simplification} are shown"
+            )
+        get_mol_view(content, view=view, hoverable=not simplification)
+    view.setStyle({"resn": "START"}, {"sphere": {"scale": 1.5, "opacity": 0.7}})
+    view.setStyle({"resn": "END"}, {"sphere": {"scale": 0.5}})
+    return view._make_html(), captions
+
+
 def represent_molecule_comparative(
-    align: Alignment, width: int = 616, height: int = 400
+    align: Alignment,
+    width: int = 616,
+    height: int = 400,
+    atom_budget: Optional[int] = DEFAULT_ATOM_BUDGET,
+    scale_factor: Optional[float] = None,
+    cache: Optional[RenderCache] = None,
+    slot: str = "",
 ):
     """
     Represents the molecular overlap between start and end of align
@@ -135,59 +527,619 @@ def represent_molecule_comparative(
         column when the browser is maximized.
     height : int, optional
         The height of the view. The default is 400.
+    atom_budget : int or None, optional
+        The maximum number of atoms drawn of each molecule (see
+        represent_molecule). The default is DEFAULT_ATOM_BUDGET.
+    scale_factor : float, optional
+        If given, the molecule in the final resolution is placed as in the
+        system mapped with this scale factor (see scaled_alignment).
+    cache : RenderCache, optional
+        If given, the view is reused while the positions of the molecules and
+        the parameters of the representation do not change.
+    slot : str, optional
+        The place of the view in the cache.
 
     """
-    align.start.resnames = "START"  # type: ignore
-    align.end.resnames = "END"  # type: ignore
-    view1 = represent_molecule(
-        align.end, width=width, height=height, return_showmol=False
-    )
-    view = represent_molecule(align.start, view=view1, return_showmol=False)
-    assert isinstance(view, py3Dmol.view)
-    view.setStyle({"resn": "START"}, {"sphere": {"scale": 1.5, "opacity": 0.7}})
-    view.setStyle({"resn": "END"}, {"sphere": {"scale": 0.5}})
-    showmol(view, height=height, width=width)
 
+    def render() -> tuple[str, list[str]]:
+        aligned = align
+        if scale_factor is not None:
+            aligned = scaled_alignment(align, scale_factor)
+        return comparative_view_html(aligned, width, height, atom_budget)
+
+    if cache is None:
+        html, captions = render()
+    else:
+        key = hashlib.blake2b(
+            repr((width, height, atom_budget, scale_factor)).encode()
+        )
+        for molecule in (align.start, align.end):
+            key.update(np.ascontiguousarray(molecule.atoms_positions).tobytes())
+        html, captions = cache.get_or_render(slot, key.hexdigest(), render)
+    for caption in captions:
+        st.caption(caption)
+    st_components.html(html, height=height, width=width)
 
-def write_and_get_file(uploaded_file: Optional[UploadedFile]) -> Optional[StringIO]:
+
+def scaled_alignment(alignment: Alignment, scale_factor: float) -> Alignment:
     """
-    Takes a file uploaded by streamlit converts it to a StringIO
+    Returns an aligned molecule with the final resolution as in a mapped system
 
-    It also adds some attributes such as the mode and name that are needed to
-    load gaddlemaps objects.
+    The molecule in the final resolution is placed with an exchange map with
+    the given scale factor, so the results of several scale factors can be
+    compared (see represent_molecule_comparative).
 
     Parameters
     ----------
-    uploaded_file : st.FileUploader or None
+    alignment : gaddlemaps.Alignment
+        The alignment of the molecule.
+    scale_factor : float
+        The compression factor applied to the mapped molecule.
+
+    Returns
+    -------
+    gaddlemaps.Alignment
+        A new alignment with the molecule in the initial resolution and the
+        mapped one.
+    """
+    exchange_map = ExchangeMap(alignment.start, alignment.end, scale_factor)
+    return Alignment(start=alignment.start, end=exchange_map(alignment.start))
+
+
+class _SpilledFile:
+    """
+    A temporary file with the content of an upload.
+
+    The file is removed when the last handle opened with the open method is
+    garbage collected.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def open(self) -> TextIO:
+        fopen = open(self.path, encoding="utf-8")
+        # Keeps the file while the handle is alive
+        fopen.spilled_file = self  # type: ignore
+        return fopen
+
+    def __del__(self):
+        with suppress(OSError):
+            os.remove(self.path)
+
+
+def write_and_get_file(uploaded_file: Optional[UploadedFile]) -> Optional[TextIO]:
+    """
+    Takes a file uploaded by streamlit and returns it as an opened text file
+
+    Small files are decoded to a StringIO with the mode and name attributes
+    that are needed to load gaddlemaps objects. Files larger than
+    SPILL_THRESHOLD are written to a temporary file (with the same extension)
+    that is opened in read mode, so the parsers read them from disk instead
+    of keeping a decoded copy in memory.
+
+    Parameters
+    ----------
+    uploaded_file : UploadedFile or None
         The file uploaded by streamlit. If None, returns None.
 
     Returns
     -------
-    tempfile.NamedTemporaryFile
-        The temporary file containing the uploaded file and seeked to the
-        beginning.
+    StringIO or TextIO
+        The opened file seeked to the beginning.
     """
     if uploaded_file is None:
         return None
     name = uploaded_file.name
-    fopen = StringIO(uploaded_file.getvalue().decode("utf-8"))
-    fopen.mode = "r"  # type: ignore
-    fopen.name = name
-    return fopen
+    if uploaded_file.size <= SPILL_THRESHOLD:
+        fopen = StringIO(uploaded_file.getvalue().decode("utf-8"))
+        fopen.mode = "r"  # type: ignore
+        fopen.name = name
+        return fopen
+    stem, extension = os.path.splitext(os.path.basename(name))
+    fdesc, path = tempfile.mkstemp(suffix=extension, prefix=stem + "_")
+    spilled = _SpilledFile(path)
+    with os.fdopen(fdesc, "wb") as fout, uploaded_file.getbuffer() as buffer:
+        fout.write(buffer)
+    return spilled.open()
+
+
+def reopen_file(fopen: TextIO) -> TextIO:
+    """
+    Returns a new handle to a file returned by write_and_get_file.
+
+    Parameters
+    ----------
+    fopen : StringIO or TextIO
+        The opened file.
+
+    Returns
+    -------
+    StringIO or TextIO
+        A new handle to the same content seeked to the beginning.
+    """
+    if hasattr(fopen, "spilled_file"):
+        return fopen.spilled_file.open()  # type: ignore
+    new_fopen = StringIO(fopen.getvalue())  # type: ignore
+    new_fopen.mode = "r"  # type: ignore
+    new_fopen.name = fopen.name  # type: ignore
+    return new_fopen
+
+
+_file_ids = itertools.count(-1, -1)
+
+
+def file_from_content(name: str, content: bytes) -> UploadedFile:
+    """
+    Wraps the content of a file in an UploadedFile
+
+    It is used to rebuild the uploaded files in other processes.
+
+    Parameters
+    ----------
+    name : str
+        The name of the file.
+    content : bytes
+        The content of the file.
+
+    Returns
+    -------
+    UploadedFile
+        The file as if it was uploaded by streamlit.
+    """
+    # Negative ids do not collide with the ones of the real uploads
+    return UploadedFile(UploadedFileRec(next(_file_ids), name, "", content))
+
+
+class AlignmentCancelled(Exception):
+    """
+    Raised when an alignment is stopped because another start of a multi-start
+    alignment already reached the target Chi2.
+    """
+
+
+# Set by the pool of a multi-start alignment in its workers. The alignments
+# running in the worker stop when it is set (see align_molecule_files).
+_stop_event = None
+
+
+def _init_start_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _check_stop():
+    if _stop_event.is_set():
+        raise AlignmentCancelled()
+
+
+def _align_start(args: tuple) -> Optional[tuple]:
+    # Run by the pool of a multi-start alignment, None if it was stopped
+    try:
+        return align_molecule_files(*args)
+    except AlignmentCancelled:
+        return None
+
+
+def align_molecule_files(
+    start_files: tuple[tuple[str, bytes], tuple[str, bytes]],
+    end_files: tuple[tuple[str, bytes], tuple[str, bytes]],
+    restrictions: Optional[list[tuple[int, int]]],
+    seed: Optional[int] = None,
+    engine: str = PYTHON_ENGINE,
+    rotate: bool = False,
+) -> tuple[np.ndarray, np.ndarray, Optional[float], float]:
+    """
+    Aligns a molecule loaded from the content of its files
+
+    This is the function run by the worker processes when the molecules are
+    aligned in parallel (see GlobalInformation.align_molecules). In the
+    workers of a multi-start alignment, the python engines check the stop
+    event of the pool while they run (see alignment_engine) and the
+    alignment is stopped once it is set.
+
+    Parameters
+    ----------
+    start_files : tuple
+        The (name, content) of the .gro and topology files of the molecule in
+        the initial resolution.
+    end_files : tuple
+        The (name, content) of the .gro and topology files of the molecule in
+        the final resolution.
+    restrictions : list of tuple of int or None
+        The parsed restrictions of the alignment.
+    seed : int, optional
+        The seed of the random number generator used in the alignment.
+    engine : str, optional
+        The alignment engine. The default is PYTHON_ENGINE.
+    rotate : bool, optional
+        If True, the molecule moved by the engine (the one with fewer atoms)
+        starts from a random orientation drawn with the seed. The default is
+        starting from the uploaded orientation.
+
+    Returns
+    -------
+    start_positions : numpy.ndarray
+        The aligned positions of the molecule in the initial resolution.
+    end_positions : numpy.ndarray
+        The aligned positions of the molecule in the final resolution.
+    chi2 : float or None
+        The final Chi2 of the alignment.
+    wall_time : float
+        The time taken by the alignment in seconds.
+
+    Raises
+    ------
+    AlignmentCancelled
+        If the stop event of the multi-start pool was set.
+    """
+    start, end = (
+        Molecule.from_files(
+            *(write_and_get_file(file_from_content(*f)) for f in files)
+        )
+        for files in (start_files, end_files)
+    )
+    alignment = Alignment(start=start, end=end)
+    if rotate:
+        moving = start if len(start) < len(end) else end
+        moving.rotate(Rotation.random(random_state=seed).as_matrix())
+    if seed is not None:
+        np.random.seed(seed)
+    start_time = time.perf_counter()
+    output = Chi2Stream()
+    check_stop = None if _stop_event is None else _check_stop
+    with redirect_stdout(output), alignment_engine(engine, check_stop):
+        alignment.align_molecules(restrictions)
+    return (
+        alignment.start.atoms_positions,
+        alignment.end.atoms_positions,
+        output.chi2,
+        time.perf_counter() - start_time,
+    )
 
 
 class GlobalInformation:
     """
     Class that stores global information about the current mapping.
+
+    An instance is kept in the session state (see get_session_information)
+    so the loaded molecules, the alignments and the mapped system survive the
+    reruns of the script. The mapping is split in stages (alignment and
+    exchange map of each molecule and the extrapolation of the system) whose
+    dependencies are tracked with a StageGraph, so only the stages affected
+    by a change in the inputs are run again.
     """
 
     def __init__(self):
         self.system = None
+        self.system_files: list[UploadedFile] = []
+        self.system_key: tuple[str, ...] = ()
         self.molecule_correspondence: dict[str, Alignment] = {}
         self.molecule_restrictions: Restrictions = {}
+        self.end_molecules: dict[str, Molecule] = {}
+        self.end_molecules_keys: dict[str, tuple[str, str]] = {}
+        self.end_files: dict[str, tuple[UploadedFile, UploadedFile]] = {}
         self.errors = False
         self.manager = None
         self.cg_system_name = ""
+        self.scale_factor = 0.5
+        # The .gro files are kept gzip compressed
+        self.mapped_system: Optional[bytes] = None
+        # The systems extrapolated with the current alignments for each scale
+        # factor
+        self.mapped_systems: dict[float, bytes] = {}
+        # The last file exported for each scale factor: (format, compressed
+        # .gro it was built from, content)
+        self._exports: dict[float, tuple[str, bytes, bytes]] = {}
+        # The 3D views of the aligned molecules, in slots named after them
+        self.render_cache = RenderCache()
+        # The compressed .gro and the preview of the last previewed system
+        self._preview: Optional[tuple[bytes, SystemPreview]] = None
+        self.stages = StageGraph()
+        self.job_id: Optional[str] = None
+        self.last_job_id: Optional[str] = None
+        self.engine = available_engines()[0]
+        self.alignment_times: dict[str, tuple[str, float]] = {}
+        self.alignment_chi2: dict[str, Optional[float]] = {}
+        # Number of independent alignments of each molecule (the best one is
+        # kept) and the Chi2 that stops the remaining ones when it is reached
+        self.alignment_starts = 1
+        self.target_chi2: Optional[float] = None
+        # The Chi2 of the finished starts of the multi-start alignments
+        # (sorted) and the number of starts that were stopped
+        self.alignment_spread: dict[str, tuple[list[float], int]] = {}
+        # Optional caching.AlignmentCache with the results of previous
+        # alignments
+        self.alignment_cache = None
+        # Optional function that receives the progress events of the mapping
+        # (see progress.progress_event)
+        self.progress: Optional[ProgressCallback] = None
+        # Wall time, CPU time and peak memory of each phase of the mapping
+        self.profiler = PhaseProfiler()
+        # Peak resident memory in MB measured after loading the uploads
+        # ("load", server process) and during the last mapping ("mapping",
+        # worker process)
+        self.peak_memory: dict[str, float] = {}
+        # The atom table of each molecule (and resolution) to resolve the
+        # selections of the constraints, with the key of the files it was
+        # built from
+        self._atom_tables: dict[tuple[str, bool], tuple[Hashable, AtomTable]] = {}
+
+    @property
+    def is_aligned(self) -> bool:
+        """
+        bool : True if all the molecules were aligned with the current inputs.
+        """
+        names = self.stages.stages("align:")
+        return bool(names) and all(self.stages.is_up_to_date(n) for n in names)
+
+    @property
+    def is_mapped(self) -> bool:
+        """
+        bool : True if the mapped system corresponds to the current inputs and
+            scale factor.
+        """
+        return (
+            self.mapped_system is not None
+            and "extrapolate" in self.stages
+            and self.stages.is_up_to_date("extrapolate")
+        )
+
+    def set_system(self, system: Optional[System], key: tuple[str, ...]):
+        """
+        Replaces the system to be mapped.
+
+        The alignments of the molecules whose topology (and the ones uploaded
+        before it) did not change are kept.
+
+        Parameters
+        ----------
+        system : gaddlemaps.components.System or None
+            The new system.
+        key : tuple of str
+            The hashes of the .gro and topology files used to load the system.
+        """
+        old_key = self.system_key
+        self.system = system
+        self.system_key = key
+        self.manager = None
+        self.mapped_systems.clear()
+        self._exports.clear()
+        self._preview = None
+        self.render_cache.evict()
+        molecules = system.different_molecules if system is not None else []
+        correspondence = {}
+        for index, mol in enumerate(molecules):
+            unchanged = key[: index + 2] == old_key[: index + 2]
+            if unchanged and mol.name in self.molecule_correspondence:
+                correspondence[mol.name] = self.molecule_correspondence[mol.name]
+            else:
+                correspondence[mol.name] = Alignment(start=mol)
+                self._remove_end_molecule(mol.name)
+        self.molecule_correspondence = correspondence
+        for name in list(self.end_molecules):
+            if name not in correspondence:
+                self._remove_end_molecule(name)
+        for name in list(self.molecule_restrictions):
+            if name not in correspondence:
+                del self.molecule_restrictions[name]
+        self._build_stages()
+
+    def load_system_files(self, files: list[UploadedFile], key: tuple[str, ...]):
+        """
+        Parses the system from its files and sets it (see set_system).
+
+        Parameters
+        ----------
+        files : list of UploadedFile
+            The .gro file of the system followed by the topologies of the
+            molecules to find in it.
+        key : tuple of str
+            The hashes of the files.
+        """
+        self.system_files = list(files)
+        with self.profiler.phase("load:system"):
+            system = System(write_and_get_file(files[0]))
+            for upl in files[1:]:
+                add_ftop(system, write_and_get_file(upl))
+        self.set_system(system, key)
+
+    def load_end_molecule(
+        self,
+        mol_name: str,
+        fgro: UploadedFile,
+        ftop: UploadedFile,
+        key: tuple[str, str],
+    ):
+        """
+        Parses a molecule in the final resolution and sets it (see
+        set_end_molecule).
+
+        Parameters
+        ----------
+        mol_name : str
+            The name of the molecule in the system.
+        fgro : UploadedFile
+            The .gro file of the molecule in the final resolution.
+        ftop : UploadedFile
+            The topology of the molecule in the final resolution.
+        key : tuple of str
+            The hashes of the files.
+        """
+        with self.profiler.phase(f"load:{mol_name}"):
+            molecule = Molecule.from_files(
+                write_and_get_file(fgro), write_and_get_file(ftop)
+            )
+        self.set_end_molecule(mol_name, molecule, key, files=(fgro, ftop))
+
+    def _remove_end_molecule(self, mol_name: str):
+        self.end_molecules.pop(mol_name, None)
+        self.end_molecules_keys.pop(mol_name, None)
+        self.end_files.pop(mol_name, None)
+
+    def set_end_molecule(
+        self,
+        mol_name: str,
+        molecule: Optional[Molecule],
+        key: Optional[tuple[str, str]],
+        files: Optional[tuple[UploadedFile, UploadedFile]] = None,
+    ):
+        """
+        Sets the molecule in the final resolution of a molecule in the system.
+
+        Nothing is done if the molecule was loaded from the same files.
+
+        Parameters
+        ----------
+        mol_name : str
+            The name of the molecule in the system.
+        molecule : gaddlemaps.components.Molecule or None
+            The molecule in the final resolution. If None, the previous one is
+            removed.
+        key : tuple of str or None
+            The hashes of the .gro and topology files used to load the
+            molecule.
+        files : tuple of UploadedFile, optional
+            The uploaded .gro and topology files of the molecule. They are
+            needed to run the mapping in a worker process.
+        """
+        if self.end_molecules_keys.get(mol_name) == key:
+            return
+        self.molecule_correspondence[mol_name] = Alignment(
+            start=self._start_molecule(mol_name), end=molecule
+        )
+        self._alignment_changed(mol_name)
+        if molecule is None:
+            self._remove_end_molecule(mol_name)
+        else:
+            self.end_molecules[mol_name] = molecule
+            self.end_molecules_keys[mol_name] = key
+            if files is not None:
+                self.end_files[mol_name] = files
+        self.stages.invalidate(f"align:{mol_name}")
+        self._build_stages()
+
+    def _alignment_changed(self, mol_name: str):
+        """
+        Forgets the results computed with the previous alignment of a molecule.
+        """
+        self.alignment_spread.pop(mol_name, None)
+        self.stages.invalidate(f"exchange_map:{mol_name}")
+        self.stages.invalidate("extrapolate")
+        self.mapped_systems.clear()
+        self._exports.clear()
+        self._preview = None
+        self.render_cache.evict(f"{mol_name}:")
+        self.render_cache.evict("system:")
+
+    def atom_table(self, mol_name: str, final: bool = False) -> AtomTable:
+        """
+        Returns the table of the atoms of a molecule to resolve selections.
+
+        The table is built once for each uploaded molecule.
+
+        Parameters
+        ----------
+        mol_name : str
+            The name of the molecule in the system.
+        final : bool, optional
+            If True, the table of the molecule in the final resolution is
+            returned. The default is False (initial resolution).
+
+        Returns
+        -------
+        selection.AtomTable
+            The table of the atoms.
+        """
+        index = list(self.molecule_correspondence).index(mol_name)
+        if final:
+            key = self.end_molecules_keys[mol_name]
+        else:
+            key = self.system_key[: index + 2]
+        cached = self._atom_tables.get((mol_name, final))
+        if cached is None or cached[0] != key:
+            alignment = self.molecule_correspondence[mol_name]
+            molecule = alignment.end if final else alignment.start
+            cached = key, AtomTable.from_molecule(molecule)
+            self._atom_tables[(mol_name, final)] = cached
+        return cached[1]
+
+    def _start_molecule(self, mol_name: str) -> Molecule:
+        return next(
+            mol for mol in self.system.different_molecules if mol.name == mol_name
+        )
+
+    def _build_stages(self):
+        """
+        Registers the stages of the molecules with both resolutions loaded.
+        """
+        complete = [
+            name
+            for name in self.molecule_correspondence
+            if name in self.end_molecules
+        ]
+        for stage in self.stages.stages("align:") + self.stages.stages(
+            "exchange_map:"
+        ):
+            if stage.split(":", 1)[1] not in complete:
+                self.stages.remove_stage(stage)
+        for name in complete:
+            self.stages.add_stage(
+                f"align:{name}",
+                key=lambda name=name: self._alignment_key(name),
+                run=lambda name=name: self._align_molecule(name),
+            )
+            self.stages.add_stage(
+                f"exchange_map:{name}",
+                key=lambda: self.scale_factor,
+                run=lambda name=name: self._init_exchange_map(name),
+                depends_on=[f"align:{name}"],
+            )
+        if complete:
+            self.stages.add_stage(
+                "extrapolate",
+                key=lambda: self.system_key,
+                run=self._extrapolate,
+                depends_on=[f"exchange_map:{name}" for name in complete],
+            )
+        else:
+            self.stages.remove_stage("extrapolate")
+
+    def _alignment_key(self, mol_name: str) -> tuple:
+        index = list(self.molecule_correspondence).index(mol_name)
+        return (
+            self.system_key[: index + 2],
+            self.end_molecules_keys[mol_name],
+            tuple(self.molecule_restrictions.get(mol_name) or ()),
+        )
+
+    def report_progress(self, *args, **kwargs):
+        """
+        Sends a progress event to the progress callback, if it is set.
+
+        The arguments are the ones of progress.progress_event.
+        """
+        if self.progress is not None:
+            self.progress(progress_event(*args, **kwargs))
+
+    def record_memory(self, phase: str, peak: Optional[float] = None):
+        """
+        Stores the memory used in a phase of the mapping in peak_memory.
+
+        Parameters
+        ----------
+        phase : str
+            The name of the phase.
+        peak : float, optional
+            The peak memory in MB. The default is the current memory of the
+            process (the maximum of all the calls for the same phase is kept).
+        """
+        if peak is None:
+            peak = memory_usage()[0]
+            if peak is None:
+                return
+            peak = max(peak, self.peak_memory.get(phase, 0.0))
+        self.peak_memory[phase] = peak
 
     def init_manager(self):
         """
@@ -196,58 +1148,557 @@ class GlobalInformation:
         self.manager = Manager(self.system)
         self.manager.molecule_correspondence = self.molecule_correspondence
 
-    def align_molecules(self):
+    def _parsed_restrictions(self, mol_name: str) -> Optional[list[tuple[int, int]]]:
+        if self.manager is None:
+            self.init_manager()
+        return self.manager.parse_restrictions(
+            {mol_name: self.molecule_restrictions.get(mol_name)}
+        )[mol_name]
+
+    def _align_molecule(self, mol_name: str, seed: Optional[int] = None):
         """
-        Aligns the molecules in the manager.
+        Aligns one molecule starting from the uploaded configurations.
         """
+        self.molecule_correspondence[mol_name] = Alignment(
+            start=self._start_molecule(mol_name), end=self.end_molecules[mol_name]
+        )
+        self._alignment_changed(mol_name)
+        restrictions = self._parsed_restrictions(mol_name)
+        self.report_progress(ALIGN, mol_name)
+        if seed is not None:
+            np.random.seed(seed)
+        start_time = time.perf_counter()
+        output = Chi2Stream(
+            lambda step, chi2: self.report_progress(ALIGN, mol_name, step, chi2)
+        )
+        with redirect_stdout(output), alignment_engine(self.engine):
+            with self.profiler.phase(f"align:{mol_name}"):
+                self.molecule_correspondence[mol_name].align_molecules(restrictions)
+        self.alignment_times[mol_name] = (
+            self.engine,
+            time.perf_counter() - start_time,
+        )
+        self.alignment_chi2[mol_name] = output.chi2
+
+    def _align_molecule_starts(
+        self, mol_name: str, seed: Optional[int] = None, workers: int = 1
+    ):
+        """
+        Aligns one molecule alignment_starts times and keeps the best result.
+
+        The first start is the uploaded configuration and the rest start from
+        random orientations. The starts run in a pool of worker processes
+        (or one after another if workers is 1). Once a start reaches
+        target_chi2 the rest are stopped: the python engines check the stop
+        event of the pool and the workers running the C++ engine, which can
+        not check it, are terminated.
+        """
+        if seed is None:
+            seed = random.getrandbits(32)
+        args = (*self._molecule_files(mol_name), self._parsed_restrictions(mol_name))
+        starts = [
+            args + ((seed + index) % 2**32, self.engine, index > 0)
+            for index in range(self.alignment_starts)
+        ]
+        results: list[tuple[float, np.ndarray, np.ndarray]] = []
+        self.report_progress(ALIGN, mol_name)
+
+        def finished(start_positions, end_positions, chi2) -> bool:
+            # Keeps the result of a start and returns True if it is good enough
+            chi2 = np.inf if chi2 is None else chi2
+            results.append((chi2, start_positions, end_positions))
+            best = min(result[0] for result in results)
+            self.report_progress(ALIGN, mol_name, chi2=None if np.isinf(best) else best)
+            return self.target_chi2 is not None and chi2 <= self.target_chi2
+
+        start_time = time.perf_counter()
+        with self.profiler.phase(f"align:{mol_name}"):
+            if workers <= 1:
+                for start in starts:
+                    if finished(*align_molecule_files(*start)[:3]):
+                        break
+            else:
+                context = multiprocessing.get_context("spawn")
+                stop_event = context.Event()
+                with context.Pool(
+                    min(workers, len(starts)), _init_start_worker, (stop_event,)
+                ) as pool:
+                    for result in pool.imap_unordered(_align_start, starts):
+                        if result is not None and finished(*result[:3]):
+                            stop_event.set()
+                            if self.engine == CPP_ENGINE:
+                                # Leaving the context terminates the workers
+                                break
+        chi2, start_positions, end_positions = min(results, key=lambda r: r[0])
+        self.restore_alignment(mol_name, start_positions, end_positions)
+        self.alignment_times[mol_name] = (self.engine, time.perf_counter() - start_time)
+        self.alignment_chi2[mol_name] = None if np.isinf(chi2) else chi2
+        self.alignment_spread[mol_name] = (
+            sorted(float(r[0]) for r in results if not np.isinf(r[0])),
+            len(starts) - len(results),
+        )
+
+    def _alignment_cache_key(self, mol_name: str) -> tuple:
+        """
+        Returns the key of the alignment of a molecule in alignment_cache.
+
+        Unlike the key of the alignment stage, it does not depend on the
+        system, only on the molecule topology in the initial resolution. The
+        multi-start alignments are stored apart from the single ones for each
+        number of starts and target Chi2.
+        """
+        index = list(self.molecule_correspondence).index(mol_name)
+        key = (
+            self.system_key[index + 1],
+            self.end_molecules_keys[mol_name],
+            tuple(self.molecule_restrictions.get(mol_name) or ()),
+        )
+        if self.alignment_starts > 1:
+            key += ((self.alignment_starts, self.target_chi2),)
+        return key
+
+    def _load_cached_alignment(self, mol_name: str) -> bool:
+        """
+        Restores the alignment of a molecule from alignment_cache.
+
+        Returns
+        -------
+        bool
+            True if the alignment was found in the cache.
+        """
+        cached = self.alignment_cache.get(self._alignment_cache_key(mol_name))
+        if cached is None:
+            return False
+        start_positions, end_positions, chi2, spread = cached
+        self.restore_alignment(mol_name, start_positions, end_positions)
+        self.alignment_times[mol_name] = (CACHED_ALIGNMENT, 0.0)
+        self.alignment_chi2[mol_name] = None if np.isnan(chi2) else chi2
+        if spread is not None:
+            self.alignment_spread[mol_name] = spread
+        self.report_progress(CACHED, mol_name, chi2=self.alignment_chi2[mol_name])
+        return True
+
+    def _store_cached_alignment(self, mol_name: str):
+        if self.alignment_cache is None:
+            return
+        alignment = self.molecule_correspondence[mol_name]
+        self.alignment_cache.store(
+            self._alignment_cache_key(mol_name),
+            alignment.start.atoms_positions,
+            alignment.end.atoms_positions,
+            self.alignment_chi2.get(mol_name),
+            self.alignment_spread.get(mol_name),
+        )
+
+    def _molecule_files(self, mol_name: str) -> tuple[tuple, tuple]:
+        """
+        Returns the (name, content) of the files of both resolutions of a
+        molecule. The initial one is written from the molecule in the system.
+        """
+        index = list(self.molecule_correspondence).index(mol_name)
+        ftop = self.system_files[index + 1]
+        start_gro = molecule_gro_content(self._start_molecule(mol_name))
+        return (
+            ((mol_name + ".gro", start_gro.encode()), (ftop.name, ftop.getvalue())),
+            tuple((upl.name, upl.getvalue()) for upl in self.end_files[mol_name]),
+        )
+
+    def restore_alignment(
+        self,
+        mol_name: str,
+        start_positions: np.ndarray,
+        end_positions: np.ndarray,
+        key: Optional[Hashable] = None,
+    ):
+        """
+        Sets the result of an alignment computed somewhere else.
+
+        Parameters
+        ----------
+        mol_name : str
+            The name of the molecule.
+        start_positions : numpy.ndarray
+            The aligned positions of the molecule in the initial resolution.
+        end_positions : numpy.ndarray
+            The aligned positions of the molecule in the final resolution.
+        key : Hashable, optional
+            The key of the alignment stage when the alignment was computed.
+            The default is the current one.
+        """
+        alignment = Alignment(
+            start=self._start_molecule(mol_name), end=self.end_molecules[mol_name]
+        )
+        alignment.start.atoms_positions = start_positions
+        alignment.end.atoms_positions = end_positions
+        self.molecule_correspondence[mol_name] = alignment
+        self._alignment_changed(mol_name)
+        stage = f"align:{mol_name}"
+        self.stages.mark_done(stage, self.stages.key(stage) if key is None else key)
+
+    def job_spec(
+        self, force: bool = False, scale_factors: Sequence[float] = ()
+    ) -> dict[str, Any]:
+        """
+        Returns the inputs needed to run the mapping in a worker process.
+
+        Only the molecules whose alignment is not up to date are aligned by
+        the worker. The positions of the rest are sent in the spec.
+
+        Parameters
+        ----------
+        force : bool, optional
+            If True, all the molecules are aligned again. The default is False.
+        scale_factors : sequence of float, optional
+            The scale factors used to extrapolate the system after the
+            alignment. The ones already in mapped_systems are skipped (unless
+            the molecules are aligned again). The default is only aligning.
+
+        Returns
+        -------
+        dict
+            The spec of the mapping job (see jobs.run_mapping_job).
+        """
+        align_stages = self.stages.stages("align:")
+        to_align = [
+            stage.split(":", 1)[1]
+            for stage in align_stages
+            if force or not self.stages.is_up_to_date(stage)
+        ]
+        if not to_align:
+            scale_factors = [
+                factor for factor in scale_factors if factor not in self.mapped_systems
+            ]
+        return {
+            "name": self.cg_system_name,
+            "system_files": [(upl.name, upl.getvalue()) for upl in self.system_files],
+            "system_key": self.system_key,
+            "end_files": {
+                mol_name: tuple((upl.name, upl.getvalue()) for upl in files)
+                for mol_name, files in self.end_files.items()
+            },
+            "end_molecules_keys": dict(self.end_molecules_keys),
+            "restrictions": dict(self.molecule_restrictions),
+            "scale_factor": self.scale_factor,
+            "scale_factors": list(scale_factors),
+            "engine": self.engine,
+            "alignment_starts": self.alignment_starts,
+            "target_chi2": self.target_chi2,
+            "aligned": {
+                mol_name: (ali.start.atoms_positions, ali.end.atoms_positions)
+                for mol_name, ali in self.molecule_correspondence.items()
+                if mol_name in self.end_molecules and mol_name not in to_align
+            },
+            "to_align": to_align,
+            "force": force,
+            "seeds": {mol_name: random.getrandbits(32) for mol_name in to_align},
+            "stage_keys": {stage: self.stages.key(stage) for stage in align_stages},
+        }
+
+    @classmethod
+    def from_job_spec(cls, spec: dict[str, Any]) -> "GlobalInformation":
+        """
+        Loads the mapping described by a spec in a new instance.
+
+        The molecules can not be sent between processes so they are loaded
+        again from the content of the files in the spec and the molecules that
+        were already aligned are restored.
+
+        Parameters
+        ----------
+        spec : dict
+            The spec of the mapping (see job_spec).
+
+        Returns
+        -------
+        GlobalInformation
+            The loaded mapping.
+        """
+        information = cls()
+        information.cg_system_name = spec["name"]
+        information.load_system_files(
+            [file_from_content(*f) for f in spec["system_files"]], spec["system_key"]
+        )
+        for mol_name, (fgro, ftop) in spec["end_files"].items():
+            information.load_end_molecule(
+                mol_name,
+                file_from_content(*fgro),
+                file_from_content(*ftop),
+                spec["end_molecules_keys"][mol_name],
+            )
+        information.molecule_restrictions = spec["restrictions"]
+        information.scale_factor = spec["scale_factor"]
+        information.engine = spec["engine"]
+        information.alignment_starts = spec["alignment_starts"]
+        information.target_chi2 = spec["target_chi2"]
+        for mol_name, positions in spec["aligned"].items():
+            information.restore_alignment(mol_name, *positions)
+        return information
+
+    def apply_job_result(self, spec: dict[str, Any], result: dict[str, Any]):
+        """
+        Uses the result of a mapping job computed in a worker process.
+
+        The results of the stages whose inputs changed while the job was
+        running are discarded. The extrapolated systems are only kept if
+        the alignments of all the molecules are the ones used in the job.
+
+        Parameters
+        ----------
+        spec : dict
+            The spec of the job (see job_spec).
+        result : dict
+            The result of the job (see jobs.run_mapping_job).
+        """
+        for mol_name, positions in result["positions"].items():
+            stage = f"align:{mol_name}"
+            key = spec["stage_keys"][stage]
+            if stage in self.stages and self.stages.key(stage) == key:
+                self.restore_alignment(mol_name, *positions, key=key)
+                self.alignment_times[mol_name] = result["alignment_times"][mol_name]
+                self.alignment_chi2[mol_name] = result["alignment_chi2"][mol_name]
+                spread = result["alignment_spread"].get(mol_name)
+                if spread is not None:
+                    self.alignment_spread[mol_name] = spread
+        if result.get("peak_memory") is not None:
+            self.record_memory("mapping", result["peak_memory"])
+        self.profiler.update(result.get("phases", {}))
+        unchanged = self.system_key == tuple(spec["system_key"]) and all(
+            stage in self.stages and self.stages.key(stage) == key
+            for stage, key in spec["stage_keys"].items()
+        )
+        if not (self.is_aligned and unchanged):
+            return
+        self.mapped_systems.update(result["mapped_systems"])
+        if result["map_stage_keys"]:
+            # The exchange maps and the system were calculated in the job. The
+            # maps are not sent, they are calculated here only if needed (see
+            # calculate_exchange_maps)
+            self.scale_factor = spec["scale_factor"]
+            for stage, key in result["map_stage_keys"].items():
+                if stage in self.stages and self.stages.key(stage) == key:
+                    self.stages.mark_done(stage, key)
+            self.mapped_system = self.mapped_systems[spec["scale_factor"]]
+
+    def _init_exchange_map(self, mol_name: str):
+        self.report_progress(EXCHANGE_MAPS, mol_name)
+        with self.profiler.phase(f"exchange_map:{mol_name}"):
+            self.molecule_correspondence[mol_name].init_exchange_map(self.scale_factor)
+
+    def _invalidate_missing_exchange_maps(self):
+        # The exchange map stages marked as done from the result of a job do
+        # not have the maps in this process (see apply_job_result)
+        for stage in self.stages.stages("exchange_map:"):
+            mol_name = stage.split(":", 1)[1]
+            if self.molecule_correspondence[mol_name].exchange_map is None:
+                self.stages.invalidate(stage)
+
+    def _extrapolate(self):
+        if self.scale_factor in self.mapped_systems:
+            self.mapped_system = self.mapped_systems[self.scale_factor]
+            return
+        self.report_progress(EXTRAPOLATE)
         if self.manager is None:
             self.init_manager()
-        self.manager.align_molecules(restrictions=self.molecule_restrictions)
+        with self.profiler.phase("extrapolate"):
+            with tempfile.NamedTemporaryFile(suffix=".gro") as temp_gro:
+                self.manager.extrapolate_system(temp_gro.name)
+                temp_gro.seek(0)
+                self.mapped_system = compress_file(temp_gro)
+        self.mapped_systems[self.scale_factor] = self.mapped_system
 
+    def align_molecules(
+        self,
+        force: bool = False,
+        workers: int = 1,
+        seeds: Optional[dict[str, int]] = None,
+    ) -> list[str]:
+        """
+        Aligns the molecules whose inputs changed since their last alignment.
 
-@contextmanager
-def st_redirect(src, dst):
-    """
-    Redirects the terminal output to the streamlit app.
-    """
-    placeholder = st.empty()
-    output_func = getattr(placeholder, dst)
-
-    with StringIO() as buffer:
-        old_write = src.write
-
-        def new_write(b):
-            if get_script_run_ctx():
-                buffer.write(b + "")
-                all_lines = buffer.getvalue().split("\n")
-                try:
-                    index = all_lines.index("Calculating exchange maps...")
-                    lines, end = all_lines[:index], all_lines[index:]
-                except ValueError:
-                    lines, end = all_lines, []
-
-                headers, chis = lines[0::4], lines[2::4]
-                value = "\n\n".join(
-                    [
-                        i + "\n\n" + (j.split("\r")[-1] if j else "Chi2")
-                        for i, j in zip(headers, chis)
-                    ]
+        The molecules are independent, so they can be aligned at the same
+        time in a pool of worker processes. Each molecule is loaded in the
+        workers from the content of its files, which must be available in
+        system_files and end_files. As the alignment engine is stochastic,
+        the same result as the serial alignment is only obtained if the
+        seeds are given. The engine used and the time taken by each molecule
+        are stored in alignment_times and the final chi2 in alignment_chi2.
+
+        If alignment_starts is greater than 1, the molecules are aligned one
+        after another and the workers run the starts of each molecule instead
+        (see _align_molecule_starts). The Chi2 of the starts are stored in
+        alignment_spread.
+
+        If alignment_cache is set, the molecules found in it are not aligned
+        again (unless force is True) and the new results are stored in it.
+
+        Parameters
+        ----------
+        force : bool, optional
+            If True, all the molecules are aligned again. The default is False.
+        workers : int, optional
+            The number of processes used to align the molecules (or the
+            starts of each molecule). If 1 (the default) they are aligned one
+            after another in the current process.
+        seeds : dict of str: int, optional
+            The seed of the random number generator used in the alignment of
+            each molecule.
+
+        Returns
+        -------
+        list of str
+            The names of the stages that were run.
+        """
+        seeds = seeds or {}
+        stages = self.stages.stages("align:")
+        if force:
+            for stage in stages:
+                self.stages.invalidate(stage)
+        pending = [stage for stage in stages if not self.stages.is_up_to_date(stage)]
+        executed = pending
+        if self.alignment_cache is not None and not force:
+            pending = [
+                stage
+                for stage in pending
+                if not self._load_cached_alignment(stage.split(":", 1)[1])
+            ]
+        if self.alignment_starts > 1:
+            for stage in pending:
+                mol_name = stage.split(":", 1)[1]
+                self._align_molecule_starts(mol_name, seeds.get(mol_name), workers)
+                self._store_cached_alignment(mol_name)
+            return executed
+        if workers <= 1 or len(pending) <= 1:
+            for stage in pending:
+                mol_name = stage.split(":", 1)[1]
+                key = self.stages.key(stage)
+                self._align_molecule(mol_name, seeds.get(mol_name))
+                self.stages.mark_done(stage, key)
+                self._store_cached_alignment(mol_name)
+            return executed
+
+        context = multiprocessing.get_context("spawn")
+        with self.profiler.phase("align:parallel"), ProcessPoolExecutor(
+            min(workers, len(pending)), context
+        ) as pool:
+            futures = []
+            for stage in pending:
+                mol_name = stage.split(":", 1)[1]
+                future = pool.submit(
+                    align_molecule_files,
+                    *self._molecule_files(mol_name),
+                    self._parsed_restrictions(mol_name),
+                    seeds.get(mol_name),
+                    self.engine,
                 )
-                output_func(value + "\n\n" + "\n\n".join(end) + "")
-            else:
-                old_write(b)
+                futures.append((stage, mol_name, self.stages.key(stage), future))
+                self.report_progress(ALIGN, mol_name)
+            # The results are merged in order so the events are the same as
+            # in the serial alignment
+            for stage, mol_name, key, future in futures:
+                start_positions, end_positions, chi2, wall_time = future.result()
+                self.restore_alignment(mol_name, start_positions, end_positions, key)
+                self.alignment_times[mol_name] = (self.engine, wall_time)
+                self.alignment_chi2[mol_name] = chi2
+                self.report_progress(ALIGN, mol_name, chi2=chi2)
+                self._store_cached_alignment(mol_name)
+        return executed
 
-        try:
-            src.write = new_write
-            yield
-        finally:
-            src.write = old_write
+    def calculate_exchange_maps(self, scale_factor: float) -> list[str]:
+        """
+        Calculates the exchange maps that are not up to date.
 
+        Parameters
+        ----------
+        scale_factor : float
+            The compression factor to apply to mapped molecules.
 
-@contextmanager
-def st_stdout(dst):
+        Returns
+        -------
+        list of str
+            The names of the stages that were run.
+        """
+        self.scale_factor = scale_factor
+        self._invalidate_missing_exchange_maps()
+        executed = []
+        for stage in self.stages.stages("exchange_map:"):
+            executed += self.stages.run(stage)
+        return executed
+
+    def extrapolate_system(self) -> bytes:
+        """
+        Generates the mapped system (if needed) and returns its .gro content.
+
+        Returns
+        -------
+        bytes
+            The gzip compressed content of the .gro file with the mapped
+            system.
+        """
+        self._invalidate_missing_exchange_maps()
+        self.stages.run("extrapolate")
+        return self.mapped_system
+
+    def export_mapped_system(
+        self, scale_factor: float, fmt: str, fname: str
+    ) -> bytes:
+        """
+        Returns the system mapped with a scale factor in a download format.
+
+        The file is built from the compressed .gro in mapped_systems and the
+        last one of each scale factor is kept, so it is not built again in
+        each run of the script.
+
+        Parameters
+        ----------
+        scale_factor : float
+            The scale factor of the mapped system (in mapped_systems).
+        fmt : str
+            The key of the format in exports.EXPORT_FORMATS.
+        fname : str
+            The name of the .gro file (used inside .zip files).
+
+        Returns
+        -------
+        bytes
+            The content of the file.
+        """
+        content = self.mapped_systems[scale_factor]
+        cached = self._exports.get(scale_factor)
+        if cached is not None and cached[0] == fmt and cached[1] is content:
+            return cached[2]
+        data = EXPORT_FORMATS[fmt][3](content, fname)
+        self._exports[scale_factor] = (fmt, content, data)
+        return data
+
+    def system_preview(self, scale_factor: float) -> SystemPreview:
+        """
+        Returns the preview of the system mapped with a scale factor.
+
+        Only the preview of the last system is kept, so the .gro file is
+        parsed again when the scale factor changes.
+
+        Parameters
+        ----------
+        scale_factor : float
+            The scale factor of the mapped system (in mapped_systems).
+
+        Returns
+        -------
+        SystemPreview
+            The parsed system.
+        """
+        content = self.mapped_systems[scale_factor]
+        if self._preview is None or self._preview[0] is not content:
+            self._preview = (content, SystemPreview(content))
+        return self._preview[1]
+
+
+def get_session_information() -> GlobalInformation:
     """
-    This will show the prints
+    Returns the GlobalInformation of the current session.
+
+    It is created the first time the script runs in the session.
     """
-    with st_redirect(sys.stdout, dst):
-        yield
+    if "information" not in st.session_state:
+        st.session_state.information = GlobalInformation()
+    return st.session_state.information